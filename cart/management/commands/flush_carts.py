@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from cart.store import flush_dirty_carts
+
+
+class Command(BaseCommand):
+    help = "Write carts changed in Redis back to Cart/CartItem (run periodically when CART_STORAGE is 'redis')"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Dirty carts fetched from Redis at a time")
+
+    def handle(self, *args, **options):
+        flushed = flush_dirty_carts(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Flushed {flushed} carts"))
@@ -1,4 +1,7 @@
+from decimal import Decimal
 from django.db import models
+from django.db.models import DecimalField, F, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from accounts.models import User
 from products.models import Product,ProductVariant
 from core.utils import Base_content
@@ -8,20 +11,63 @@ class Cart(Base_content):
     user = models.OneToOneField(User, related_name='cart', on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Running totals over the items, kept in step by every cart mutation
+    item_count = models.IntegerField(default=0, editable=False)
+    subtotal = models.DecimalField(max_digits=20, decimal_places=2, default=0, editable=False)
+    discount_total = models.DecimalField(max_digits=20, decimal_places=2, default=0, editable=False)
 
     def __str__(self):
         return f"Cart of {self.user.email}"
 
+    @staticmethod
+    def adjust_totals(cart_id, count_delta, subtotal_delta, discount_delta):
+        Cart.objects.filter(pk=cart_id).update(
+            item_count=F('item_count') + count_delta,
+            subtotal=F('subtotal') + subtotal_delta,
+            discount_total=F('discount_total') + discount_delta,
+        )
+
+    @staticmethod
+    def refresh_totals(cart_ids):
+        """
+        Recompute the totals of whole carts with one set-based UPDATE, for bulk changes.
+        """
+        items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+        money = DecimalField(max_digits=20, decimal_places=2)
+        Cart.objects.filter(pk__in=list(cart_ids)).update(
+            item_count=Coalesce(Subquery(items.annotate(total=Sum('quantity')).values('total')),
+                                Value(0), output_field=IntegerField()),
+            subtotal=Coalesce(Subquery(items.annotate(total=Sum('cart_total')).values('total')),
+                              Value(Decimal(0)), output_field=money),
+            discount_total=Coalesce(Subquery(items.annotate(total=Sum('discount_total')).values('total')),
+                                    Value(Decimal(0)), output_field=money),
+        )
+
 class CartItem(Base_content):
     cart = models.ForeignKey(Cart, related_name='items', on_delete=models.CASCADE)
     variant = models.ForeignKey(ProductVariant, related_name='cart_items', on_delete=models.SET_NULL, null=True, blank=True)
     quantity = models.IntegerField(default=1)
     price = models.DecimalField(max_digits=10, decimal_places=2,null=True,blank=True)
     cart_total = models.DecimalField(max_digits=20,decimal_places=2,null=True)
+    discount_total = models.DecimalField(max_digits=20, decimal_places=2, default=0)
 
     def __str__(self):
         return f"{self.quantity} x {self.variant}"
 
+    def price_line(self, variant):
+        """
+        Set price, cart_total and discount_total from the variant's current prices and self.quantity.
+        """
+        self.price = variant.price
+        self.cart_total = self.quantity * Decimal(variant.price)
+        self.discount_total = line_discount(variant.price, variant.discount_price, self.quantity)
+
+
+def line_discount(price, discount_price, quantity):
+    if discount_price is None or price is None or Decimal(discount_price) >= Decimal(price):
+        return Decimal(0)
+    return (Decimal(price) - Decimal(discount_price)) * quantity
+
 class Coupon(models.Model):
     code = models.CharField(max_length=50, unique=True)
     discount = models.DecimalField(max_digits=5, decimal_places=2, help_text="Discount percentage")
@@ -1,22 +1,92 @@
 from rest_framework import serializers
 from .models import Cart, CartItem,Wishlist
 from products.models import ProductVariant
-from products.serializers import ProductVariantSerializer
+from products.serializers import ProductVariantSerializer, ProductVariantSummarySerializer
+from core.serializers import QueryPlanMixin
+from .store import MAX_QUANTITY
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(QueryPlanMixin, serializers.ModelSerializer):
     # variant = serializers.StringRelatedField()
     variant = ProductVariantSerializer()
+    plan_nested = {'variant': ProductVariantSerializer}
 
     class Meta:
         model = CartItem
-        fields = ['id', 'variant', 'quantity', 'price', 'cart_total']
+        fields = ['id', 'variant', 'quantity', 'price', 'cart_total', 'discount_total']
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(QueryPlanMixin, serializers.ModelSerializer):
     items = CartItemSerializer(many=True, read_only=True)
+    plan_prefetch_nested = {'items': CartItemSerializer}
 
     class Meta:
         model = Cart
-        fields = ['id', 'user', 'created_at', 'updated_at', 'items']
+        fields = ['id', 'user', 'created_at', 'updated_at', 'item_count', 'subtotal', 'discount_total', 'items']
+
+
+class CartItemSummarySerializer(CartItemSerializer):
+    variant = ProductVariantSummarySerializer()
+    plan_nested = {'variant': ProductVariantSummarySerializer}
+
+
+class CartSummarySerializer(CartSerializer):
+    items = CartItemSummarySerializer(many=True, read_only=True)
+    plan_prefetch_nested = {'items': CartItemSummarySerializer}
+
+
+# Serializer profiles of view_cart, picked with ?fields=
+CART_PROFILES = {
+    'full': CartSerializer,
+    'summary': CartSummarySerializer,
+}
+
+
+class CartItemFragmentSerializer(serializers.ModelSerializer):
+    # Pre-rendered variant from context['variants'] ({id: data}, see products.fragments)
+    variant = serializers.SerializerMethodField()
+
+    class Meta:
+        model = CartItem
+        fields = ['id', 'variant', 'quantity', 'price', 'cart_total', 'discount_total']
+
+    def get_variant(self, obj):
+        return self.context['variants'].get(obj.variant_id)
+
+
+class CartHeaderSerializer(serializers.ModelSerializer):
+    # CartSerializer without the items, which view_cart streams after it
+    class Meta:
+        model = Cart
+        fields = ['id', 'user', 'created_at', 'updated_at', 'item_count', 'subtotal', 'discount_total']
+
+
+class CartTotalsSerializer(serializers.Serializer):
+    # cart_summary's totals, money as decimal strings like CartSerializer's
+    item_count = serializers.IntegerField()
+    subtotal = serializers.DecimalField(max_digits=20, decimal_places=2)
+    discount_total = serializers.DecimalField(max_digits=20, decimal_places=2)
+    total = serializers.DecimalField(max_digits=20, decimal_places=2)
+
+class CartOperationSerializer(serializers.Serializer):
+    op = serializers.ChoiceField(choices=['add', 'set', 'remove'])
+    # Primary keys are bigints
+    variant_id = serializers.IntegerField(min_value=1, max_value=2 ** 63 - 1)
+    quantity = serializers.IntegerField(required=False)
+
+    def validate(self, data):
+        if data['op'] == 'remove':
+            # Ignores the quantity; applied as a set to 0
+            return {'op': 'set', 'variant_id': data['variant_id'], 'quantity': 0}
+        quantity = data.get('quantity', 1 if data['op'] == 'add' else None)
+        if quantity is None:
+            raise serializers.ValidationError({'quantity': 'This field is required.'})
+        if not 1 <= quantity <= MAX_QUANTITY:
+            raise serializers.ValidationError({'quantity': f'Must be between 1 and {MAX_QUANTITY}.'})
+        return {**data, 'quantity': quantity}
+
+
+class CartBatchSerializer(serializers.Serializer):
+    operations = CartOperationSerializer(many=True, allow_empty=False)
+
 
 class WishlistSerializer(serializers.ModelSerializer):
     products = ProductVariantSerializer(many=True,read_only=True)
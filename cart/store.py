@@ -0,0 +1,321 @@
+from decimal import Decimal
+from django.conf import settings
+from django.db import transaction
+from django_redis import get_redis_connection
+from products.models import ProductVariant
+from .models import Cart, CartItem, line_discount
+
+# Redis cart storage (settings.CART_STORAGE = 'redis'). The live cart of a user is a hash
+# of variant id -> quantity, mutated with single atomic commands, and the user id is added
+# to a dirty set. Cart/CartItem rows are written behind: by flush_dirty_carts (the
+# flush_carts command), and synchronously when the cart is viewed or checked out.
+# Redis comes from the django_redis 'default' connection, so pointing its connection pool
+# at fakeredis (CONNECTION_POOL_KWARGS connection_class/server) is enough for tests.
+# Largest quantity of a cart line; a request asking for more is rejected, an add that would
+# go past it stops there
+MAX_QUANTITY = 1000
+CART_KEY = 'cart_items_{}'
+DIRTY_KEY = 'cart_dirty_users'
+# Marks a hash as loaded from the database, so an empty cart still exists in Redis
+LOADED_FIELD = 'loaded'
+# Bumped by every change to the hash; seeded with the server time on load so a reloaded cart
+# never repeats the version of an earlier copy. Checkout uses it to tell whether the cart
+# changed between its flush and the order commit.
+VERSION_FIELD = 'version'
+
+# KEYS: cart, dirty set. ARGV: ttl, user id, max quantity, then op (add/set), variant id,
+# quantity triples. Returns nil when the cart is not loaded yet, otherwise the new quantity of
+# each line.
+_MUTATE = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local quantities = {}
+for i = 4, #ARGV, 3 do
+    local quantity
+    if ARGV[i] == 'add' then
+        quantity = redis.call('HINCRBY', KEYS[1], ARGV[i + 1], ARGV[i + 2])
+    else
+        quantity = tonumber(ARGV[i + 2])
+    end
+    quantity = math.min(quantity, tonumber(ARGV[3]))
+    redis.call('HSET', KEYS[1], ARGV[i + 1], quantity)
+    if quantity <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[i + 1])
+        quantity = 0
+    end
+    quantities[#quantities + 1] = quantity
+end
+redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('SADD', KEYS[2], ARGV[2])
+return quantities
+"""
+
+# KEYS: cart. ARGV: ttl, then field/value pairs. Loads the cart unless a concurrent request already did.
+_LOAD = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local now = redis.call('TIME')
+redis.call('HSET', KEYS[1], 'version', now[1] .. string.format('%06d', now[2]), unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# KEYS: cart, dirty set. ARGV: ttl, user id. Empties the cart, keeping its version going.
+_CLEAR = """
+local version = redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'loaded', 1, 'version', version)
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('SADD', KEYS[2], ARGV[2])
+"""
+
+# KEYS: cart, dirty set. ARGV: version flushed, user id, then variant id, quantity pairs that
+# were checked out. Drops the cart when it is still at that version; otherwise it changed after
+# the flush, so only the checked-out quantities are taken off and the rest is queued for a flush
+# (which also overwrites lines a concurrent flush wrote back meanwhile).
+_FORGET = """
+local version = redis.call('HGET', KEYS[1], 'version')
+if not version then
+    return 0
+end
+if version == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    redis.call('SREM', KEYS[2], ARGV[2])
+    return 1
+end
+for i = 3, #ARGV, 2 do
+    if redis.call('HINCRBY', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1])) <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('SADD', KEYS[2], ARGV[2])
+return 2
+"""
+
+
+def enabled():
+    return getattr(settings, 'CART_STORAGE', 'database') == 'redis'
+
+
+def _ttl():
+    return getattr(settings, 'CART_REDIS_TTL', 60 * 60 * 24 * 30)
+
+
+def _load(redis, user_id):
+    """
+    Copy the user's database cart into Redis, the first time the cart is touched.
+    """
+    args = [_ttl(), LOADED_FIELD, 1]
+    rows = CartItem.objects.filter(cart__user_id=user_id, variant__isnull=False).values_list('variant_id', 'quantity')
+    quantities = {}
+    for variant_id, quantity in rows:
+        quantities[variant_id] = quantities.get(variant_id, 0) + quantity
+    for variant_id, quantity in quantities.items():
+        args += [variant_id, quantity]
+    redis.register_script(_LOAD)(keys=[CART_KEY.format(user_id)], args=args)
+
+
+def _mutate(user_id, operations):
+    redis = get_redis_connection('default')
+    script = redis.register_script(_MUTATE)
+    keys = [CART_KEY.format(user_id), DIRTY_KEY]
+    args = [_ttl(), user_id, MAX_QUANTITY]
+    for op, variant_id, quantity in operations:
+        args += [op, variant_id, quantity]
+    result = script(keys=keys, args=args)
+    if result is None:
+        _load(redis, user_id)
+        result = script(keys=keys, args=args)
+    return [int(quantity) for quantity in result]
+
+
+def add_item(user_id, variant_id, quantity=1):
+    """
+    Add quantity of a variant to the cart, up to MAX_QUANTITY. Returns the new quantity of the line.
+    """
+    return _mutate(user_id, [('add', variant_id, quantity)])[0]
+
+
+def set_quantity(user_id, variant_id, quantity):
+    """
+    Set the quantity of a cart line, removing it when quantity is 0 or less.
+    """
+    return _mutate(user_id, [('set', variant_id, quantity)])[0]
+
+
+def remove_item(user_id, variant_id):
+    return _mutate(user_id, [('set', variant_id, 0)])[0]
+
+
+def apply_operations(user_id, operations):
+    """
+    Apply (op, variant_id, quantity) operations in order, op being 'add' or 'set' (a remove is
+    a set to 0), as one atomic change to the cart. Works in both storage modes.
+    Returns the resulting {variant_id: quantity} of the lines touched, 0 for removed lines.
+    """
+    if enabled():
+        quantities = _mutate(user_id, operations)
+        return {variant_id: quantity for (_, variant_id, _), quantity in zip(operations, quantities)}
+
+    with transaction.atomic():
+        cart, _ = Cart.objects.get_or_create(user_id=user_id)
+        # Serialize concurrent batches on the same cart
+        Cart.objects.select_for_update().filter(pk=cart.pk).values_list('pk').first()
+        items = list(cart.items.all())
+        current = {}
+        for item in items:
+            if item.variant_id:
+                current[item.variant_id] = current.get(item.variant_id, 0) + item.quantity
+        touched = {}
+        for op, variant_id, quantity in operations:
+            value = min(max(current.get(variant_id, 0) + quantity if op == 'add' else quantity, 0), MAX_QUANTITY)
+            current[variant_id] = touched[variant_id] = value
+        _sync_items(cart, items, {variant_id: quantity for variant_id, quantity in current.items() if quantity > 0})
+    return touched
+
+
+def clear(user_id):
+    redis = get_redis_connection('default')
+    redis.register_script(_CLEAR)(keys=[CART_KEY.format(user_id), DIRTY_KEY], args=[_ttl(), user_id])
+
+
+def forget(user_id, version, quantities):
+    """
+    Drop the Redis copy of a cart after checkout, version being what flush_for_checkout returned
+    and quantities the {variant_id: quantity} lines ordered. Lines changed since the flush are
+    kept. Returns False when the cart changed meanwhile.
+    """
+    redis = get_redis_connection('default')
+    args = [version or '', user_id]
+    for variant_id, quantity in quantities.items():
+        args += [variant_id, quantity]
+    return redis.register_script(_FORGET)(keys=[CART_KEY.format(user_id), DIRTY_KEY], args=args) != 2
+
+
+def get_items(user_id):
+    """
+    The live cart as {variant_id: quantity}.
+    """
+    redis = get_redis_connection('default')
+    raw = redis.hgetall(CART_KEY.format(user_id))
+    if not raw:
+        _load(redis, user_id)
+        raw = redis.hgetall(CART_KEY.format(user_id))
+    return _parse(raw)
+
+
+def _parse(raw):
+    return {
+        int(field): int(quantity)
+        for field, quantity in raw.items()
+        if field.decode() not in (LOADED_FIELD, VERSION_FIELD) and int(quantity) > 0
+    }
+
+
+def _sync_items(cart, items, quantities):
+    """
+    Make the CartItem rows of a cart match {variant_id: quantity}, with one bulk write per kind,
+    and refresh the cart totals.
+    """
+    variants = ProductVariant.objects.in_bulk(list(quantities))
+    existing = {}
+    stale = []
+    for item in items:
+        if item.variant_id in quantities and item.variant_id not in existing:
+            existing[item.variant_id] = item
+        else:
+            stale.append(item.pk)
+
+    to_create, to_update = [], []
+    for variant_id, quantity in quantities.items():
+        variant = variants.get(variant_id)
+        if variant is None:
+            continue
+        item = existing.get(variant_id) or CartItem(cart=cart, variant=variant)
+        item.quantity = quantity
+        item.price_line(variant)
+        (to_update if item.pk else to_create).append(item)
+
+    if stale:
+        CartItem.objects.filter(pk__in=stale).delete()
+    CartItem.objects.bulk_update(to_update, ['quantity', 'price', 'cart_total', 'discount_total'])
+    CartItem.objects.bulk_create(to_create)
+    Cart.refresh_totals([cart.pk])
+
+
+def _write_cart(user_id, quantities):
+    with transaction.atomic():
+        cart, _ = Cart.objects.get_or_create(user_id=user_id)
+        _sync_items(cart, list(cart.items.all()), quantities)
+
+
+def _flush(user_id):
+    redis = get_redis_connection('default')
+    pipe = redis.pipeline(transaction=True)
+    pipe.srem(DIRTY_KEY, user_id)
+    pipe.hgetall(CART_KEY.format(user_id))
+    was_dirty, raw = pipe.execute()
+    version = raw.get(VERSION_FIELD.encode())
+    if not raw or not was_dirty:
+        # Unchanged, never loaded or expired: the database already holds the cart
+        return False, version
+    try:
+        _write_cart(user_id, _parse(raw))
+    except Exception:
+        # Keep it queued so the next flush retries
+        redis.sadd(DIRTY_KEY, user_id)
+        raise
+    return True, version
+
+
+def flush_cart(user_id):
+    """
+    Write the Redis cart of a user to Cart/CartItem if it changed since the last flush.
+    Returns True when the database was written.
+    """
+    return _flush(user_id)[0]
+
+
+def flush_for_checkout(user_id):
+    """
+    flush_cart, returning the version of the cart the database now holds, for forget.
+    """
+    return _flush(user_id)[1]
+
+
+def flush_dirty_carts(batch_size=500):
+    """
+    Flush every cart changed since the last run. Returns the number of carts written.
+    """
+    redis = get_redis_connection('default')
+    flushed = 0
+    while True:
+        user_ids = redis.srandmember(DIRTY_KEY, batch_size)
+        if not user_ids:
+            return flushed
+        for user_id in user_ids:
+            flushed += flush_cart(int(user_id))
+
+
+def summary(user_id):
+    """
+    Item count and money totals of the live cart, without loading the items.
+    In Redis mode they are computed from the hash and one price lookup, so no flush is needed.
+    """
+    if not enabled():
+        totals = Cart.objects.filter(user_id=user_id).values('item_count', 'subtotal', 'discount_total').first()
+        return totals or {'item_count': 0, 'subtotal': Decimal(0), 'discount_total': Decimal(0)}
+
+    quantities = get_items(user_id)
+    totals = {'item_count': 0, 'subtotal': Decimal(0), 'discount_total': Decimal(0)}
+    prices = ProductVariant.objects.filter(pk__in=list(quantities)).values_list('id', 'price', 'discount_price')
+    for variant_id, price, discount_price in prices:
+        quantity = quantities[variant_id]
+        totals['item_count'] += quantity
+        totals['subtotal'] += quantity * price
+        totals['discount_total'] += line_discount(price, discount_price, quantity)
+    return totals
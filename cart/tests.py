@@ -1,3 +1,273 @@
-from django.test import TestCase
+import gzip
+import json
+from decimal import Decimal
+from unittest import mock
+import fakeredis
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import AccessToken
+from accounts.models import User
+from products.fragments import bump_fragment_epoch
+from products.models import Category, Product, ProductVariant, Varient_Type, Varient_values
+from .models import Cart, CartItem
+from . import store
 
-# Create your tests here.
+
+def auth_headers(user):
+    return {'Authorization': f'Bearer {AccessToken.for_user(user)}'}
+
+
+def make_variants(count):
+    category = Category.objects.create(name='Shoes')
+    color = Varient_values.objects.create(varient_type=Varient_Type.objects.create(name='Color'), value='Red')
+    product = Product.objects.create(name='Runner', description='Running shoe', price=Decimal('10.00'),
+                                     sku='RUN', total_stock=100, category=category)
+    return [
+        ProductVariant.objects.create(product=product, primary_varient=color, variant_name=f'Size {index}',
+                                      price=Decimal('10.00'), discount_price=Decimal('8.00'),
+                                      sku=f'RUN-{index}', total_stock=100)
+        for index in range(count)
+    ]
+
+
+class ViewCartTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer@example.com', 'secret')
+        cart = Cart.objects.create(user=cls.user)
+        cls.variants = make_variants(30)
+        for variant in cls.variants:
+            item = CartItem(cart=cart, variant=variant, quantity=2)
+            item.price_line(variant)
+            item.save()
+        Cart.refresh_totals([cart.id])
+
+    async def test_streams_compressed_under_asgi(self):
+        headers = {**auth_headers(self.user), 'Accept-Encoding': 'gzip'}
+        response = await self.async_client.get(reverse('view-cart'), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        body = gzip.decompress(b''.join([chunk async for chunk in response.streaming_content]))
+        data = json.loads(body)
+        self.assertEqual(len(data['items']), 30)
+        self.assertEqual(data['item_count'], 60)
+
+    def test_streams_under_wsgi(self):
+        response = self.client.get(reverse('view-cart'), headers=auth_headers(self.user))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.is_async)
+        self.assertEqual(len(json.loads(b''.join(response.streaming_content))['items']), 30)
+
+    def test_query_count_does_not_grow_with_items(self):
+        user = User.objects.create_user('other@example.com', 'secret')
+        cart = Cart.objects.create(user=user)
+        counts = []
+        for variants in (self.variants[:1], self.variants[1:10]):
+            for variant in variants:
+                item = CartItem(cart=cart, variant=variant, quantity=1)
+                item.price_line(variant)
+                item.save()
+            bump_fragment_epoch()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('view-cart'), headers=auth_headers(user))
+                items = json.loads(b''.join(response.streaming_content))['items']
+            counts.append(len(queries))
+        self.assertEqual(len(items), 10)
+        self.assertEqual(counts[0], counts[1])
+
+
+class CartSummaryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer@example.com', 'secret')
+        cart = Cart.objects.create(user=cls.user)
+        for variant, quantity in zip(make_variants(2), (3, 1)):
+            item = CartItem(cart=cart, variant=variant, quantity=quantity)
+            item.price_line(variant)
+            item.save()
+        Cart.refresh_totals([cart.id])
+
+    def test_totals_are_decimal_strings(self):
+        response = self.client.get(reverse('cart_summary'), headers=auth_headers(self.user))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            'item_count': 4, 'subtotal': '40.00', 'discount_total': '8.00', 'total': '32.00',
+        })
+
+    def test_empty_cart(self):
+        user = User.objects.create_user('new@example.com', 'secret')
+        response = self.client.get(reverse('cart_summary'), headers=auth_headers(user))
+        self.assertEqual(response.json(), {
+            'item_count': 0, 'subtotal': '0.00', 'discount_total': '0.00', 'total': '0.00',
+        })
+
+
+class CartBatchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer@example.com', 'secret')
+        cls.variants = make_variants(12)
+
+    def batch(self, operations):
+        return self.client.post(reverse('cart_batch'), {'operations': operations}, headers=auth_headers(self.user),
+                                content_type='application/json')
+
+    def lines(self):
+        return dict(CartItem.objects.filter(cart__user=self.user).values_list('variant_id', 'quantity'))
+
+    def test_applies_mixed_operations_in_order(self):
+        first, second, third = self.variants[:3]
+        self.batch([{'op': 'add', 'variant_id': first.id, 'quantity': 2}, {'op': 'add', 'variant_id': third.id}])
+        response = self.batch([
+            {'op': 'add', 'variant_id': first.id, 'quantity': 3},
+            {'op': 'set', 'variant_id': second.id, 'quantity': 4},
+            {'op': 'remove', 'variant_id': third.id},
+            {'op': 'add', 'variant_id': second.id, 'quantity': store.MAX_QUANTITY},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['items'], [
+            {'variant_id': first.id, 'quantity': 5},
+            {'variant_id': second.id, 'quantity': store.MAX_QUANTITY},
+            {'variant_id': third.id, 'quantity': 0},
+        ])
+        self.assertEqual(self.lines(), {first.id: 5, second.id: store.MAX_QUANTITY})
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual(cart.item_count, 5 + store.MAX_QUANTITY)
+        self.assertEqual(cart.subtotal, Decimal('10.00') * (5 + store.MAX_QUANTITY))
+
+    def test_applies_nothing_when_one_operation_fails(self):
+        first = self.variants[0]
+        self.batch([{'op': 'add', 'variant_id': first.id, 'quantity': 2}])
+        for operations, status in [
+            ([{'op': 'add', 'variant_id': first.id}, {'op': 'set', 'variant_id': 10 ** 6, 'quantity': 1}], 404),
+            ([{'op': 'add', 'variant_id': first.id}, {'op': 'set', 'variant_id': first.id, 'quantity': 2 ** 40}], 400),
+            ([{'op': 'add', 'variant_id': first.id}, {'op': 'set', 'variant_id': first.id}], 400),
+            ([{'op': 'add', 'variant_id': first.id}, {'op': 'add', 'variant_id': first.id, 'quantity': 0}], 400),
+            ([{'op': 'add', 'variant_id': first.id}, {'op': 'drop', 'variant_id': first.id}], 400),
+            ([{'op': 'add', 'variant_id': 10 ** 20}], 400),
+            ([], 400),
+        ]:
+            with self.subTest(operations=operations):
+                self.assertEqual(self.batch(operations).status_code, status)
+                self.assertEqual(self.lines(), {first.id: 2})
+
+    def test_query_count_does_not_depend_on_batch_size(self):
+        counts = []
+        for variants in (self.variants[:1], self.variants[1:]):
+            self.batch([{'op': 'add', 'variant_id': variant.id} for variant in variants])
+            operations = [{'op': 'set', 'variant_id': variant.id, 'quantity': 2} for variant in variants]
+            operations += [{'op': 'add', 'variant_id': variant.id} for variant in variants]
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.batch(operations).status_code, 200)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(set(self.lines().values()), {3})
+
+
+@override_settings(CART_STORAGE='redis')
+class RedisCartTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer@example.com', 'secret')
+        cls.first, cls.second, cls.third = make_variants(3)
+
+    def setUp(self):
+        # A Redis of its own per test
+        self.redis = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        patcher = mock.patch.object(store, 'get_redis_connection', lambda alias: self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def db_items(self):
+        return dict(CartItem.objects.filter(cart__user=self.user).values_list('variant_id', 'quantity'))
+
+    def is_dirty(self):
+        return self.redis.sismember(store.DIRTY_KEY, self.user.id)
+
+    def test_loads_the_database_cart_on_first_change(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, variant=self.first, quantity=2, price=Decimal('10.00'))
+        self.assertEqual(store.add_item(self.user.id, self.first.id, 3), 5)
+        self.assertEqual(store.apply_operations(self.user.id, [('set', self.second.id, 4), ('add', self.third.id, 1),
+                                                               ('set', self.third.id, 0)]),
+                         {self.second.id: 4, self.third.id: 0})
+        self.assertEqual(store.get_items(self.user.id), {self.first.id: 5, self.second.id: 4})
+        self.assertTrue(self.is_dirty())
+        # Written behind only
+        self.assertEqual(self.db_items(), {self.first.id: 2})
+
+    def test_flushes_dirty_carts_once(self):
+        store.add_item(self.user.id, self.first.id, 2)
+        self.assertEqual(store.flush_dirty_carts(), 1)
+        self.assertEqual(self.db_items(), {self.first.id: 2})
+        self.assertEqual(Cart.objects.get(user=self.user).item_count, 2)
+        self.assertFalse(self.is_dirty())
+        self.assertEqual(store.flush_dirty_carts(), 0)
+
+        store.remove_item(self.user.id, self.first.id)
+        store.clear(self.user.id)
+        self.assertEqual(store.flush_dirty_carts(), 1)
+        self.assertEqual(self.db_items(), {})
+
+    def test_failed_flush_stays_queued(self):
+        store.add_item(self.user.id, self.first.id, 2)
+        with mock.patch.object(store, '_write_cart', side_effect=RuntimeError), self.assertRaises(RuntimeError):
+            store.flush_cart(self.user.id)
+        self.assertTrue(self.is_dirty())
+
+    def test_forget_drops_an_unchanged_cart(self):
+        store.add_item(self.user.id, self.first.id, 2)
+        version = store.flush_for_checkout(self.user.id)
+        self.assertTrue(store.forget(self.user.id, version, {self.first.id: 2}))
+        self.assertFalse(self.redis.exists(store.CART_KEY.format(self.user.id)))
+
+    def test_forget_keeps_lines_changed_after_the_flush(self):
+        store.add_item(self.user.id, self.first.id, 2)
+        store.add_item(self.user.id, self.second.id, 1)
+        version = store.flush_for_checkout(self.user.id)
+        store.add_item(self.user.id, self.third.id, 1)
+        store.add_item(self.user.id, self.second.id, 1)
+        self.assertFalse(store.forget(self.user.id, version, {self.first.id: 2, self.second.id: 1}))
+        self.assertEqual(store.get_items(self.user.id), {self.second.id: 1, self.third.id: 1})
+        self.assertTrue(self.is_dirty())
+
+    def test_checkout_keeps_lines_added_while_it_ran(self):
+        from orders.views import reserve_stock
+        address = self.user.shipping_addresses.create(address='1 Main Road', city='Pune', state='MH', postal_code='411001')
+        store.add_item(self.user.id, self.first.id, 2)
+
+        def reserve_then_add(order, lines):
+            reservations = reserve_stock(order, lines)
+            # Another request adds a line and a write-behind run flushes it meanwhile
+            store.add_item(self.user.id, self.second.id, 1)
+            store.flush_dirty_carts()
+            return reservations
+
+        with mock.patch('orders.views.reserve_stock', reserve_then_add), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('checkout'), {'shipping_address_id': address.id},
+                                        headers=auth_headers(self.user), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(store.get_items(self.user.id), {self.second.id: 1})
+        store.flush_dirty_carts()
+        self.assertEqual(self.db_items(), {self.second.id: 1})
+
+    def test_update_and_delete_unflushed_lines_by_variant(self):
+        headers = auth_headers(self.user)
+        self.client.post(reverse('add-to-cart'), {'variant_id': self.first.id, 'quantity': 2}, headers=headers,
+                         content_type='application/json')
+        response = self.client.put(reverse('update_cart_quantity'), {'variant_id': self.first.id, 'quantity': 5},
+                                   headers=headers, content_type='application/json')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(store.get_items(self.user.id), {self.first.id: 5})
+        response = self.client.put(reverse('update_cart_quantity'), {'variant_id': self.second.id, 'quantity': 5},
+                                   headers=headers, content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+        url = reverse('delete-variant-from-cart', args=[self.first.id])
+        self.assertEqual(self.client.delete(url, headers=headers).status_code, 204)
+        self.assertEqual(store.get_items(self.user.id), {})
+        self.assertEqual(self.client.delete(url, headers=headers).status_code, 404)
+        self.assertEqual(self.db_items(), {})
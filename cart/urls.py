@@ -5,8 +5,11 @@ urlpatterns = [
     path('', view_cart, name='view-cart'),
     path('add/', add_to_cart, name='add-to-cart'),
     path('delete/<int:item_id>/', delete_from_cart, name='delete-from-cart'),
+    path('delete/variant/<int:variant_id>/', delete_from_cart, name='delete-variant-from-cart'),
     path('clear/', clear_cart, name='clear-cart'),
     path('update-quantity/', update_cart_quantity, name='update_cart_quantity'),
+    path('batch', cart_batch, name='cart_batch'),
+    path('summary', cart_summary, name='cart_summary'),
     path('wishlist/', wishlists, name='wishlists'),
     path('wishlist/add', add_to_wishlist, name='add_to_wishlist'),
     path('wishlist/delete', delete_from_wishlist, name='delete_from_wishlist'),
@@ -3,10 +3,31 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from django.core.cache import cache
+from django.db import transaction
 from .models import Cart, CartItem,Wishlist
 from products.models import ProductVariant
-from .serializers import CartSerializer, CartItemSerializer,WishlistSerializer
+from .serializers import CartSerializer, CartItemSerializer, CartHeaderSerializer, CartItemFragmentSerializer, CartTotalsSerializer, CartBatchSerializer, WishlistSerializer, CART_PROFILES
+from core.serializers import serializer_profile
+from core.cache import cache_aside
+from core.renderers import StreamedList, StreamingJSONResponse
+from products.fragments import variant_fragments
+from . import store
 from decimal import Decimal
+from itertools import islice
+
+STREAM_CHUNK_SIZE = 200
+
+
+def _positive_quantity(value):
+    """
+    value as an int, or None when it is not an integer from 1 to store.MAX_QUANTITY.
+    """
+    try:
+        quantity = int(value)
+    except (TypeError, ValueError):
+        return None
+    return quantity if 0 < quantity <= store.MAX_QUANTITY else None
+
 
 # View Cart
 @api_view(['GET'])
@@ -14,22 +35,42 @@ from decimal import Decimal
 def view_cart(request):
     """
     Retrieve the user's cart details including all cart items.
-    Caching is used to store cart data for faster repeated requests.
+    `?fields=summary` renders the items with the lean variant serializer.
+    Items are streamed in chunks of STREAM_CHUNK_SIZE, each with its variants taken from the
+    per-variant fragments of products.fragments, so a large cart never sits in memory whole.
     """
     user = request.user
-    cache_key = f"cart_{user.id}"
+    profile, _ = serializer_profile(request, CART_PROFILES)
 
-    cached_cart = cache.get(cache_key)
-    # if cached_cart:
-    #     return Response(cached_cart, status=status.HTTP_200_OK)
+    if store.enabled():
+        # Write pending Redis changes behind so the items carry their database ids
+        store.flush_cart(user.id)
 
     try:
         cart = Cart.objects.get(user=user)
     except Cart.DoesNotExist:
         return Response({"error": "Cart not found."}, status=status.HTTP_404_NOT_FOUND)
 
-    serializer = CartSerializer(cart)
-    cache.set(cache_key, serializer.data, timeout=60 * 15)  # Cache for 15 minutes
+    def items():
+        rows = cart.items.all().iterator(chunk_size=STREAM_CHUNK_SIZE)
+        while chunk := list(islice(rows, STREAM_CHUNK_SIZE)):
+            variant_ids = [item.variant_id for item in chunk if item.variant_id]
+            variants = {data['id']: data for data in variant_fragments(variant_ids, profile)}
+            yield from CartItemFragmentSerializer(chunk, many=True, context={'variants': variants}).data
+
+    data = {**CartHeaderSerializer(cart).data, 'items': StreamedList(items())}
+    return StreamingJSONResponse(data, status=status.HTTP_200_OK, request=request)
+
+# Cart summary
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def cart_summary(request):
+    """
+    Item count and totals of the user's cart, for header badges and mini-carts.
+    Reads the running totals kept on Cart instead of serializing the items.
+    """
+    totals = store.summary(request.user.id)
+    serializer = CartTotalsSerializer({**totals, 'total': totals['subtotal'] - totals['discount_total']})
     return Response(serializer.data, status=status.HTTP_200_OK)
 
 # Add to Cart
@@ -41,46 +82,89 @@ def add_to_cart(request):
     """
     user = request.user
     variant_id = request.data.get('variant_id')
-    quantity = int(request.data.get('quantity', 1))
+    quantity = _positive_quantity(request.data.get('quantity', 1))
 
     if not variant_id:
         return Response({"error": "Variant ID is required."}, status=status.HTTP_400_BAD_REQUEST)
+    if quantity is None:
+        return Response({"error": f"Quantity must be an integer from 1 to {store.MAX_QUANTITY}."}, status=status.HTTP_400_BAD_REQUEST)
+
+    if store.enabled():
+        if not ProductVariant.objects.filter(id=variant_id).exists():
+            return Response({"error": "Product variant not found."}, status=status.HTTP_404_NOT_FOUND)
+        store.add_item(user.id, int(variant_id), quantity)
+        cache.delete(f"cart_{user.id}")
+        return Response({"success": "Item added to cart."}, status=status.HTTP_200_OK)
 
     try:
         variant = ProductVariant.objects.get(id=variant_id)
     except ProductVariant.DoesNotExist:
         return Response({"error": "Product variant not found."}, status=status.HTTP_404_NOT_FOUND)
 
-    # Get or create cart for the user
-    cart, _ = Cart.objects.get_or_create(user=user)
+    with transaction.atomic():
+        # Get or create cart for the user
+        cart, _ = Cart.objects.get_or_create(user=user)
 
-    # Check if the item is already in the cart
-    cart_item, created = CartItem.objects.get_or_create(cart=cart, variant=variant)
+        # Check if the item is already in the cart
+        cart_item, created = CartItem.objects.select_for_update().get_or_create(
+            cart=cart, variant=variant, defaults={'quantity': 0, 'cart_total': 0}
+        )
+        old_quantity, old_total, old_discount = cart_item.quantity, cart_item.cart_total or 0, cart_item.discount_total
 
-    # Update the quantity and price
-    if not created:
+        # Update the quantity and price
         cart_item.quantity += quantity
-    cart_item.price = variant.price
-    cart_item.cart_total = cart_item.quantity * Decimal(variant.price)
-    cart_item.save()
+        cart_item.price_line(variant)
+        cart_item.save()
+        Cart.adjust_totals(cart.pk, cart_item.quantity - old_quantity, cart_item.cart_total - old_total,
+                           cart_item.discount_total - old_discount)
 
     # Invalidate the cache
     cache.delete(f"cart_{user.id}")
 
     return Response({"success": "Item added to cart."}, status=status.HTTP_200_OK)
 
+def _redis_line(user, item_id, variant_id):
+    """
+    The variant of a line of the Redis cart, addressed by variant id, or by CartItem id for
+    lines that were already flushed. None when the cart has no such line.
+    """
+    if variant_id is None:
+        variant_id = CartItem.objects.filter(id=item_id, cart__user=user).values_list('variant_id', flat=True).first()
+    return variant_id if variant_id in store.get_items(user.id) else None
+
+
+def _line_id(value):
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
 # Delete from Cart
 @api_view(['DELETE'])
 @permission_classes([IsAuthenticated])
-def delete_from_cart(request, item_id):
+def delete_from_cart(request, item_id=None, variant_id=None):
     """
-    Remove an item from the cart by item ID.
+    Remove an item from the cart by item ID, or by variant ID (delete/variant/<id>/), which
+    also reaches lines of a Redis cart that were not written to the database yet.
     """
     user = request.user
 
+    if store.enabled():
+        variant_id = _redis_line(user, item_id, variant_id)
+        if variant_id is None:
+            return Response({"error": "Cart item not found."}, status=status.HTTP_404_NOT_FOUND)
+        store.remove_item(user.id, variant_id)
+        cache.delete(f"cart_{user.id}")
+        return Response({"success": "Item removed from cart."}, status=status.HTTP_204_NO_CONTENT)
+
+    line = {'id': item_id} if variant_id is None else {'variant_id': variant_id}
     try:
-        cart_item = CartItem.objects.get(id=item_id, cart__user=user)
-        cart_item.delete()
+        with transaction.atomic():
+            cart_item = CartItem.objects.select_for_update().get(cart__user=user, **line)
+            cart_item.delete()
+            Cart.adjust_totals(cart_item.cart_id, -cart_item.quantity, -(cart_item.cart_total or 0),
+                               -cart_item.discount_total)
 
         # Invalidate the cache
         cache.delete(f"cart_{user.id}")
@@ -94,18 +178,34 @@ def delete_from_cart(request, item_id):
 @permission_classes([IsAuthenticated])
 def update_cart_quantity(request):
     """
-    Remove an item from the cart by item ID.
+    Set the quantity of a cart line, given by item_id or by variant_id. variant_id also
+    reaches lines of a Redis cart that were not written to the database yet.
     """
     user = request.user
-    item_id = request.data.get('item_id')
-    quantity = request.data.get('quantity')
+    item_id = _line_id(request.data.get('item_id'))
+    variant_id = _line_id(request.data.get('variant_id'))
+    quantity = _positive_quantity(request.data.get('quantity'))
+    if quantity is None:
+        return Response({"error": f"Quantity must be an integer from 1 to {store.MAX_QUANTITY}."}, status=status.HTTP_400_BAD_REQUEST)
+
+    if store.enabled():
+        variant_id = _redis_line(user, item_id, variant_id)
+        if variant_id is None:
+            return Response({"error": "Cart item not found."}, status=status.HTTP_404_NOT_FOUND)
+        store.set_quantity(user.id, variant_id, quantity)
+        cache.delete(f"cart_{user.id}")
+        return Response({"success": "Item removed from cart."}, status=status.HTTP_204_NO_CONTENT)
 
+    line = {'id': item_id} if variant_id is None else {'variant_id': variant_id}
     try:
-        cart_item = CartItem.objects.get(id=item_id, cart__user=user)
-        cart_item.quantity=quantity
-        cart_item.price = cart_item.variant.price
-        cart_item.cart_total = cart_item.quantity * Decimal(cart_item.price)
-        cart_item.save()
+        with transaction.atomic():
+            cart_item = CartItem.objects.select_for_update().select_related('variant').get(cart__user=user, **line)
+            old_quantity, old_total, old_discount = cart_item.quantity, cart_item.cart_total or 0, cart_item.discount_total
+            cart_item.quantity = quantity
+            cart_item.price_line(cart_item.variant)
+            cart_item.save()
+            Cart.adjust_totals(cart_item.cart_id, cart_item.quantity - old_quantity, cart_item.cart_total - old_total,
+                               cart_item.discount_total - old_discount)
 
         # Invalidate the cache
         return Response({"success": "Item removed from cart."}, status=status.HTTP_204_NO_CONTENT)
@@ -113,6 +213,41 @@ def update_cart_quantity(request):
     except CartItem.DoesNotExist:
         return Response({"error": "Cart item not found."}, status=status.HTTP_404_NOT_FOUND)
 
+# Batch cart operations
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def cart_batch(request):
+    """
+    Apply a list of cart operations in one request and one transaction, e.g. to merge a guest cart.
+
+    Body:
+    - operations: list of {"op": "add" | "set" | "remove", "variant_id": int, "quantity": int}.
+      `add` defaults to quantity 1, `set` requires one; both must be from 1 to store.MAX_QUANTITY,
+      and an add stops at it. `remove` drops the line and ignores the quantity. Operations
+      apply in order.
+
+    Either every operation is applied or none is.
+    """
+    user = request.user
+    serializer = CartBatchSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response({"error": "Invalid operations.", "details": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+    parsed = [(operation['op'], operation['variant_id'], operation['quantity'])
+              for operation in serializer.validated_data['operations']]
+
+    # Resolve every variant with a single query
+    variant_ids = {variant_id for _, variant_id, _ in parsed}
+    found = ProductVariant.objects.in_bulk(list(variant_ids))
+    missing = sorted(variant_ids - set(found))
+    if missing:
+        return Response({"error": "Product variant not found.", "variant_ids": missing}, status=status.HTTP_404_NOT_FOUND)
+
+    quantities = store.apply_operations(user.id, parsed)
+    cache.delete(f"cart_{user.id}")
+
+    items = [{"variant_id": variant_id, "quantity": quantity} for variant_id, quantity in quantities.items()]
+    return Response({"success": "Cart updated.", "items": items}, status=status.HTTP_200_OK)
+
 # Clear Cart
 @api_view(['DELETE'])
 @permission_classes([IsAuthenticated])
@@ -122,9 +257,16 @@ def clear_cart(request):
     """
     user = request.user
 
+    if store.enabled():
+        store.clear(user.id)
+        cache.delete(f"cart_{user.id}")
+        return Response({"success": "Cart cleared."}, status=status.HTTP_204_NO_CONTENT)
+
     try:
         cart = Cart.objects.get(user=user)
-        cart.items.all().delete()
+        with transaction.atomic():
+            cart.items.all().delete()
+            Cart.objects.filter(pk=cart.pk).update(item_count=0, subtotal=0, discount_total=0)
 
         # Invalidate the cache
         cache.delete(f"cart_{user.id}")
@@ -139,27 +281,30 @@ def clear_cart(request):
 def wishlists(request):
     user = request.user
     cache_key = f'wishlist_{user.id}'
-    cached_wishlist = cache.get(cache_key)
-    if cached_wishlist:
-        return Response(cached_wishlist, status=status.HTTP_200_OK)
-    try:
-        user_wishlist = Wishlist.objects.prefetch_related('products').get(user=user)
-    except Wishlist.DoesNotExist:
-        return Response({'status': 0, 'error': 'Wishlist not found'}, status=status.HTTP_404_NOT_FOUND)
-    
-    # serializer = WishlistSerializer(user_wishlist)
-    response_data = {
-        'user':user_wishlist.user.email,
-        'items':[],
-        'status':1
-    }
-    for i in user_wishlist.products.all():
-        product_data = {
-            'product_varient_id':i.id,
-            'product':i.product.name,
+
+    def build_wishlist():
+        try:
+            user_wishlist = Wishlist.objects.select_related('user').prefetch_related('products__product').get(user=user)
+        except Wishlist.DoesNotExist:
+            return None
+
+        # serializer = WishlistSerializer(user_wishlist)
+        response_data = {
+            'user':user_wishlist.user.email,
+            'items':[],
+            'status':1
         }
-        response_data['items'].append(product_data)
-    cache.set(cache_key, response_data, timeout=60 * 15)
+        for i in user_wishlist.products.all():
+            product_data = {
+                'product_varient_id':i.id,
+                'product':i.product.name,
+            }
+            response_data['items'].append(product_data)
+        return response_data
+
+    response_data = cache_aside(cache_key, build_wishlist, timeout=60 * 15)
+    if response_data is None:
+        return Response({'status': 0, 'error': 'Wishlist not found'}, status=status.HTTP_404_NOT_FOUND)
     
     return Response(response_data, status=status.HTTP_200_OK)
 
@@ -180,6 +325,7 @@ def add_to_wishlist(request):
         return Response({'status': 0, 'error': "Product already in wishlist"})
 
     wishlist_obj.products.add(product_variant)
+    cache.delete(f'wishlist_{user.id}')
 
     return Response({'status': 1, 'message': 'Product added to wishlist'})
 
@@ -204,4 +350,5 @@ def delete_from_wishlist(request):
         return Response({'status': 0, 'error': 'Wishlist not found'}, status=404)
 
     wishlist_obj.products.remove(product_variant)
+    cache.delete(f'wishlist_{user.id}')
     return Response({'status': 1, 'message': 'Product deleted from wishlist'})
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import weakref
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DataError, IntegrityError
+from django.db.models import Case, F, PositiveIntegerField, Q, TextField, Value, When
+from .models import ChatRoom, Message
+
+logger = logging.getLogger(__name__)
+
+# Write-behind buffer for chat messages. ChatConsumer broadcasts a message as soon as it
+# arrives and only queues it here; a background task saves the queue with one bulk_create
+# every CHAT_FLUSH_INTERVAL_MS milliseconds, or as soon as CHAT_FLUSH_BATCH_SIZE messages
+# are waiting, so a busy room costs one INSERT per batch rather than one per message.
+# Messages still queued when the process dies are lost: at most one interval's worth. A batch
+# that cannot be saved (the database is down) is queued again and retried with the next one;
+# only messages the database rejects are dropped.
+# Saving a batch also updates the last message and unread counters of its rooms; mark_read
+# resets a participant's counter.
+
+
+class MessageBuffer:
+    """
+    Messages waiting to be saved, with the task that saves them. Belongs to one event loop.
+    """
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = []
+        self.saving = []
+        self._full = asyncio.Event()
+        self._task = None
+
+    def add(self, message):
+        """
+        Queue an unsaved Message, timestamped when it was created. Never waits on the database.
+        """
+        self.pending.append(message)
+        if len(self.pending) >= self.batch_size:
+            self._full.set()
+        self._start()
+
+    def _start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def buffered(self, room_id):
+        """
+        The room's messages that may not be in the database yet, in the order they were queued.
+        Those being saved have a pk once their INSERT is done.
+        """
+        return [message for message in self.saving + self.pending if message.room_id == room_id]
+
+    async def _run(self):
+        # Exits once the queue is empty; the next add() starts it again
+        while self.pending:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    async def flush(self):
+        """
+        Save every queued message now.
+        """
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        self.saving = self.saving + batch
+        try:
+            saved, failed = await _save(batch)
+        except Exception:
+            logger.exception("Saving %d chat messages failed, queueing them again", len(batch))
+            saved, failed = [], batch
+        finally:
+            done = {id(message) for message in batch}
+            self.saving = [message for message in self.saving if id(message) not in done]
+        if failed:
+            # Ahead of the newer messages, so they are still saved in the order they were sent
+            self.pending = failed + self.pending
+            self._start()
+        if saved:
+            try:
+                await update_rooms(saved)
+            except Exception:
+                logger.exception("Updating the rooms of %d chat messages failed", len(saved))
+
+
+async def _save(batch):
+    """
+    Save a batch, returning (saved, failed): failed messages are to be retried.
+    """
+    try:
+        await Message.objects.abulk_create(batch)
+        return batch, []
+    except (IntegrityError, DataError):
+        # Most likely one bad row (its room was deleted meanwhile); keep the others
+        logger.exception("Saving %d chat messages failed, saving them one by one", len(batch))
+        return await sync_to_async(_save_each)(batch)
+
+
+def _save_each(batch):
+    saved, failed = [], []
+    for message in batch:
+        try:
+            message.save()
+            saved.append(message)
+        except (IntegrityError, DataError):
+            logger.exception("Dropping chat message for room %s", message.room_id)
+        except Exception:
+            logger.exception("Saving chat message for room %s failed, queueing it again", message.room_id)
+            failed.append(message)
+    return saved, failed
+
+
+async def update_rooms(messages):
+    """
+    Record saved messages on their rooms: the last one, and one more unread message for the
+    participant who didn't send it. One UPDATE per room.
+    """
+    rooms = {}
+    for message in messages:
+        room = rooms.setdefault(message.room_id, {'last': message, 'customer': 0, 'agent': 0})
+        room['last'] = message
+        room['agent' if message.sender_id == message.room.customer_id else 'customer'] += 1
+
+    for room_id, room in rooms.items():
+        last = room['last']
+        # Batches can be saved concurrently; never let an older one overwrite the last message
+        newer = Q(last_message_at__isnull=True) | Q(last_message_at__lte=last.timestamp)
+        await ChatRoom.objects.filter(pk=room_id).aupdate(
+            last_message_text=Case(When(newer, then=Value(last.text, output_field=TextField())), default=F('last_message_text')),
+            last_message_at=Case(When(newer, then=Value(last.timestamp)), default=F('last_message_at')),
+            customer_unread=F('customer_unread') + room['customer'],
+            agent_unread=F('agent_unread') + room['agent'],
+        )
+
+
+_buffers = weakref.WeakKeyDictionary()
+
+
+def message_buffer():
+    """
+    The buffer of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    buffer = _buffers.get(loop)
+    if buffer is None:
+        buffer = _buffers[loop] = MessageBuffer(
+            getattr(settings, 'CHAT_FLUSH_INTERVAL_MS', 200) / 1000,
+            getattr(settings, 'CHAT_FLUSH_BATCH_SIZE', 100),
+        )
+    return buffer
+
+
+def _read(room_id, user_id):
+    return ChatRoom.objects.filter(room_id=room_id).filter(Q(customer_id=user_id)|Q(support_agent_id=user_id)), {
+        'customer_unread': Case(When(customer_id=user_id, then=Value(0)), default=F('customer_unread'), output_field=PositiveIntegerField()),
+        'agent_unread': Case(When(support_agent_id=user_id, then=Value(0)), default=F('agent_unread'), output_field=PositiveIntegerField()),
+    }
+
+
+def mark_read(room_id, user_id):
+    """
+    Reset the user's unread counter in the room (room_id being ChatRoom.room_id).
+    """
+    rooms, counters = _read(room_id, user_id)
+    rooms.update(**counters)
+
+
+async def amark_read(room_id, user_id):
+    """
+    mark_read for the consumer. Saves the queued messages first, so none of them is counted
+    as unread after the user has seen it.
+    """
+    await message_buffer().flush()
+    rooms, counters = _read(room_id, user_id)
+    await rooms.aupdate(**counters)
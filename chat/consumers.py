@@ -55,16 +55,46 @@
 
 
 import json
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+from . import presence
+from .buffer import amark_read, message_buffer
+from .history import push_recent, recent_messages
 from .models import ChatRoom, Message
-from accounts.models import User
+from .throttle import Coalescer
+
+# Frames a client sends, all carrying its user id as 'sender':
+#   {'message': ...}                       a chat message
+#   {'type': 'typing', 'typing': bool}     typing indicator, as often as the client likes
+#   {'type': 'read'}                       the user has read the room up to now
+#   {'type': 'heartbeat'}                  keeps the user present, at least every CHAT_PRESENCE_TTL / 2
+# and what it receives besides chat messages ({'message', 'sender'}):
+#   {'history': [...]} and {'presence': [user ids]} when it connects, then
+#   {'type': 'presence', 'user', 'online'}, {'type': 'typing', 'user', 'typing'} and
+#   {'type': 'read', 'user', 'read_at'} events of the other connections.
+# Typing and read events are coalesced per connection (chat.throttle) before they reach the
+# channel layer, so a fast typist costs one group_send per CHAT_TYPING_INTERVAL at most.
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_id = self.scope['url_route']['kwargs']['room_id']
         self.room_group_name = f'chat_{self.room_id}'
 
+        # Resolved once per connection: a room's only senders are its customer and agent
+        try:
+            self.room = await ChatRoom.objects.aget(room_id=self.room_id)
+        except ChatRoom.DoesNotExist:
+            await self.close()
+            return
+        self.participants = {self.room.customer_id, self.room.support_agent_id}
+        # The participant on this connection, known from the session or from its first frame
+        self.user_id = None
+        self.heartbeat_at = 0
+        self.typing = Coalescer(getattr(settings, 'CHAT_TYPING_INTERVAL', 2), self.send_typing)
+        self.reads = Coalescer(getattr(settings, 'CHAT_READ_INTERVAL', 1), self.send_read)
+
         # Join the room group
         await self.channel_layer.group_add(
             self.room_group_name,
@@ -72,26 +102,70 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
         await self.accept()
 
+        # The room's last messages, so the client can render it without a request first
+        await self.send(text_data=json.dumps({'history': await recent_messages(self.room)}))
+        await self.send(text_data=json.dumps({'presence': await presence.online_users(self.room.id)}))
+
+        user = self.scope.get('user')
+        if user is not None and user.is_authenticated and user.id in self.participants:
+            await self.identify(user.id)
+
     async def disconnect(self, close_code):
+        if not hasattr(self, 'participants'):
+            return
+        self.typing.cancel()
+        if self.typing.last_sent is True:
+            await self.send_typing(False)
+        await self.reads.flush()
+        if self.user_id is not None and await presence.leave(self.room.id, self.user_id, self.channel_name):
+            await self.group_event('chat_presence', online=False)
         # Leave the room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        # Don't leave this connection's last messages waiting for the next flush
+        await message_buffer().flush()
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message = data['message']
-        sender_email = data['sender']
+    async def identify(self, user_id):
+        self.user_id = user_id
+        self.heartbeat_at = time.monotonic()
+        if await presence.join(self.room.id, user_id, self.channel_name):
+            await self.group_event('chat_presence', online=True)
 
-        # Use sync_to_async to handle the ORM operations asynchronously
-        sender = await sync_to_async(User.objects.get)(id=sender_email)
-        room = await sync_to_async(ChatRoom.objects.get)(room_id=self.room_id)
-
-        # Save the message to the database
-        await sync_to_async(Message.objects.create)(room=room, sender=sender, text=message)
+    async def group_event(self, event_type, **data):
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {'type': event_type, 'user': self.user_id, 'channel': self.channel_name, **data}
+        )
 
-        # Broadcast the message to the group
+    async def receive(self, text_data):
+        data = json.loads(text_data)
+        sender_email = data.get('sender')
+
+        try:
+            sender_id = int(sender_email)
+        except (TypeError, ValueError):
+            sender_id = None
+        if sender_id not in self.participants or self.user_id not in (None, sender_id):
+            await self.send(text_data=json.dumps({'error': 'Unknown sender'}))
+            return
+        if self.user_id is None:
+            await self.identify(sender_id)
+        elif time.monotonic() - self.heartbeat_at >= presence.presence_ttl() / 3:
+            self.heartbeat_at = time.monotonic()
+            await presence.heartbeat(self.room.id, self.user_id, self.channel_name)
+
+        frame_type = data.get('type', 'message')
+        if frame_type == 'typing':
+            await self.typing.submit(bool(data.get('typing')))
+        elif frame_type == 'read':
+            await self.reads.submit(timezone.now())
+        elif frame_type == 'message':
+            await self.receive_message(data['message'], sender_id, sender_email)
+
+    async def receive_message(self, message, sender_id, sender_email):
+        # Broadcast the message to the group right away
         await self.channel_layer.group_send(
             self.room_group_name,
             {
@@ -100,6 +174,19 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 'sender': sender_email
             }
         )
+        # Clients clear the sender's typing indicator when its message arrives
+        self.typing.assume(False)
+
+        # Saved behind, in batches, see chat.buffer
+        message_buffer().add(Message(room=self.room, sender_id=sender_id, text=message))
+        await push_recent(self.room, sender_id, message)
+
+    async def send_typing(self, typing):
+        await self.group_event('chat_typing', typing=typing)
+
+    async def send_read(self, read_at):
+        await amark_read(self.room_id, self.user_id)
+        await self.group_event('chat_read', read_at=read_at.isoformat())
 
     async def chat_message(self, event):
         message = event['message']
@@ -110,3 +197,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'message': message,
             'sender': sender
         }))
+
+    async def chat_presence(self, event):
+        await self.send(text_data=json.dumps({'type': 'presence', 'user': event['user'], 'online': event['online']}))
+
+    async def chat_typing(self, event):
+        if event['channel'] != self.channel_name:
+            await self.send(text_data=json.dumps({'type': 'typing', 'user': event['user'], 'typing': event['typing']}))
+
+    async def chat_read(self, event):
+        if event['channel'] != self.channel_name:
+            await self.send(text_data=json.dumps({'type': 'read', 'user': event['user'], 'read_at': event['read_at']}))
@@ -0,0 +1,90 @@
+import json
+from django.conf import settings
+from core.cache import async_redis
+from .buffer import message_buffer
+from .models import Message
+
+# The last CHAT_HISTORY_SIZE messages of each room, as a Redis list of JSON entries
+# ({'message', 'sender'}, oldest first), sent by ChatConsumer when a connection opens so
+# clients don't have to fetch the first page of history separately. A cold list (first
+# connection, a first message, or expired) is filled from the database plus the messages
+# still waiting in this process's chat.buffer; messages only append to lists that exist, so
+# the fill can't interleave with them. Every message pushes the list's expiry back to RECENT_TTL.
+RECENT_KEY = 'chat_recent_{}'
+RECENT_TTL = 60 * 60 * 24 * 7
+
+# KEYS: list. ARGV: size, ttl, entries. Only fills a list that doesn't exist.
+_FILL = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+if #ARGV > 2 then
+    redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+    redis.call('LTRIM', KEYS[1], -tonumber(ARGV[1]), -1)
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+
+def _size():
+    return getattr(settings, 'CHAT_HISTORY_SIZE', 50)
+
+
+def _entry(sender_id, text):
+    return json.dumps({'message': text, 'sender': sender_id})
+
+
+async def _fill(redis, key, room):
+    """
+    Fill the room's cold list. Returns its entries and whether they were stored, which they
+    are not when another connection filled the list first.
+    """
+    rows = Message.objects.filter(room=room).order_by('-timestamp', '-id').values_list('id', 'sender_id', 'text')
+    saved = [row async for row in rows[:_size()]]
+    saved.reverse()
+    # Read after the rows: a message saved meanwhile has its pk, and is skipped if it was read
+    saved_ids = {message_id for message_id, _, _ in saved}
+    buffered = [message for message in message_buffer().buffered(room.id) if message.pk not in saved_ids]
+    entries = [_entry(sender_id, text) for _, sender_id, text in saved]
+    entries += [_entry(message.sender_id, message.text) for message in buffered]
+    entries = entries[-_size():]
+    if not entries:
+        return entries, False
+    return entries, bool(await redis.register_script(_FILL)(keys=[key], args=[_size(), RECENT_TTL] + entries))
+
+
+async def _append(redis, key, entry):
+    pipe = redis.pipeline(transaction=True)
+    pipe.rpushx(key, entry)
+    pipe.ltrim(key, -_size(), -1)
+    pipe.expire(key, RECENT_TTL)
+    length, _, _ = await pipe.execute()
+    return length
+
+
+async def push_recent(room, sender_id, text):
+    """
+    Append a message, already queued in chat.buffer, to the room's recent history, filling
+    the list when it is cold.
+    """
+    key = RECENT_KEY.format(room.id)
+    entry = _entry(sender_id, text)
+    redis = async_redis()
+    if not await _append(redis, key, entry):
+        # The fill takes the message from the buffer, unless another connection filled first
+        entries, filled = await _fill(redis, key, room)
+        if entries and not filled:
+            await _append(redis, key, entry)
+
+
+async def recent_messages(room):
+    """
+    The room's last messages, oldest first, filling the list when it is cold.
+    """
+    key = RECENT_KEY.format(room.id)
+    redis = async_redis()
+    entries = await redis.lrange(key, 0, -1)
+    if not entries:
+        entries, _ = await _fill(redis, key, room)
+    return [json.loads(entry) for entry in entries]
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import time
+from uuid import uuid4
+from asgiref.sync import async_to_sync
+from channels.layers import DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer, channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django_redis import get_redis_connection
+from accounts.models import User
+from chat.buffer import message_buffer
+from chat.history import RECENT_KEY
+from chat.models import ChatRoom
+from chat.presence import PRESENCE_KEY
+from chat.routing import websocket_urlpatterns
+
+
+class Command(BaseCommand):
+    help = ("Measure what a chat room's broadcasts cost as its connections grow, on the in-memory channel "
+            "layer. The room and its messages are rolled back, its Redis keys deleted.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', default='2,10,50,100,250', help="Comma separated connection counts to measure")
+        parser.add_argument('--messages', type=int, default=50, help="Messages broadcast per measurement")
+        parser.add_argument('--keystrokes', type=int, default=200, help="Typing frames sent in one burst per measurement")
+
+    def handle(self, *args, **options):
+        counts = [int(count) for count in options['connections'].split(',') if count.strip()]
+        # Every connection queues each broadcast until it is read
+        layer = InMemoryChannelLayer(capacity=options['messages'] + options['keystrokes'] + 100)
+        self.group_sends = []
+        group_send = layer.group_send
+
+        async def counting_group_send(group, message):
+            self.group_sends.append(message['type'])
+            await group_send(group, message)
+        layer.group_send = counting_group_send
+
+        previous = channel_layers.set(DEFAULT_CHANNEL_LAYER, layer)
+        room = None
+        try:
+            with transaction.atomic():
+                tag = uuid4().hex[:12]
+                room = ChatRoom.objects.create(
+                    room_id=f'load-test-{tag}',
+                    customer=User.objects.create_user(f'load-test-customer-{tag}@example.com'),
+                    support_agent=User.objects.create_user(f'load-test-agent-{tag}@example.com'),
+                )
+                self.stdout.write("connections  ms/message  us/delivery  typing frames -> group_sends")
+                for count in counts:
+                    async_to_sync(self.measure)(room, count, options['messages'], options['keystrokes'])
+                transaction.set_rollback(True)
+        finally:
+            channel_layers.set(DEFAULT_CHANNEL_LAYER, previous)
+            if room is not None:
+                get_redis_connection('default').delete(RECENT_KEY.format(room.id), PRESENCE_KEY.format(room.id))
+
+    async def measure(self, room, count, messages, keystrokes):
+        application = URLRouter(websocket_urlpatterns)
+        connections = [WebsocketCommunicator(application, f'/ws/chat/{room.room_id}/') for _ in range(count)]
+        await asyncio.gather(*(connection.connect() for connection in connections))
+        # The history and presence frames of a new connection
+        await asyncio.gather(*(connection.receive_from() for connection in connections))
+        await asyncio.gather(*(connection.receive_from() for connection in connections))
+
+        sender = connections[0]
+        await sender.send_to(text_data=json.dumps({'type': 'heartbeat', 'sender': room.customer_id}))
+        await asyncio.gather(*(connection.receive_from() for connection in connections))  # online
+
+        started = time.perf_counter()
+        for index in range(messages):
+            await sender.send_to(text_data=json.dumps({'message': f'load test {index}', 'sender': room.customer_id}))
+            await asyncio.gather(*(connection.receive_from() for connection in connections))
+        elapsed = time.perf_counter() - started
+
+        self.group_sends.clear()
+        for _ in range(keystrokes):
+            await sender.send_to(text_data=json.dumps({'type': 'typing', 'typing': True, 'sender': room.customer_id}))
+        await sender.send_to(text_data=json.dumps({'type': 'heartbeat', 'sender': room.customer_id}))
+        await asyncio.sleep(0.1)
+        typing_sends = self.group_sends.count('chat_typing')
+
+        await asyncio.gather(*(connection.disconnect() for connection in connections))
+        await message_buffer().flush()
+        self.stdout.write(
+            f"{count:>11}  {elapsed / messages * 1000:>10.2f}  {elapsed / (messages * count) * 1e6:>11.1f}  "
+            f"{keystrokes} -> {typing_sends}"
+        )
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery, TextField, Value
+from django.db.models.functions import Coalesce
+from chat.models import ChatRoom, Message
+
+
+class Command(BaseCommand):
+    help = "Recompute the last message of every chat room from its messages (after adding the fields, or to repair them)"
+
+    def handle(self, *args, **options):
+        last = Message.objects.filter(room=OuterRef('pk')).order_by('-timestamp', '-id')
+        updated = ChatRoom.objects.update(
+            last_message_text=Coalesce(Subquery(last.values('text')[:1]), Value(''), output_field=TextField()),
+            last_message_at=Subquery(last.values('timestamp')[:1]),
+        )
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} chat rooms"))
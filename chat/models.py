@@ -1,13 +1,29 @@
 from django.db import models
+from django.utils import timezone
 from accounts.models import User
 
 class ChatRoom(models.Model):
     room_id = models.CharField(max_length=255, unique=True)
     customer = models.ForeignKey(User, related_name='customer_chats', on_delete=models.CASCADE)
     support_agent = models.ForeignKey(User, related_name='agent_chats', on_delete=models.CASCADE)
+    # Denormalized for the room list, kept up to date by chat.buffer when messages are saved
+    last_message_text = models.TextField(blank=True, default='')
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    customer_unread = models.PositiveIntegerField(default=0)
+    agent_unread = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        # A participant's rooms, by recent activity, see chat.views.chat_rooms
+        indexes = [models.Index(fields=['customer', '-last_message_at']),
+                   models.Index(fields=['support_agent', '-last_message_at'])]
 
 class Message(models.Model):
     room = models.ForeignKey(ChatRoom, related_name='messages', on_delete=models.CASCADE,null=True)
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     text = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+    # When the message was sent: chat.buffer saves it later, auto_now_add would store the flush time
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        # History is paged newest first per room, see chat.views.chat_messages
+        indexes = [models.Index(fields=['room', 'timestamp', 'id'])]
\ No newline at end of file
@@ -0,0 +1,86 @@
+import time
+from django.conf import settings
+from core.cache import async_redis
+
+# Who is online in each room: a Redis sorted set per room of '<user id>:<channel name>'
+# members, one per open connection, scored by when the connection's presence expires.
+# Connections refresh their score with heartbeats; one that stops (its process died without
+# a disconnect) simply expires. A user is online while any of their connections is.
+PRESENCE_KEY = 'chat_presence_{}'
+
+# KEYS: presence set. ARGV: now, user prefix ('<user id>:'). Drops expired connections.
+_PRUNE = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+"""
+_USER_ONLINE = """
+local function online(prefix)
+    for _, member in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+        if string.sub(member, 1, #prefix) == prefix then
+            return true
+        end
+    end
+    return false
+end
+"""
+# ARGV: now, user prefix, member, expires at, key ttl. Returns 1 when the user came online.
+_JOIN = _USER_ONLINE + _PRUNE + """
+local was_online = online(ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[4], ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+if was_online then
+    return 0
+end
+return 1
+"""
+# ARGV: now, user prefix, member. Returns 1 when the user has no live connection left.
+_LEAVE = _USER_ONLINE + _PRUNE + """
+redis.call('ZREM', KEYS[1], ARGV[3])
+if online(ARGV[2]) then
+    return 0
+end
+return 1
+"""
+
+
+def presence_ttl():
+    return getattr(settings, 'CHAT_PRESENCE_TTL', 60)
+
+
+def _member(user_id, channel_name):
+    return f'{user_id}:{channel_name}'
+
+
+async def join(room_id, user_id, channel_name):
+    """
+    Mark a connection present. Returns whether its user just came online in the room.
+    """
+    now = time.time()
+    args = [now, f'{user_id}:', _member(user_id, channel_name), now + presence_ttl(), presence_ttl()]
+    return bool(await async_redis().register_script(_JOIN)(keys=[PRESENCE_KEY.format(room_id)], args=args))
+
+
+async def heartbeat(room_id, user_id, channel_name):
+    """
+    Keep a connection present for another CHAT_PRESENCE_TTL seconds.
+    """
+    key = PRESENCE_KEY.format(room_id)
+    pipe = async_redis().pipeline(transaction=True)
+    pipe.zadd(key, {_member(user_id, channel_name): time.time() + presence_ttl()})
+    pipe.expire(key, presence_ttl())
+    await pipe.execute()
+
+
+async def leave(room_id, user_id, channel_name):
+    """
+    Drop a connection. Returns whether its user is now offline in the room.
+    """
+    args = [time.time(), f'{user_id}:', _member(user_id, channel_name)]
+    return bool(await async_redis().register_script(_LEAVE)(keys=[PRESENCE_KEY.format(room_id)], args=args))
+
+
+async def online_users(room_id):
+    """
+    Ids of the users with a live connection to the room.
+    """
+    members = await async_redis().zrangebyscore(PRESENCE_KEY.format(room_id), time.time(), '+inf')
+    return sorted({int(member.split(b':', 1)[0]) for member in members})
@@ -1,3 +1,356 @@
-from django.test import TestCase
+import asyncio
+import io
+from datetime import timedelta
+from unittest import mock
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+from accounts.models import User
+from core.cache import async_redis
+from . import presence
+from .buffer import MessageBuffer, mark_read
+from .history import RECENT_KEY, RECENT_TTL, push_recent, recent_messages
+from .models import ChatRoom, Message
+from .routing import websocket_urlpatterns
+from .throttle import Coalescer
 
-# Create your tests here.
+
+class RecentHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = User.objects.create_user('customer@example.com', 'secret')
+        cls.agent = User.objects.create_user('agent@example.com', 'secret', is_staff=True)
+        cls.room = ChatRoom.objects.create(room_id='room-1', customer=cls.customer, support_agent=cls.agent)
+        for text in ('hello', 'how can I help?'):
+            Message.objects.create(room=cls.room, sender=cls.agent, text=text)
+
+    def setUp(self):
+        # Queued messages are only saved when a test flushes them
+        self.buffer = MessageBuffer(interval=60, batch_size=100)
+        patcher = mock.patch('chat.history.message_buffer', lambda: self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.key = RECENT_KEY.format(self.room.id)
+
+    def queue(self, text):
+        self.buffer.pending.append(Message(room=self.room, sender_id=self.customer.id, text=text))
+
+    async def cleanup(self):
+        await async_redis().delete(self.key)
+
+    async def test_cold_fill_includes_buffered_messages(self):
+        self.queue('my order is late')
+        history = await recent_messages(self.room)
+        await self.cleanup()
+        self.assertEqual([entry['message'] for entry in history], ['hello', 'how can I help?', 'my order is late'])
+
+    async def test_first_message_fills_the_list(self):
+        self.queue('my order is late')
+        await push_recent(self.room, self.customer.id, 'my order is late')
+        entries = await async_redis().lrange(self.key, 0, -1)
+        ttl = await async_redis().ttl(self.key)
+        await self.cleanup()
+        self.assertEqual(len(entries), 3)
+        self.assertGreater(ttl, 0)
+
+    async def test_saved_and_queued_messages_in_order(self):
+        self.queue('my order is late')
+        await self.buffer.flush()
+        self.queue('order 42')
+        history = await recent_messages(self.room)
+        await self.cleanup()
+        self.assertEqual([entry['message'] for entry in history],
+                         ['hello', 'how can I help?', 'my order is late', 'order 42'])
+
+    async def test_push_refreshes_the_expiry(self):
+        await recent_messages(self.room)
+        await async_redis().expire(self.key, 10)
+        await push_recent(self.room, self.customer.id, 'still there?')
+        ttl = await async_redis().ttl(self.key)
+        entries = await async_redis().lrange(self.key, 0, -1)
+        await self.cleanup()
+        self.assertGreater(ttl, RECENT_TTL - 60)
+        self.assertEqual(len(entries), 3)
+
+
+class MessageBufferTests(TransactionTestCase):
+    # Not TestCase: the buffer saves in autocommit mode, where a rejected row fails on its own
+
+    def setUp(self):
+        self.customer = User.objects.create_user('customer@example.com', 'secret')
+        self.agent = User.objects.create_user('agent@example.com', 'secret', is_staff=True)
+        self.room = ChatRoom.objects.create(room_id='room-1', customer=self.customer, support_agent=self.agent)
+        self.buffer = MessageBuffer(interval=60, batch_size=100)
+
+    async def stop(self):
+        if self.buffer._task is not None:
+            self.buffer._task.cancel()
+
+    async def test_keeps_the_time_messages_were_sent(self):
+        sent_at = timezone.now() - timedelta(minutes=5)
+        message = Message(room=self.room, sender_id=self.customer.id, text='hello', timestamp=sent_at)
+        self.buffer.add(message)
+        await self.buffer.flush()
+        await self.stop()
+        self.assertEqual((await Message.objects.aget(pk=message.pk)).timestamp, sent_at)
+        room = await ChatRoom.objects.aget(pk=self.room.pk)
+        self.assertEqual((room.last_message_at, room.agent_unread), (sent_at, 1))
+
+    async def test_failed_batch_is_queued_again(self):
+        first = Message(room=self.room, sender_id=self.customer.id, text='first')
+        self.buffer.add(first)
+        with mock.patch.object(Message.objects, 'abulk_create', side_effect=OperationalError('gone away')), \
+                self.assertLogs('chat.buffer', 'ERROR'):
+            await self.buffer.flush()
+        self.assertEqual(self.buffer.pending, [first])
+        self.buffer.add(Message(room=self.room, sender_id=self.customer.id, text='second'))
+        await self.buffer.flush()
+        await self.stop()
+        texts = [text async for text in Message.objects.order_by('timestamp', 'id').values_list('text', flat=True)]
+        self.assertEqual(texts, ['first', 'second'])
+
+    async def test_rejected_message_is_dropped(self):
+        self.buffer.add(Message(room_id=self.room.id + 100, sender_id=self.customer.id, text='lost'))
+        self.buffer.add(Message(room=self.room, sender_id=self.customer.id, text='kept'))
+        with self.assertLogs('chat.buffer', 'ERROR'):
+            await self.buffer.flush()
+        await self.stop()
+        self.assertEqual(self.buffer.pending, [])
+        self.assertEqual([text async for text in Message.objects.values_list('text', flat=True)], ['kept'])
+
+
+class RoomActivityTests(TransactionTestCase):
+    def setUp(self):
+        self.customer = User.objects.create_user('customer@example.com', 'secret')
+        self.agent = User.objects.create_user('agent@example.com', 'secret', is_staff=True)
+        self.room = ChatRoom.objects.create(room_id='room-1', customer=self.customer, support_agent=self.agent)
+        self.buffer = MessageBuffer(interval=60, batch_size=100)
+
+    async def stop(self):
+        if self.buffer._task is not None:
+            self.buffer._task.cancel()
+
+    def message(self, sender, text, minutes_ago=0):
+        return Message(room=self.room, sender_id=sender.id, text=text,
+                       timestamp=timezone.now() - timedelta(minutes=minutes_ago))
+
+    async def test_flush_records_the_last_message_and_unread_counts(self):
+        for message in (self.message(self.customer, 'hello', 3), self.message(self.customer, 'anyone?', 2),
+                        self.message(self.agent, 'hi!', 1)):
+            self.buffer.add(message)
+        await self.buffer.flush()
+        # A batch older than the last message saved only adds to the counters
+        self.buffer.add(self.message(self.customer, 'late', 10))
+        await self.buffer.flush()
+        await self.stop()
+        room = await ChatRoom.objects.aget(pk=self.room.pk)
+        self.assertEqual((room.last_message_text, room.customer_unread, room.agent_unread), ('hi!', 1, 3))
+
+    def test_mark_read_resets_the_readers_counter(self):
+        ChatRoom.objects.filter(pk=self.room.pk).update(customer_unread=2, agent_unread=5)
+        mark_read('room-1', self.agent.id)
+        room = ChatRoom.objects.get(pk=self.room.pk)
+        self.assertEqual((room.customer_unread, room.agent_unread), (2, 0))
+        # Reading the latest messages marks them read too
+        headers = {'Authorization': f'Bearer {AccessToken.for_user(self.customer)}'}
+        self.assertEqual(self.client.get(reverse('chat_messages', args=['room-1']), headers=headers).status_code, 200)
+        room = ChatRoom.objects.get(pk=self.room.pk)
+        self.assertEqual((room.customer_unread, room.agent_unread), (0, 0))
+
+    def test_mark_read_ignores_other_users(self):
+        ChatRoom.objects.filter(pk=self.room.pk).update(customer_unread=2, agent_unread=5)
+        stranger = User.objects.create_user('stranger@example.com', 'secret')
+        mark_read('room-1', stranger.id)
+        room = ChatRoom.objects.get(pk=self.room.pk)
+        self.assertEqual((room.customer_unread, room.agent_unread), (2, 5))
+
+
+class ChatRoomsViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = User.objects.create_user('customer@example.com', 'secret')
+        now = timezone.now()
+        cls.rooms = []
+        for index, minutes_ago in enumerate((30, None, 5, 60)):
+            agent = User.objects.create_user(f'agent{index}@example.com', 'secret', is_staff=True)
+            room = ChatRoom.objects.create(room_id=f'room-{index}', customer=cls.customer, support_agent=agent,
+                                           customer_unread=index, agent_unread=10)
+            if minutes_ago is not None:
+                Message.objects.create(room=room, sender=agent, text=f'message {index}',
+                                       timestamp=now - timedelta(minutes=minutes_ago))
+            cls.rooms.append(room)
+        # Someone else's room
+        other = User.objects.create_user('other@example.com', 'secret')
+        ChatRoom.objects.create(room_id='other', customer=other, support_agent=agent)
+        call_command('rebuild_chat_rooms', stdout=io.StringIO())
+
+    def test_rebuild_sets_the_last_message(self):
+        room = ChatRoom.objects.get(room_id='room-2')
+        self.assertEqual(room.last_message_text, 'message 2')
+        self.assertEqual(room.last_message_at, Message.objects.get(room=room).timestamp)
+        empty = ChatRoom.objects.get(room_id='room-1')
+        self.assertEqual((empty.last_message_text, empty.last_message_at), ('', None))
+
+    def test_lists_rooms_by_recent_activity_in_one_query(self):
+        headers = {'Authorization': f'Bearer {AccessToken.for_user(self.customer)}'}
+        # The user, then the rooms
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('rooms'), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        rooms = response.json()
+        self.assertEqual([room['room_id'] for room in rooms], ['room-2', 'room-0', 'room-3', 'room-1'])
+        self.assertEqual(rooms[0]['last_message'], 'message 2')
+        self.assertEqual(rooms[0]['support_agent'], {'username': 'agent2@example.com'})
+        self.assertEqual([room['unread'] for room in rooms], [2, 0, 3, 1])
+        self.assertIsNone(rooms[3]['last_message'])
+
+
+class CoalescerTests(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+
+    async def send(self, event):
+        self.sent.append(event)
+
+    async def test_sends_the_first_event_at_once(self):
+        coalescer = Coalescer(60, self.send)
+        await coalescer.submit('a')
+        self.assertEqual(self.sent, ['a'])
+        coalescer.cancel()
+
+    async def test_sends_the_latest_event_when_the_interval_ends(self):
+        coalescer = Coalescer(0.05, self.send)
+        for event in ('a', 'b', 'c', 'd'):
+            await coalescer.submit(event)
+        self.assertEqual(self.sent, ['a'])
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.sent, ['a', 'd'])
+
+    async def test_drops_a_repeat_of_the_last_event_sent(self):
+        coalescer = Coalescer(0.05, self.send)
+        await coalescer.submit(True)
+        await coalescer.submit(False)
+        await coalescer.submit(True)
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.sent, [True])
+
+    async def test_flush_and_cancel(self):
+        coalescer = Coalescer(60, self.send)
+        await coalescer.submit('a')
+        await coalescer.submit('b')
+        await coalescer.flush()
+        self.assertEqual(self.sent, ['a', 'b'])
+        await coalescer.submit('c')
+        coalescer.cancel()
+        await coalescer.flush()
+        self.assertEqual(self.sent, ['a', 'b'])
+
+
+@override_settings(CHAT_PRESENCE_TTL=60)
+class PresenceTests(SimpleTestCase):
+    room_id = 9999
+
+    def at(self, now):
+        return mock.patch('chat.presence.time', mock.Mock(time=mock.Mock(return_value=now)))
+
+    async def test_online_while_any_connection_is(self):
+        await async_redis().delete(presence.PRESENCE_KEY.format(self.room_id))
+        self.assertTrue(await presence.join(self.room_id, 1, 'first'))
+        self.assertFalse(await presence.join(self.room_id, 1, 'second'))
+        self.assertTrue(await presence.join(self.room_id, 2, 'third'))
+        self.assertEqual(await presence.online_users(self.room_id), [1, 2])
+        self.assertFalse(await presence.leave(self.room_id, 1, 'first'))
+        self.assertEqual(await presence.online_users(self.room_id), [1, 2])
+        self.assertTrue(await presence.leave(self.room_id, 1, 'second'))
+        self.assertEqual(await presence.online_users(self.room_id), [2])
+        await async_redis().delete(presence.PRESENCE_KEY.format(self.room_id))
+
+    async def test_connections_expire_without_heartbeats(self):
+        await async_redis().delete(presence.PRESENCE_KEY.format(self.room_id))
+        with self.at(1000):
+            await presence.join(self.room_id, 1, 'first')
+            await presence.join(self.room_id, 1, 'second')
+        with self.at(1050):
+            await presence.heartbeat(self.room_id, 1, 'second')
+        with self.at(1070):
+            self.assertEqual(await presence.online_users(self.room_id), [1])
+        with self.at(1200):
+            self.assertEqual(await presence.online_users(self.room_id), [])
+            # Both connections had expired: the user comes back online
+            self.assertTrue(await presence.join(self.room_id, 1, 'third'))
+            self.assertTrue(await presence.leave(self.room_id, 1, 'third'))
+        await async_redis().delete(presence.PRESENCE_KEY.format(self.room_id))
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ChatConsumerTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = User.objects.create_user('customer@example.com', 'secret')
+        cls.agent = User.objects.create_user('agent@example.com', 'secret', is_staff=True)
+        cls.room = ChatRoom.objects.create(room_id='room-1', customer=cls.customer, support_agent=cls.agent,
+                                           customer_unread=3)
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/room-1/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(await communicator.receive_json_from(), {'history': []})
+        self.assertIn('presence', await communicator.receive_json_from())
+        return communicator
+
+    async def cleanup(self):
+        await async_redis().delete(RECENT_KEY.format(self.room.id), presence.PRESENCE_KEY.format(self.room.id))
+
+    async def test_typing_read_and_presence_reach_the_other_connection(self):
+        await self.cleanup()
+        agent = await self.connect()
+        customer = await self.connect()
+        online = {'type': 'presence', 'user': self.agent.id, 'online': True}
+
+        await agent.send_json_to({'type': 'heartbeat', 'sender': self.agent.id})
+        self.assertEqual(await agent.receive_json_from(), online)
+        self.assertEqual(await customer.receive_json_from(), online)
+
+        # A second connection of the agent isn't announced
+        second = await self.connect()
+        await second.send_json_to({'type': 'heartbeat', 'sender': self.agent.id})
+        await second.disconnect()
+        self.assertTrue(await customer.receive_nothing())
+
+        # The first frame identifies the customer, then only the agent hears them typing
+        await customer.send_json_to({'type': 'typing', 'typing': True, 'sender': self.customer.id})
+        online = {'type': 'presence', 'user': self.customer.id, 'online': True}
+        self.assertEqual(await agent.receive_json_from(), online)
+        self.assertEqual(await customer.receive_json_from(), online)
+        self.assertEqual(await agent.receive_json_from(), {'type': 'typing', 'user': self.customer.id, 'typing': True})
+        # Repeats are dropped
+        await customer.send_json_to({'type': 'typing', 'typing': True, 'sender': self.customer.id})
+        self.assertTrue(await agent.receive_nothing())
+
+        await customer.send_json_to({'type': 'read', 'sender': self.customer.id})
+        read = await agent.receive_json_from()
+        self.assertEqual((read['type'], read['user']), ('read', self.customer.id))
+        self.assertEqual((await ChatRoom.objects.aget(pk=self.room.pk)).customer_unread, 0)
+        self.assertTrue(await customer.receive_nothing())
+
+        # Leaving clears the typing indicator and announces the customer offline
+        await customer.disconnect()
+        self.assertEqual(await agent.receive_json_from(), {'type': 'typing', 'user': self.customer.id, 'typing': False})
+        self.assertEqual(await agent.receive_json_from(),
+                         {'type': 'presence', 'user': self.customer.id, 'online': False})
+        await agent.disconnect()
+        await self.cleanup()
+
+    async def test_rejects_frames_of_other_users(self):
+        await self.cleanup()
+        customer = await self.connect()
+        await customer.send_json_to({'type': 'typing', 'typing': True, 'sender': 10 ** 6})
+        self.assertEqual(await customer.receive_json_from(), {'error': 'Unknown sender'})
+        await customer.disconnect()
+        await self.cleanup()
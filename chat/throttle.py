@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+_NOTHING = object()
+
+
+class Coalescer:
+    """
+    Rate limit for one kind of event of one connection: at most one send per interval.
+
+    The first event goes out at once. Events submitted within the interval replace each
+    other and only the latest is sent, when the interval ends; one equal to the last event
+    sent is dropped (a client repeating "typing" on every keystroke). send is a coroutine
+    function taking the event.
+    """
+
+    def __init__(self, interval, send):
+        self.interval = interval
+        self.send = send
+        self.last_sent = _NOTHING
+        self.sent_at = float('-inf')
+        self.pending = _NOTHING
+        self._task = None
+
+    async def submit(self, event):
+        if time.monotonic() - self.sent_at >= self.interval:
+            self.pending = _NOTHING
+            await self._send(event)
+            return
+        self.pending = _NOTHING if event == self.last_sent else event
+        if self.pending is not _NOTHING and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._send_later())
+
+    async def _send(self, event):
+        self.last_sent = event
+        self.sent_at = time.monotonic()
+        await self.send(event)
+
+    async def _send_later(self):
+        await asyncio.sleep(max(0.0, self.sent_at + self.interval - time.monotonic()))
+        if self.pending is not _NOTHING:
+            event, self.pending = self.pending, _NOTHING
+            await self._send(event)
+
+    def assume(self, event):
+        """
+        Record event as the last one sent, without sending it, dropping any pending event.
+        """
+        self.cancel()
+        self.last_sent = event
+
+    async def flush(self):
+        """
+        Send the pending event now, if any.
+        """
+        if self._task is not None:
+            self._task.cancel()
+        if self.pending is not _NOTHING:
+            event, self.pending = self.pending, _NOTHING
+            await self._send(event)
+
+    def cancel(self):
+        self.pending = _NOTHING
+        if self._task is not None:
+            self._task.cancel()
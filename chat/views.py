@@ -1,25 +1,38 @@
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
+from rest_framework import status
 from .models import ChatRoom, Message
-from django.db.models import Q
+from .buffer import mark_read
+from django.db.models import F, Q
+from core.pagination import keyset_filter
 # from .serializers import ChatRoomSerializer
 
+# Messages per page of history, by default and at most
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def chat_rooms(request):
-    print('hai')
+    """
+    The user's rooms, most recently active first, with their last message and the number of
+    messages the user hasn't read. One query, from the fields chat.buffer keeps on ChatRoom.
+    """
     user = request.user  # Get the current logged-in user
-    rooms = ChatRoom.objects.filter(Q(customer=user)|Q(support_agent=user))
+    rooms = ChatRoom.objects.filter(Q(customer=user)|Q(support_agent=user)) \
+        .order_by(F('last_message_at').desc(nulls_last=True), '-id') \
+        .values_list('room_id', 'support_agent__email', 'last_message_text', 'last_message_at',
+                     'customer_id', 'customer_unread', 'agent_unread')
 
-    # Add the last message to each room (if any)
     room_data = []
-    for room in rooms:
-        last_message = Message.objects.filter(room=room).order_by('-timestamp').first()
+    for room_id, agent_email, last_text, last_at, customer_id, customer_unread, agent_unread in rooms:
         room_data.append({
-            'room_id': room.room_id,
-            'support_agent': {'username': room.support_agent.email},
-            'last_message': last_message.text if last_message else None,
+            'room_id': room_id,
+            'support_agent': {'username': agent_email},
+            'last_message': last_text if last_at else None,
+            'last_message_at': last_at,
+            'unread': customer_unread if customer_id == user.id else agent_unread,
         })
 
     return Response(room_data)
@@ -28,26 +41,50 @@ def chat_rooms(request):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def chat_messages(request,roomId):
-    print('hai')
-    # customer = request.user  # Get the current logged-in user
-    # rooms = ChatRoom.objects.filter(customer=customer)
+    """
+    A page of a room's messages, oldest first: the latest ones, or those sent before a message.
+
+    Query Parameters:
+    - before: (int) Optional. A message id; returns the messages that precede it. Pass the
+      id of the first message of a page to get the page before it.
+    - limit: (int) Optional. Messages per page, 50 by default and 200 at most.
+
+    Response:
+    - A list of messages, `room_id` being the message id. Fewer than limit means the
+      beginning of the room was reached. Reading the latest page resets the user's unread
+      count of the room.
+
+    Status Codes:
+    - 200: Success.
+    - 400: before is not a message of this room.
+    """
+    # Paged newest first over the (room, timestamp, id) index, one query per page
     messages = Message.objects.filter(room__room_id=roomId)
+    ordering = ('-timestamp', '-id')
+
+    try:
+        limit = min(max(int(request.query_params.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        limit = PAGE_SIZE
+
+    before = request.query_params.get('before')
+    if before:
+        try:
+            anchor = messages.values_list('timestamp', 'id').get(pk=int(before))
+        except (ValueError, Message.DoesNotExist):
+            return Response({'error': 'Message not found in this room'}, status=status.HTTP_400_BAD_REQUEST)
+        messages = messages.filter(keyset_filter(ordering, anchor))
+    else:
+        # The latest messages are being read
+        mark_read(roomId, request.user.id)
 
-    # Add the last message to each room (if any)
-    # room_data = []
-    # for room in rooms:
-    #     last_message = Message.objects.filter(room=room).order_by('-timestamp').first()
-    #     room_data.append({
-    #         'room_id': room.room_id,
-    #         'support_agent': {'username': room.support_agent.email},
-    #         'last_message': last_message.text if last_message else None,
-    #     })
+    rows = list(messages.order_by(*ordering).values_list('id', 'sender_id', 'text')[:limit])
     message_list = [
         {
-            'room_id':room.id,
-            'sender':room.sender.id,
-            'message':room.text
-        }for room in messages
+            'room_id':message_id,
+            'sender':sender_id,
+            'message':text
+        }for message_id, sender_id, text in reversed(rows)
     ]
 
     return Response(message_list)
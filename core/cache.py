@@ -0,0 +1,421 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis import asyncio as aioredis
+from redis.exceptions import LockError
+
+logger = logging.getLogger(__name__)
+
+# Hit/miss counters of this process, for both tiers, see cache_stats()
+stats = Counter()
+
+# Cache-aside with stampede protection for the cached views. Entries are stored as
+# (value, expires_at, delta), delta being how long the value took to compute, and kept
+# for stale_timeout past their expiry:
+#   - a fresh entry is served, except that a request may refresh it early with a
+#     probability growing as expiry nears and with delta (probabilistic early expiry),
+#     so hot keys are usually recomputed by one request before they ever expire;
+#   - an expired entry is still served while one worker, holding the key's lock,
+#     recomputes it (stale-while-revalidate);
+#   - on a miss, one worker computes while the others wait for its result (single flight).
+LOCK_SUFFIX = '_lock'
+STALE_TIMEOUT = 60 * 5
+LOCK_TIMEOUT = 10
+
+_LOCKED = object()
+
+
+def _store(key, compute, timeout, stale_timeout):
+    started = time.time()
+    value = compute()
+    delta = time.time() - started
+    cache.set(key, (value, started + delta + timeout, delta), timeout=timeout + stale_timeout)
+    return value
+
+
+def _refresh(key, compute, timeout, stale_timeout, lock_timeout, wait):
+    """
+    Recompute key under its lock. Without wait, returns _LOCKED when another worker holds it.
+    """
+    lock = cache.lock(key + LOCK_SUFFIX, timeout=lock_timeout)
+    if not lock.acquire(blocking=wait, blocking_timeout=lock_timeout):
+        if not wait:
+            return _LOCKED
+        # The worker holding the lock is stuck or gone; compute without it
+        return _store(key, compute, timeout, stale_timeout)
+    try:
+        if wait:
+            # The previous holder has most likely just stored the value
+            entry = cache.get(key)
+            if isinstance(entry, tuple) and entry[1] > time.time():
+                return entry[0]
+        return _store(key, compute, timeout, stale_timeout)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # Expired while computing, and maybe taken by another worker since
+            pass
+
+
+def cache_aside(key, compute, timeout, stale_timeout=STALE_TIMEOUT, lock_timeout=LOCK_TIMEOUT, beta=1.0):
+    """
+    Return the value cached under key, computing it with compute() when it is missing or due.
+    timeout is how long the value is fresh, stale_timeout how much longer it may be served while
+    it is recomputed. beta > 1 favours earlier refreshes, beta = 0 disables them. Entries are
+    wrapped, so a key read here must only be written here (deleting it is fine).
+    """
+    entry = cache.get(key)
+    if not isinstance(entry, tuple):
+        # Missing, or written before the key was served through here
+        stats['l2_misses'] += 1
+        return _refresh(key, compute, timeout, stale_timeout, lock_timeout, wait=True)
+    stats['l2_hits'] += 1
+
+    value, expires_at, delta = entry
+    if time.time() - delta * beta * math.log(1.0 - random.random()) < expires_at:
+        return value
+    refreshed = _refresh(key, compute, timeout, stale_timeout, lock_timeout, wait=False)
+    return value if refreshed is _LOCKED else refreshed
+
+
+# Optional in-process L1 in front of the default cache, for small data that is read on
+# every request and rarely changes (reference data, catalog generations). Entries live
+# L1_CACHE_TTL seconds at most, in an LRU of L1_CACHE_MAX_ENTRIES (0 disables the tier).
+# Writers call invalidate(), which publishes the keys on INVALIDATION_CHANNEL; a listener
+# thread in every process drops them from its L1. While the listener is not subscribed the
+# L1 is bypassed, since invalidations could be missed. Every invalidation also bumps the L1's
+# sequence number: readers record it before reading the default cache and only keep what they
+# read if it has not moved, or a value read just before an invalidation landed could be
+# stored after it and served until it expires.
+INVALIDATION_CHANNEL = 'l1_cache_invalidate'
+
+
+class LocalCache:
+    """
+    Thread-safe LRU of (value, expires_at), bounded in entries. sequence counts the deletions.
+    """
+
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.sequence = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return (found, value).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[0]
+
+    def set(self, key, value, timeout=None):
+        self.set_many({key: value}, timeout)
+
+    def set_many(self, data, timeout=None, sequence=None):
+        """
+        Store data, unless sequence is given and something was deleted since it was read.
+        """
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        with self._lock:
+            if sequence is not None and sequence != self.sequence:
+                return False
+            expires_at = time.monotonic() + timeout
+            for key, value in data.items():
+                self._entries[key] = (value, expires_at)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return True
+
+    def delete_many(self, keys):
+        with self._lock:
+            self.sequence += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.sequence += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Listener:
+    """
+    Subscriber thread applying invalidation messages to this process's L1.
+    """
+
+    def __init__(self, local):
+        self.local = local
+        self.subscribed = False
+        self.pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        # A forked worker inherits the parent's entries but not its thread
+        if self.pid == os.getpid():
+            return
+        with self._lock:
+            if self.pid != os.getpid():
+                self.subscribed = False
+                self.local.clear()
+                self.pid = os.getpid()
+                threading.Thread(target=self.run, name='l1-cache-invalidation', daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                pubsub = get_redis_connection('default').pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Anything cached before the subscription may have missed an invalidation
+                self.local.clear()
+                self.subscribed = True
+                for message in pubsub.listen():
+                    keys = json.loads(message['data'])
+                    if keys is None:
+                        self.local.clear()
+                    else:
+                        self.local.delete_many(keys)
+            except Exception:
+                logger.exception("L1 cache invalidation listener failed, retrying")
+            self.subscribed = False
+            self.local.clear()
+            time.sleep(1)
+
+
+_local = None
+_listener = None
+
+
+def _local_cache():
+    """
+    This process's L1, or None when it is disabled or not yet subscribed to invalidations.
+    """
+    global _local, _listener
+    max_entries = getattr(settings, 'L1_CACHE_MAX_ENTRIES', 0)
+    if not max_entries:
+        return None
+    if _local is None:
+        _local = LocalCache(max_entries, getattr(settings, 'L1_CACHE_TTL', 60))
+        _listener = _Listener(_local)
+    _listener.ensure_started()
+    return _local if _listener.subscribed else None
+
+
+def local_get_many(keys):
+    """
+    {key: value} of the given keys found in the L1.
+    """
+    local = _local_cache()
+    found = {}
+    for key in keys:
+        hit, value = local.get(key) if local is not None else (False, None)
+        if hit:
+            found[key] = value
+            stats['l1_hits'] += 1
+        else:
+            stats['l1_misses'] += 1
+    return found
+
+
+def local_sequence():
+    """
+    The L1's invalidation sequence number, to record before reading what local_set_many will
+    store. None while the L1 is disabled.
+    """
+    _local_cache()
+    return _local.sequence if _local is not None else None
+
+
+def local_set_many(data, timeout=None, sequence=None):
+    """
+    Store data in the L1. With sequence (from local_sequence()), nothing is stored when an
+    invalidation arrived since, as data may have been read before it.
+    """
+    local = _local_cache()
+    if local is not None:
+        local.set_many(data, timeout, sequence)
+
+
+def two_tier(key, compute, timeout, local_timeout=None, **options):
+    """
+    cache_aside behind the L1: served from this process when possible, otherwise from the
+    default cache (and computed there on a miss). Writers must call invalidate(key).
+    """
+    sequence = local_sequence()
+    found = local_get_many([key])
+    if key in found:
+        return found[key]
+    value = cache_aside(key, compute, timeout, **options)
+    local_set_many({key: value}, local_timeout, sequence)
+    return value
+
+
+def publish_invalidation(keys=None):
+    """
+    Drop keys (every key when None) from the L1 of every process, this one included.
+    """
+    keys = None if keys is None else list(keys)
+    if _local is not None:
+        if keys is None:
+            _local.clear()
+        else:
+            _local.delete_many(keys)
+    get_redis_connection('default').publish(INVALIDATION_CHANNEL, json.dumps(keys))
+
+
+def invalidate(*keys):
+    """
+    Delete keys served through two_tier from both tiers, in every process.
+    """
+    cache.delete_many(keys)
+    publish_invalidation(keys)
+
+
+def cache_stats():
+    """
+    Hit/miss counters of this process for both tiers, with the L1 size.
+    """
+    data = {name: stats[name] for name in ('l1_hits', 'l1_misses', 'l2_hits', 'l2_misses')}
+    data['l1_entries'] = len(_local) if _local is not None else 0
+    data['l1_subscribed'] = bool(_listener and _listener.subscribed)
+    return data
+
+
+# Async access to the default cache, for the ASGI-native views. Django's async cache methods
+# only run the sync client through sync_to_async, a thread hop per call, so these talk to the
+# same Redis with redis.asyncio instead. Keys and values are encoded by django_redis's client,
+# so entries, locks and generations are shared with the sync functions above.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _connect():
+    """
+    redis.asyncio client configured like django_redis's: the first LOCATION, with the password,
+    socket timeouts and connection pool settings of OPTIONS.
+    """
+    config = settings.CACHES['default']
+    location = config['LOCATION']
+    options = config.get('OPTIONS', {})
+    # connection_class would be a sync connection, the async pool uses its own
+    kwargs = {name: value for name, value in options.get('CONNECTION_POOL_KWARGS', {}).items()
+              if name != 'connection_class'}
+    for option, name in (('PASSWORD', 'password'), ('SOCKET_TIMEOUT', 'socket_timeout'),
+                         ('SOCKET_CONNECT_TIMEOUT', 'socket_connect_timeout')):
+        if options.get(option) is not None:
+            kwargs[name] = options[option]
+    return aioredis.Redis.from_url(location[0] if isinstance(location, (list, tuple)) else location, **kwargs)
+
+
+def async_redis():
+    """
+    redis.asyncio client for the default cache. Async connections belong to the event loop
+    they were opened on, so there is one client per loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = _connect()
+    return client
+
+
+async def aget_many(keys):
+    """
+    Async cache.get_many: {key: value} of the given keys found in the default cache.
+    """
+    keys = list(keys)
+    if not keys:
+        return {}
+    values = await async_redis().mget([cache.client.make_key(key) for key in keys])
+    return {key: cache.client.decode(value) for key, value in zip(keys, values) if value is not None}
+
+
+async def aget(key, default=None):
+    return (await aget_many([key])).get(key, default)
+
+
+async def aset(key, value, timeout=None, nx=False):
+    """
+    Async cache.set (cache.add with nx=True), timeout in seconds, None for no expiry.
+    """
+    ex = max(1, int(timeout)) if timeout is not None else None
+    return bool(await async_redis().set(cache.client.make_key(key), cache.client.encode(value), ex=ex, nx=nx))
+
+
+async def _astore(key, compute, timeout, stale_timeout):
+    started = time.time()
+    value = await compute()
+    delta = time.time() - started
+    await aset(key, (value, started + delta + timeout, delta), timeout=timeout + stale_timeout)
+    return value
+
+
+async def _arefresh(key, compute, timeout, stale_timeout, lock_timeout, wait):
+    lock = async_redis().lock(cache.client.make_key(key + LOCK_SUFFIX), timeout=lock_timeout)
+    if not await lock.acquire(blocking=wait, blocking_timeout=lock_timeout):
+        if not wait:
+            return _LOCKED
+        return await _astore(key, compute, timeout, stale_timeout)
+    try:
+        if wait:
+            entry = await aget(key)
+            if isinstance(entry, tuple) and entry[1] > time.time():
+                return entry[0]
+        return await _astore(key, compute, timeout, stale_timeout)
+    finally:
+        try:
+            await lock.release()
+        except LockError:
+            pass
+
+
+async def acache_aside(key, compute, timeout, stale_timeout=STALE_TIMEOUT, lock_timeout=LOCK_TIMEOUT, beta=1.0):
+    """
+    cache_aside for async views: compute is a coroutine function. Entries, early refreshes
+    and locks are the same as cache_aside's, and the two may serve the same key.
+    """
+    entry = await aget(key)
+    if not isinstance(entry, tuple):
+        stats['l2_misses'] += 1
+        return await _arefresh(key, compute, timeout, stale_timeout, lock_timeout, wait=True)
+    stats['l2_hits'] += 1
+
+    value, expires_at, delta = entry
+    if time.time() - delta * beta * math.log(1.0 - random.random()) < expires_at:
+        return value
+    refreshed = await _arefresh(key, compute, timeout, stale_timeout, lock_timeout, wait=False)
+    return value if refreshed is _LOCKED else refreshed
+
+
+async def atwo_tier(key, compute, timeout, local_timeout=None, **options):
+    """
+    two_tier for async views: compute is a coroutine function.
+    """
+    sequence = local_sequence()
+    found = local_get_many([key])
+    if key in found:
+        return found[key]
+    value = await acache_aside(key, compute, timeout, **options)
+    local_set_many({key: value}, local_timeout, sequence)
+    return value
@@ -0,0 +1,108 @@
+import hashlib
+from functools import wraps
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+
+# Cache-Control policies. Catalog and reference data are the same for every user, so shared
+# caches (a CDN) may keep them; order data is per user and must be revalidated every time.
+CATALOG_CACHE_CONTROL = {'public': True, 'max_age': 60, 'stale_while_revalidate': 30}
+REFERENCE_CACHE_CONTROL = {'public': True, 'max_age': 300, 'stale_while_revalidate': 60}
+PRIVATE_CACHE_CONTROL = {'private': True, 'no_cache': True}
+
+
+def conditional(version, cache_control):
+    """
+    View decorator answering conditional GETs from a cheap version stamp.
+
+    version(request, *args, **kwargs) returns a string that changes whenever the body would
+    (generation counters, a max updated_at, ...). The strong ETag hashes it together with the
+    full path and the Accept header, so it is known before the view runs: a matching
+    If-None-Match gets a 304 without any query or serialization. Successful responses get the
+    ETag and the cache_control policy. Apply it below @api_view (or with method_decorator on a
+    class-based view's get), so request.user is already authenticated when version runs.
+    Async views are supported too, version must then be a coroutine function.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if request.method not in ('GET', 'HEAD'):
+                    return await view(request, *args, **kwargs)
+                etag = _etag(request, await version(request, *args, **kwargs))
+                if _matches(request, etag):
+                    return _finish(request, HttpResponseNotModified(), etag, cache_control)
+                return _finish(request, await view(request, *args, **kwargs), etag, cache_control)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            etag = _etag(request, version(request, *args, **kwargs))
+            if _matches(request, etag):
+                return _finish(request, HttpResponseNotModified(), etag, cache_control)
+            return _finish(request, view(request, *args, **kwargs), etag, cache_control)
+        return wrapper
+    return decorator
+
+
+def _etag(request, version):
+    stamp = f"{version}|{request.get_full_path()}|{request.META.get('HTTP_ACCEPT', '')}"
+    return quote_etag(hashlib.md5(stamp.encode()).hexdigest())
+
+
+def _matches(request, etag):
+    # Weak comparison, as If-None-Match requires: compression weakens the ETag
+    if_none_match = [tag.removeprefix('W/') for tag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))]
+    return etag in if_none_match or '*' in if_none_match
+
+
+def _finish(request, response, etag, cache_control):
+    if response.status_code not in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+        return response
+    response['ETag'] = etag
+    patch_cache_control(response, **cache_control)
+    patch_vary_headers(response, ['Accept', 'Authorization'] if cache_control.get('private') else ['Accept'])
+    return response
+
+
+def is_asgi(request):
+    """
+    Whether request is served by the ASGI handler (daphne), DRF requests included.
+    """
+    return isinstance(getattr(request, '_request', request), ASGIRequest)
+
+
+_DONE = object()
+
+
+async def aiterate(iterator):
+    """
+    Async iterator over a sync one, each item produced through sync_to_async. Under ASGI,
+    Django collects a sync StreamingHttpResponse body in full before sending it; an async
+    one goes out chunk by chunk. Items are produced in the thread-sensitive executor, so a
+    generator reading a database cursor always runs on the thread holding the connection.
+    """
+    iterator = iter(iterator)
+    step = sync_to_async(next)
+    try:
+        while True:
+            item = await step(iterator, _DONE)
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            await sync_to_async(close)()
+
+
+def streaming_content(request, iterator):
+    """
+    The body to give a StreamingHttpResponse for request: async under ASGI, as is under WSGI.
+    """
+    return aiterate(iterator) if is_asgi(request) else iterator
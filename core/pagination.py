@@ -0,0 +1,137 @@
+import base64
+import json
+import math
+from datetime import date, datetime
+from decimal import Decimal
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _cursor_value(value):
+    # Full precision on purpose: DjangoJSONEncoder drops microseconds, which would skip rows
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f'{type(value).__name__} is not a supported cursor value')
+
+
+def encode_cursor(values):
+    data = json.dumps(values, default=_cursor_value, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list):
+        raise InvalidCursor(cursor)
+    return values
+
+
+def keyset_filter(ordering, values):
+    """
+    Build the "comes after (values)" condition for a lexicographic ordering such
+    as ('-created_at', '-id'): (a < x) OR (a = x AND b < y) ...
+    """
+    condition = Q()
+    for index, (field, value) in enumerate(zip(ordering, values)):
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        term = Q(**{f'{name}__{lookup}': value})
+        for previous, previous_value in zip(ordering[:index], values[:index]):
+            term &= Q(**{previous.lstrip('-'): previous_value})
+        condition |= term
+    return condition
+
+
+def keyset_paginate(queryset, cursor, ordering, page_size=10):
+    """
+    Paginate a queryset by an opaque keyset cursor instead of LIMIT/OFFSET.
+
+    ordering must end with a unique field (usually 'id' or '-id') so the keyset is total.
+    An empty cursor returns the first page. Every page costs one indexed range scan,
+    and no COUNT(*) is issued, regardless of how deep the client has paged.
+
+    Returns a tuple of (items, next_cursor); next_cursor is None on the last page.
+    Works on .values() querysets too, items are then dicts. Raises InvalidCursor when the
+    cursor does not decode to a value of each ordering field; views answer it with a 400.
+    """
+    queryset = _keyset_queryset(queryset, cursor, ordering)
+    return _keyset_page(list(queryset[:page_size + 1]), ordering, page_size)
+
+
+async def akeyset_paginate(queryset, cursor, ordering, page_size=10):
+    """
+    keyset_paginate for async views.
+    """
+    queryset = _keyset_queryset(queryset, cursor, ordering)
+    return _keyset_page([item async for item in queryset[:page_size + 1]], ordering, page_size)
+
+
+def _ordering_field(model, name):
+    *path, name = name.split('__')
+    for part in path:
+        model = model._meta.get_field(part).related_model
+    return model._meta.pk if name == 'pk' else model._meta.get_field(name)
+
+
+def _cursor_values(model, cursor, ordering):
+    """
+    The values of cursor, one per ordering field, converted by the model field they compare
+    with. Raises InvalidCursor for a cursor that was not produced for this ordering.
+    """
+    values = decode_cursor(cursor)
+    if len(values) != len(ordering):
+        raise InvalidCursor(cursor)
+    converted = []
+    for field, value in zip(ordering, values):
+        # Cursors only hold JSON scalars, never null: ordering fields are not nullable
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise InvalidCursor(cursor)
+        try:
+            converted.append(_ordering_field(model, field.lstrip('-')).to_python(value))
+        except (ValidationError, TypeError, ValueError):
+            raise InvalidCursor(cursor)
+    return converted
+
+
+def _keyset_queryset(queryset, cursor, ordering):
+    queryset = queryset.order_by(*ordering)
+    if cursor:
+        queryset = queryset.filter(keyset_filter(ordering, _cursor_values(queryset.model, cursor, ordering)))
+    return queryset
+
+
+def _keyset_page(items, ordering, page_size):
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        last = items[-1]
+        get = last.get if isinstance(last, dict) else lambda field: getattr(last, field)
+        next_cursor = encode_cursor([get(field.lstrip('-')) for field in ordering])
+    return items, next_cursor
+
+
+async def apaginate(queryset, page, page_size=10):
+    """
+    Numbered page of an ordered queryset for async views, like Paginator(queryset, page_size)
+    falling back to the first page when page is invalid or out of range.
+    Returns (items, page number, number of pages).
+    """
+    pages = max(1, math.ceil(await queryset.acount() / page_size))
+    try:
+        number = int(page)
+        if not 1 <= number <= pages:
+            raise ValueError(number)
+    except (TypeError, ValueError):
+        number = 1
+    start = (number - 1) * page_size
+    return [item async for item in queryset[start:start + page_size]], number, pages
@@ -0,0 +1,120 @@
+import json
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework.renderers import JSONRenderer
+from .http import streaming_content
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is an optional speedup
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that encodes with orjson when it is installed.
+
+    The output is byte-for-byte what JSONRenderer produces with the default (compact, unicode)
+    settings: non-native types go through the same DRF encoder, datetimes included, and
+    \\u2028/\\u2029 are escaped the same way. Anything orjson cannot encode identically
+    (indented output, huge integers, ...) falls back to JSONRenderer. Floats are where the two
+    differ: exponent notation (1e-7 instead of 1e-07, for magnitudes below 1e-4 or from 1e16)
+    and NaN/Infinity, written as null. Only use it on views whose floats stay in plain range,
+    like the catalog listings whose only floats are average ratings.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if (orjson is None or self.ensure_ascii or not self.compact
+                or self.get_indent(accepted_media_type, renderer_context or {}) is not None):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except (orjson.JSONEncodeError, TypeError, ValueError):
+            return super().render(data, accepted_media_type, renderer_context)
+        return _escape_separators(ret)
+
+    def _encode(self, data):
+        """
+        Compact encoding of data, the same bytes render() gives with the default settings.
+        """
+        if orjson is not None:
+            try:
+                ret = orjson.dumps(data, default=self.encoder_class().default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+                return _escape_separators(ret)
+            except (orjson.JSONEncodeError, TypeError, ValueError):
+                pass
+        ret = json.dumps(data, cls=self.encoder_class, ensure_ascii=False, allow_nan=not self.strict, separators=(',', ':'))
+        return _escape_separators(ret.encode())
+
+
+def _escape_separators(ret):
+    # Same escaping as JSONRenderer: U+2028/2029 are valid JSON but not valid JavaScript
+    return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+class FastJSONResponse(HttpResponse):
+    """
+    JSON response encoded like FastJSONRenderer, for plain Django (async) views outside DRF.
+    """
+
+    def __init__(self, data, status=None, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(FastJSONRenderer()._encode(data), status=status, **kwargs)
+
+
+class StreamedList:
+    """
+    Marks an iterable to be written by StreamingJSONResponse as a JSON array, row by row.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+
+class StreamingJSONResponse(StreamingHttpResponse):
+    """
+    JSON response written while it is produced, for payloads too large to build in memory.
+
+    data is encoded like FastJSONRenderer would, except that StreamedList values anywhere in it
+    are consumed lazily, so feeding one from queryset.iterator(chunk_size=...) keeps the peak
+    memory at one chunk of rows. Output is buffered into pieces of about buffer_size bytes.
+    Pass the request so that under ASGI the body is an async iterator, each piece produced
+    through sync_to_async; otherwise Django would collect it whole before sending it.
+    """
+    buffer_size = 64 * 1024
+
+    def __init__(self, data, status=None, request=None, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        self._encode = FastJSONRenderer()._encode
+        pieces = self._buffered(self._iter_json(data))
+        if request is not None:
+            pieces = streaming_content(request, pieces)
+        super().__init__(pieces, status=status, **kwargs)
+
+    def _iter_json(self, data):
+        if isinstance(data, StreamedList):
+            yield b'['
+            for index, row in enumerate(data.rows):
+                yield b',' + self._encode(row) if index else self._encode(row)
+            yield b']'
+        elif isinstance(data, dict) and any(isinstance(value, StreamedList) for value in data.values()):
+            yield b'{'
+            for index, (key, value) in enumerate(data.items()):
+                yield (b',' if index else b'') + self._encode(str(key)) + b':'
+                yield from self._iter_json(value)
+            yield b'}'
+        else:
+            yield self._encode(data)
+
+    def _buffered(self, pieces):
+        buffer, size = [], 0
+        for piece in pieces:
+            buffer.append(piece)
+            size += len(piece)
+            if size >= self.buffer_size:
+                yield b''.join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield b''.join(buffer)
@@ -0,0 +1,57 @@
+from django.db.models import Prefetch
+
+
+class QueryPlanMixin:
+    """
+    Serializer mixin declaring the select_related / prefetch_related plan its fields need,
+    so views build querysets with apply_query_plan instead of repeating the lookups.
+
+    - plan_select_related / plan_prefetch_related: lookups relative to the serialized model.
+    - plan_nested: {source: serializer} for nested to-one serializers, joined and planned
+      under the source's prefix.
+    - plan_prefetch_nested: {source: serializer} for nested many=True serializers, prefetched
+      with a queryset planned by that serializer.
+
+    Plans do not defer columns: django-lifecycle touches every attribute when a Base_content
+    model is instantiated, so only()/defer() would cost a query per deferred field and row.
+    """
+    plan_select_related = ()
+    plan_prefetch_related = ()
+    plan_nested = {}
+    plan_prefetch_nested = {}
+
+    @classmethod
+    def query_plan(cls, prefix=''):
+        """
+        Return the (select_related, prefetch_related) lookups for this serializer under prefix.
+        """
+        select = [prefix + lookup for lookup in cls.plan_select_related]
+        prefetch = [prefix + lookup for lookup in cls.plan_prefetch_related]
+        for source, serializer_class in cls.plan_nested.items():
+            select.append(prefix + source)
+            nested_select, nested_prefetch = serializer_class.query_plan(f'{prefix}{source}__')
+            select += nested_select
+            prefetch += nested_prefetch
+        for source, serializer_class in cls.plan_prefetch_nested.items():
+            model = serializer_class.Meta.model
+            prefetch.append(Prefetch(prefix + source, queryset=apply_query_plan(model.objects.all(), serializer_class)))
+        return select, prefetch
+
+
+def apply_query_plan(queryset, serializer_class):
+    """
+    Apply the query plan declared by serializer_class to queryset.
+    """
+    select, prefetch = serializer_class.query_plan()
+    return queryset.select_related(*select).prefetch_related(*prefetch)
+
+
+def serializer_profile(request, profiles, default='full'):
+    """
+    Pick a serializer from {name: serializer} by the `fields` query parameter, falling back
+    to the view's default profile. Returns (name, serializer).
+    """
+    name = request.GET.get('fields', default)
+    if name not in profiles:
+        name = default
+    return name, profiles[name]
@@ -40,6 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework_simplejwt',
     'products',
@@ -93,6 +94,7 @@ FRONTEND_URL = 'http://localhost:3000'  # Replace with your actual frontend URL
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
+    'core.middleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -138,9 +140,36 @@ CACHES = {
     }
 }
 
+# In-process L1 in front of the default cache for reference data (core.cache.two_tier),
+# kept coherent across workers by Redis pub/sub. 0 entries disables it.
+L1_CACHE_MAX_ENTRIES = 1000
+L1_CACHE_TTL = 60
+
+# Responses below this many bytes are not compressed (core.middleware.CompressionMiddleware)
+COMPRESSION_MIN_SIZE = 1024
+
+# Chat messages are saved in batches by chat.buffer, at most this long after they were sent
+CHAT_FLUSH_INTERVAL_MS = 200
+CHAT_FLUSH_BATCH_SIZE = 100
+# Messages sent to a chat connection when it opens, from a Redis list per room (chat.history)
+CHAT_HISTORY_SIZE = 50
+# Presence expires this many seconds after a connection's last heartbeat (chat.presence);
+# typing and read events are sent at most once per interval per connection (chat.throttle)
+CHAT_PRESENCE_TTL = 60
+CHAT_TYPING_INTERVAL = 2
+CHAT_READ_INTERVAL = 1
+
 # Set up cache timeout (optional)
 CACHE_TTL = 60 * 1  # 15 minutes
 
+# Where live carts are kept: 'database' (Cart/CartItem rows) or 'redis' (a hash per user,
+# written behind to the database by the flush_carts command and at checkout)
+CART_STORAGE = 'database'
+CART_REDIS_TTL = 60 * 60 * 24 * 30  # 30 days
+
+# How long checkout holds stock for an unpaid order before it is released
+STOCK_RESERVATION_TTL = 60 * 15  # 15 minutes
+
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
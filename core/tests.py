@@ -0,0 +1,148 @@
+import threading
+import time
+from unittest import mock
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from . import cache as cache_module
+from .cache import LOCK_SUFFIX, LocalCache, _connect, acache_aside, atwo_tier, cache_aside, invalidate, two_tier
+
+
+class LocalCacheMixin:
+    """
+    Serve the L1 from a fresh LocalCache, as if the invalidation listener were subscribed.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.local = LocalCache(100, 60)
+        for target, value in (('_local', self.local), ('_local_cache', lambda: self.local)):
+            patcher = mock.patch.object(cache_module, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class CacheAsideTests(SimpleTestCase):
+    key = 'cache_aside_test'
+
+    def setUp(self):
+        self.computed = []
+        self.addCleanup(cache.delete_many, [self.key, self.key + LOCK_SUFFIX])
+
+    def compute(self, value):
+        def compute():
+            self.computed.append(value)
+            return value
+        return compute
+
+    def expire(self, value, delta=0):
+        # As stored by an earlier request, now past its expiry but within the stale timeout
+        cache.set(self.key, (value, time.time() - 1, delta), timeout=60)
+
+    def test_computes_on_a_miss_then_serves_the_hit(self):
+        self.assertEqual(cache_aside(self.key, self.compute('a'), timeout=60), 'a')
+        self.assertEqual(cache_aside(self.key, self.compute('b'), timeout=60), 'a')
+        self.assertEqual(self.computed, ['a'])
+
+    def test_refreshes_an_expired_value(self):
+        self.expire('old')
+        self.assertEqual(cache_aside(self.key, self.compute('new'), timeout=60), 'new')
+        self.assertEqual(cache.get(self.key)[0], 'new')
+
+    def test_serves_stale_while_another_worker_refreshes(self):
+        self.expire('old')
+        lock = cache.lock(self.key + LOCK_SUFFIX, timeout=10)
+        lock.acquire()
+        self.addCleanup(lock.release)
+        self.assertEqual(cache_aside(self.key, self.compute('new'), timeout=60), 'old')
+        self.assertEqual(self.computed, [])
+
+    def test_refreshes_early_as_expiry_nears(self):
+        # Due in a second, and computing it took a minute
+        cache.set(self.key, ('old', time.time() + 1, 60), timeout=60)
+        with mock.patch.object(cache_module.random, 'random', return_value=0.5):
+            self.assertEqual(cache_aside(self.key, self.compute('new'), timeout=60, beta=0), 'old')
+            self.assertEqual(cache_aside(self.key, self.compute('new'), timeout=60), 'new')
+
+    def test_single_flight_on_a_miss(self):
+        locked = threading.Event()
+
+        def other_worker():
+            with cache.lock(self.key + LOCK_SUFFIX, timeout=10):
+                locked.set()
+                time.sleep(0.2)
+                cache.set(self.key, ('theirs', time.time() + 60, 0), timeout=60)
+
+        thread = threading.Thread(target=other_worker)
+        thread.start()
+        locked.wait()
+        self.assertEqual(cache_aside(self.key, self.compute('mine'), timeout=60), 'theirs')
+        thread.join()
+        self.assertEqual(self.computed, [])
+
+    async def test_async_shares_entries_and_locks(self):
+        async def compute():
+            self.computed.append('new')
+            return 'new'
+
+        self.expire('old')
+        lock = cache.lock(self.key + LOCK_SUFFIX, timeout=10)
+        lock.acquire()
+        self.assertEqual(await acache_aside(self.key, compute, timeout=60), 'old')
+        lock.release()
+        self.assertEqual(await acache_aside(self.key, compute, timeout=60), 'new')
+        self.assertEqual(cache_aside(self.key, self.compute('sync'), timeout=60), 'new')
+        self.assertEqual(self.computed, ['new'])
+
+
+class TwoTierTests(LocalCacheMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(cache.delete, 'two_tier_test')
+
+    def test_serves_from_l1_until_invalidated(self):
+        self.assertEqual(two_tier('two_tier_test', lambda: 1, timeout=60), 1)
+        self.assertEqual(two_tier('two_tier_test', lambda: 2, timeout=60), 1)
+        invalidate('two_tier_test')
+        self.assertEqual(two_tier('two_tier_test', lambda: 3, timeout=60), 3)
+
+    def test_invalidation_during_read_is_not_undone(self):
+        def compute():
+            # A writer invalidates the key while this reader is computing the old value
+            invalidate('two_tier_test')
+            return 'old'
+
+        self.assertEqual(two_tier('two_tier_test', compute, timeout=60), 'old')
+        self.assertEqual(self.local.get('two_tier_test'), (False, None))
+
+    async def test_async_invalidation_during_read_is_not_undone(self):
+        async def compute():
+            invalidate('two_tier_test')
+            return 'old'
+
+        async def acache_aside(key, compute, timeout):
+            return await compute()
+
+        with mock.patch.object(cache_module, 'acache_aside', acache_aside):
+            self.assertEqual(await atwo_tier('two_tier_test', compute, timeout=60), 'old')
+        self.assertEqual(self.local.get('two_tier_test'), (False, None))
+
+
+class ConnectTests(SimpleTestCase):
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': ['redis://cache-1:6380/2', 'redis://cache-2:6380/2'],
+        'OPTIONS': {
+            'PASSWORD': 'secret',
+            'SOCKET_TIMEOUT': 5,
+            'CONNECTION_POOL_KWARGS': {'max_connections': 7, 'connection_class': object},
+        },
+    }})
+    def test_uses_the_default_cache_options(self):
+        pool = _connect().connection_pool
+        self.assertEqual(pool.max_connections, 7)
+        self.assertEqual(pool.connection_kwargs['host'], 'cache-1')
+        self.assertEqual(pool.connection_kwargs['port'], 6380)
+        self.assertEqual(pool.connection_kwargs['db'], 2)
+        self.assertEqual(pool.connection_kwargs['password'], 'secret')
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 5)
+        self.assertIsNot(pool.connection_class, object)
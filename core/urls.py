@@ -18,6 +18,7 @@ from django.contrib import admin
 from django.urls import path,include
 from django.conf.urls.static import static
 from django.conf import settings
+from .views import cache_stats_view
 
 
 urlpatterns = [
@@ -27,4 +28,5 @@ urlpatterns = [
     path('api/cart/', include('cart.urls')),
     path('api/checkout/', include('orders.urls')),
     path('api/chat/', include('chat.urls')),
+    path('api/cache-stats', cache_stats_view, name='cache_stats'),
 ]+ static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
@@ -0,0 +1,14 @@
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from .cache import cache_stats
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def cache_stats_view(request):
+    """
+    Hit/miss counters of the L1 (in-process) and L2 (Redis) cache tiers. The counters are
+    per process, so this reports the worker that served the request.
+    """
+    return Response(cache_stats())
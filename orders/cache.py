@@ -0,0 +1,2 @@
+# Reference data served through core.cache.two_tier, invalidated by orders.signals
+SHIPPING_METHODS_CACHE_KEY = 'shipping_methods'
@@ -0,0 +1,133 @@
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from django.utils import timezone
+from .models import Order, OrderItem, Payment
+
+# Finance exports: one table per kind, read with a server-side cursor (.iterator() on
+# PostgreSQL) as flat value rows joined like select_related would, so memory stays at
+# one chunk of rows however long the range is.
+# kind: (model, date field the range applies to, [(column, lookup)])
+EXPORTS = {
+    'orders': (Order, 'created_at', [
+        ('order_id', 'id'),
+        ('created_at', 'created_at'),
+        ('updated_at', 'updated_at'),
+        ('user_email', 'user__email'),
+        ('status', 'status'),
+        ('payment_status', 'payment_status'),
+        ('payment_method', 'payment_method'),
+        ('total_price', 'total_price'),
+        ('shipping_city', 'shipping_address__city'),
+        ('shipping_state', 'shipping_address__state'),
+        ('shipping_postal_code', 'shipping_address__postal_code'),
+    ]),
+    'items': (OrderItem, 'order__created_at', [
+        ('order_item_id', 'id'),
+        ('order_id', 'order_id'),
+        ('order_created_at', 'order__created_at'),
+        ('user_email', 'order__user__email'),
+        ('product_id', 'product_id'),
+        ('product_name', 'product__name'),
+        ('variant_id', 'variant_id'),
+        ('variant_sku', 'variant__sku'),
+        ('quantity', 'quantity'),
+        ('price', 'price'),
+    ]),
+    'payments': (Payment, 'payment_date', [
+        ('payment_id', 'id'),
+        ('order_id', 'order_id'),
+        ('user_email', 'order__user__email'),
+        ('payment_method', 'payment_method'),
+        ('amount', 'amount'),
+        ('status', 'status'),
+        ('payment_date', 'payment_date'),
+        ('transaction_id', 'transaction_id'),
+    ]),
+}
+FORMATS = ('csv', 'jsonl')
+CHUNK_SIZE = 2000
+# Rows written per piece of output
+FLUSH_ROWS = 500
+
+
+def day_range(since=None, until=None):
+    """
+    Aware datetimes for [since, until) given as dates; defaults to yesterday.
+    """
+    if since is None:
+        since = timezone.localdate() - timedelta(days=1)
+    if until is None:
+        until = since + timedelta(days=1)
+    start = timezone.make_aware(datetime.combine(since, time.min))
+    end = timezone.make_aware(datetime.combine(until, time.min))
+    return start, end
+
+
+def export_rows(kind, start, end, chunk_size=CHUNK_SIZE):
+    """
+    The header and an iterator over the value rows of kind with its date in [start, end).
+    """
+    model, date_field, columns = EXPORTS[kind]
+    rows = model.objects.filter(**{f'{date_field}__gte': start, f'{date_field}__lt': end}) \
+                        .order_by('id').values_list(*[lookup for _, lookup in columns])
+    return [name for name, _ in columns], rows.iterator(chunk_size=chunk_size)
+
+
+def _value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def _iter_csv(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for index, row in enumerate(rows, start=1):
+        writer.writerow([_value(value) for value in row])
+        if index % FLUSH_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _iter_jsonl(header, rows):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(header, map(_value, row))), ensure_ascii=False))
+        if len(lines) == FLUSH_ROWS:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(kind, start, end, file_format='csv', compress=False, chunk_size=CHUNK_SIZE):
+    """
+    The export as an iterator of bytes, CSV with a header row or JSON lines, optionally gzipped.
+    """
+    header, rows = export_rows(kind, start, end, chunk_size)
+    text = _iter_csv(header, rows) if file_format == 'csv' else _iter_jsonl(header, rows)
+    chunks = (piece.encode() for piece in text if piece)
+    return _gzip(chunks) if compress else chunks
+
+
+def export_filename(kind, start, end, file_format, compress):
+    name = f"{kind}_{start.date().isoformat()}_{end.date().isoformat()}.{file_format}"
+    return name + '.gz' if compress else name
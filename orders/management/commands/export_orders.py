@@ -0,0 +1,51 @@
+import sys
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from orders.exports import CHUNK_SIZE, EXPORTS, FORMATS, day_range, export
+
+
+def _date(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f"Invalid date {value!r}, expected YYYY-MM-DD")
+
+
+class Command(BaseCommand):
+    help = "Export orders, order items or payments created in a date range as CSV or JSONL (run daily for finance)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', choices=tuple(EXPORTS), default='orders', help="Rows to export")
+        parser.add_argument('--since', help="First day included, YYYY-MM-DD (default: yesterday)")
+        parser.add_argument('--until', help="First day excluded, YYYY-MM-DD (default: the day after --since)")
+        parser.add_argument('--format', choices=FORMATS, default='csv', help="Output format")
+        parser.add_argument('--gzip', action='store_true', help="Gzip the output (implied by an --output ending in .gz)")
+        parser.add_argument('--output', help="File to write (default: standard output)")
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="Rows fetched per round trip")
+
+    def handle(self, *args, **options):
+        since = _date(options['since']) if options['since'] else None
+        until = _date(options['until']) if options['until'] else None
+        start, end = day_range(since, until)
+        if end <= start:
+            raise CommandError("--until must be after --since")
+
+        output = options['output']
+        compress = options['gzip'] or bool(output and output.endswith('.gz'))
+        chunks = export(options['kind'], start, end, options['format'], compress, options['chunk_size'])
+
+        written = 0
+        handle = open(output, 'wb') if output else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                handle.write(chunk)
+                written += len(chunk)
+        finally:
+            if output:
+                handle.close()
+            else:
+                handle.flush()
+        if output:
+            self.stderr.write(self.style.SUCCESS(
+                f"Exported {options['kind']} from {start.date()} to {end.date()} ({written} bytes) to {output}"
+            ))
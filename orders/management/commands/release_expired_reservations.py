@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from orders.reservations import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = "Return the stock of checkout reservations whose hold expired before payment (run periodically)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Reservations released per transaction")
+
+    def handle(self, *args, **options):
+        released = release_expired_reservations(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Released {released} expired reservations"))
@@ -1,6 +1,6 @@
 from django.db import models
 from accounts.models import User,Address,ShippingAddress
-from products.models import Product,ProductVariant
+from products.models import Product,ProductVariant,Stock
 # Create your models here.
 
 class Order(models.Model):
@@ -43,4 +43,32 @@ class ShippingMethod(models.Model):
     estimated_delivery_days = models.IntegerField()
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+class StockReservation(models.Model):
+    """
+    Stock held for an order line until it is paid for or the hold expires, see orders.reservations.
+    """
+    order = models.ForeignKey(Order, related_name='reservations', on_delete=models.CASCADE)
+    variant = models.ForeignKey(ProductVariant, related_name='reservations', on_delete=models.CASCADE)
+    quantity = models.IntegerField()
+    status = models.CharField(max_length=20, choices=(('Held','Held'),('Committed','Committed'),('Released','Released')), default='Held')
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'expires_at'])]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.variant_id} for order {self.order_id} ({self.status})"
+
+class StockAllocation(models.Model):
+    """
+    The part of a reservation taken from one warehouse's Stock row.
+    """
+    reservation = models.ForeignKey(StockReservation, related_name='allocations', on_delete=models.CASCADE)
+    stock = models.ForeignKey(Stock, related_name='allocations', on_delete=models.CASCADE)
+    quantity = models.IntegerField()
+
+    def __str__(self):
+        return f"{self.quantity} from {self.stock_id}"
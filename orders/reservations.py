@@ -0,0 +1,192 @@
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+from products.models import ProductVariant, Stock
+from products.signals import (invalidate_catalog, invalidate_fragments, invalidate_stock, product_category_ids,
+                             refacet_categories)
+from .models import StockReservation, StockAllocation
+
+
+class InsufficientStock(Exception):
+    def __init__(self, variant_id):
+        super().__init__(f"Insufficient stock for variant {variant_id}")
+        self.variant_id = variant_id
+
+
+class InvalidQuantity(ValueError):
+    def __init__(self, variant_id, quantity):
+        super().__init__(f"Invalid quantity {quantity} for variant {variant_id}")
+        self.variant_id = variant_id
+        self.quantity = quantity
+
+
+def _after_stock_change(variant_ids, crossed_zero=()):
+    """
+    Stock moved through .update(), which skips signals. Only the variants' fragments are
+    retired: cached listing pages hold variant ids and render stock from the fragments, so
+    they stay valid through a sale. Variants in crossed_zero sold out or came back, which
+    changes the in_stock listings and facet counts, so their categories are invalidated and
+    refaceted too.
+    """
+    invalidate_fragments(variant_ids)
+    invalidate_stock()
+    if crossed_zero:
+        category_ids = list(product_category_ids(variants__id__in=crossed_zero))
+        invalidate_catalog(category_ids)
+        refacet_categories(category_ids)
+
+
+def _decrement(model, field, amounts):
+    """
+    Apply {pk: amount} to model.field with a single UPDATE ... SET field = field - CASE pk ... END.
+    """
+    if not amounts:
+        return
+    delta = Case(*[When(pk=pk, then=Value(amount)) for pk, amount in amounts.items()], output_field=IntegerField())
+    model.objects.filter(pk__in=list(amounts)).update(**{field: F(field) - delta})
+
+
+def reserve_stock(order, lines, ttl=None):
+    """
+    Reserve stock for (variant_id, quantity) lines of an order. Must run inside transaction.atomic().
+
+    Rows are locked in one global order so concurrent checkouts cannot deadlock: first every
+    variant, by id, then every warehouse Stock row of the products involved, by id, each with
+    a single SELECT ... FOR UPDATE. Warehouse stock is taken from the fullest warehouse first,
+    spilling over into the next. Products without any Stock rows are only limited by
+    ProductVariant.total_stock. The query count does not depend on the number of lines.
+
+    Raises InsufficientStock, leaving the transaction to be rolled back, when a line cannot be met,
+    and InvalidQuantity, before locking anything, for a line that is not a positive quantity.
+    """
+    ttl = settings.STOCK_RESERVATION_TTL if ttl is None else ttl
+    quantities = defaultdict(int)
+    for variant_id, quantity in lines:
+        if quantity <= 0:
+            raise InvalidQuantity(variant_id, quantity)
+        quantities[variant_id] += quantity
+    variant_ids = sorted(quantities)
+
+    variants = ProductVariant.objects.select_for_update().filter(pk__in=variant_ids).order_by('id') \
+                                     .values_list('id', 'product_id', 'total_stock')
+    product_by_variant = {}
+    sold_out = []
+    for variant_id, product_id, total_stock in variants:
+        if total_stock < quantities[variant_id]:
+            raise InsufficientStock(variant_id)
+        product_by_variant[variant_id] = product_id
+        if total_stock == quantities[variant_id]:
+            sold_out.append(variant_id)
+    for variant_id in variant_ids:
+        if variant_id not in product_by_variant:
+            raise InsufficientStock(variant_id)
+
+    stock_by_product = defaultdict(list)
+    for stock in Stock.objects.select_for_update().filter(product_id__in=set(product_by_variant.values())).order_by('id'):
+        stock_by_product[stock.product_id].append(stock)
+
+    taken = defaultdict(int)
+    allocations = {}
+    for variant_id in variant_ids:
+        stocks = stock_by_product.get(product_by_variant[variant_id])
+        if not stocks:
+            continue
+        needed = quantities[variant_id]
+        allocations[variant_id] = []
+        for stock in sorted(stocks, key=lambda s: (-(s.quantity - taken[s.id]), s.id)):
+            available = stock.quantity - taken[stock.id]
+            if needed <= 0 or available <= 0:
+                break
+            quantity = min(needed, available)
+            taken[stock.id] += quantity
+            allocations[variant_id].append((stock.id, quantity))
+            needed -= quantity
+        if needed > 0:
+            raise InsufficientStock(variant_id)
+
+    _decrement(ProductVariant, 'total_stock', quantities)
+    _decrement(Stock, 'quantity', taken)
+
+    expires_at = timezone.now() + timedelta(seconds=ttl)
+    reservations = StockReservation.objects.bulk_create([
+        StockReservation(order=order, variant_id=variant_id, quantity=quantities[variant_id], expires_at=expires_at)
+        for variant_id in variant_ids
+    ])
+    StockAllocation.objects.bulk_create([
+        StockAllocation(reservation=reservation, stock_id=stock_id, quantity=quantity)
+        for reservation in reservations
+        for stock_id, quantity in allocations.get(reservation.variant_id, [])
+    ])
+
+    _after_stock_change(variant_ids, sold_out)
+    return reservations
+
+
+def release_reservations(reservation_ids):
+    """
+    Put the stock of held reservations back and mark them released.
+    Reservations already being released or committed by someone else are skipped.
+    Returns the number of reservations released.
+    """
+    with transaction.atomic():
+        reservations = list(
+            StockReservation.objects.select_for_update(skip_locked=True)
+                                    .filter(pk__in=list(reservation_ids), status='Held').order_by('id')
+        )
+        if not reservations:
+            return 0
+
+        quantities = defaultdict(int)
+        for reservation in reservations:
+            quantities[reservation.variant_id] += reservation.quantity
+        returned = defaultdict(int)
+        for stock_id, quantity in StockAllocation.objects.filter(reservation__in=reservations).values_list('stock_id', 'quantity'):
+            returned[stock_id] += quantity
+
+        # Same lock order as reserve_stock: variants by id, then warehouse stock by id
+        restocked = [
+            variant_id for variant_id, total_stock in
+            ProductVariant.objects.select_for_update().filter(pk__in=list(quantities)).order_by('id').values_list('id', 'total_stock')
+            if total_stock <= 0
+        ]
+        list(Stock.objects.select_for_update().filter(pk__in=list(returned)).order_by('id').values_list('id'))
+        _decrement(ProductVariant, 'total_stock', {pk: -amount for pk, amount in quantities.items()})
+        _decrement(Stock, 'quantity', {pk: -amount for pk, amount in returned.items()})
+
+        StockReservation.objects.filter(pk__in=[r.pk for r in reservations]).update(status='Released')
+        _after_stock_change(list(quantities), restocked)
+    return len(reservations)
+
+
+def release_expired_reservations(batch_size=500):
+    """
+    Release every held reservation past its expiry, in batches. Returns the number released.
+    """
+    released = 0
+    while True:
+        expired = list(
+            StockReservation.objects.filter(status='Held', expires_at__lte=timezone.now())
+                                    .order_by('id').values_list('id', flat=True)[:batch_size]
+        )
+        if not expired:
+            return released
+        count = release_reservations(expired)
+        if not count:
+            # The whole batch is locked by concurrent releasers, leave it to them
+            return released
+        released += count
+
+
+def commit_reservations(order):
+    """
+    Turn an order's held stock into a sale once it is paid. Lines whose hold already expired
+    are reserved again. Must run inside transaction.atomic(); raises InsufficientStock.
+    """
+    reservations = list(StockReservation.objects.select_for_update().filter(order=order).exclude(status='Committed'))
+    expired = [(r.variant_id, r.quantity) for r in reservations if r.status == 'Released']
+    if expired:
+        reserve_stock(order, expired)
+    StockReservation.objects.filter(order=order, status='Held').update(status='Committed')
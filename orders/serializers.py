@@ -1,20 +1,25 @@
 from rest_framework import serializers
 from .models import Order, OrderItem, Payment
 from accounts.models import ShippingAddress
+from core.serializers import QueryPlanMixin
+
+class OrderItemSerializer(QueryPlanMixin, serializers.ModelSerializer):
+    plan_select_related = ('product', 'variant')
 
-class OrderItemSerializer(serializers.ModelSerializer):
     product_name = serializers.CharField(source='product.name', read_only=True)
     variant_name = serializers.CharField(source='variant.variant_name', read_only=True)
     class Meta:
         model = OrderItem
         fields = ['product_name', 'variant_name', 'quantity', 'price']
 
-class PaymentSerializer(serializers.ModelSerializer):
+class PaymentSerializer(QueryPlanMixin, serializers.ModelSerializer):
     class Meta:
         model = Payment
         fields = ['payment_method', 'amount', 'status', 'payment_date', 'transaction_id']
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(QueryPlanMixin, serializers.ModelSerializer):
+    plan_prefetch_nested = {'items': OrderItemSerializer, 'payments': PaymentSerializer}
+
     items = OrderItemSerializer(many=True, read_only=True)
     payments = PaymentSerializer(many=True, read_only=True)
 
@@ -0,0 +1,12 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from core.cache import invalidate
+from .cache import SHIPPING_METHODS_CACHE_KEY
+from .models import ShippingMethod
+
+
+@receiver([post_save, post_delete], sender=ShippingMethod)
+def shipping_methods_changed(sender, **kwargs):
+    # Served from every process's L1, so drop it everywhere after commit
+    transaction.on_commit(lambda: invalidate(SHIPPING_METHODS_CACHE_KEY))
@@ -1,3 +1,337 @@
-from django.test import TestCase
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django_redis import get_redis_connection
+from rest_framework_simplejwt.tokens import AccessToken
+from accounts.models import User
+from cart.models import Cart, CartItem
+from products.cache import CATALOG_GENERATION_KEY, CATEGORY_GENERATION_KEY, STOCK_GENERATION_KEY
+from products.fragments import VERSION_KEY, bump_fragment_epoch
+from products.models import Category, Product, ProductVariant, Stock, Varient_Type, Varient_values, Warehouse
+from .models import Order, OrderItem, Payment, StockReservation
+from core.pagination import encode_cursor
+from .reservations import release_reservations, reserve_stock, InsufficientStock, InvalidQuantity
 
-# Create your tests here.
+
+def auth_headers(user):
+    return {'Authorization': f'Bearer {AccessToken.for_user(user)}'}
+
+
+def make_variants(count, stock=100, warehouses=()):
+    """
+    count variants of one product with stock each, the product's warehouse stock split over
+    warehouses given as quantities.
+    """
+    category = Category.objects.create(name='Shoes')
+    color = Varient_values.objects.create(varient_type=Varient_Type.objects.create(name='Color'), value='Red')
+    product = Product.objects.create(name='Runner', description='Running shoe', price=Decimal('10.00'),
+                                     sku='RUN', total_stock=stock * count, category=category)
+    for index, quantity in enumerate(warehouses):
+        warehouse = Warehouse.objects.create(name=f'Warehouse {index}', location='Pune')
+        Stock.objects.create(product=product, warehouse=warehouse, quantity=quantity)
+    return [
+        ProductVariant.objects.create(product=product, primary_varient=color, variant_name=f'Size {index}',
+                                      price=Decimal('10.00'), discount_price=Decimal('8.00'),
+                                      sku=f'RUN-{index}', total_stock=stock)
+        for index in range(count)
+    ]
+
+
+class ExportOrdersTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('admin@example.com', 'secret', is_staff=True)
+        yesterday = timezone.now() - timedelta(days=1)
+        orders = Order.objects.bulk_create(
+            Order(user=cls.admin, total_price=Decimal('10.00')) for _ in range(25)
+        )
+        Order.objects.filter(id__in=[order.id for order in orders]).update(created_at=yesterday)
+        cls.url = reverse('export_orders')
+
+    async def test_streams_under_asgi(self):
+        with mock.patch('orders.exports.FLUSH_ROWS', 10):
+            response = await self.async_client.get(self.url, headers=auth_headers(self.admin))
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            self.assertTrue(response.is_async)
+            chunks = [chunk async for chunk in response.streaming_content]
+        self.assertEqual(len(chunks), 3)
+        rows = b''.join(chunks).decode().splitlines()
+        self.assertEqual(rows[0].split(',')[0], 'order_id')
+        self.assertEqual(len(rows), 26)
+
+    def test_streams_under_wsgi(self):
+        response = self.client.get(self.url, {'file_format': 'jsonl'}, headers=auth_headers(self.admin))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertFalse(response.is_async)
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 25)
+
+    def test_requires_staff(self):
+        user = User.objects.create_user('customer@example.com', 'secret')
+        response = self.client.get(self.url, headers=auth_headers(user))
+        self.assertEqual(response.status_code, 403)
+
+
+class AllOrdersTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer@example.com', 'secret')
+        cls.variants = make_variants(12)
+
+    def place_order(self, variants):
+        order = Order.objects.create(user=self.user, total_price=Decimal('10.00') * len(variants))
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, product=variant.product, variant=variant, quantity=1, price=variant.price)
+            for variant in variants
+        )
+        Payment.objects.create(order=order, payment_method='card', amount=order.total_price, status='Paid',
+                               transaction_id=f'txn-{order.id}')
+
+    def get_orders(self, params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('all_orders'), params, headers=auth_headers(self.user))
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()['orders']
+
+    def test_query_count_does_not_grow_with_items(self):
+        for params in ({}, {'cursor': ''}):
+            with self.subTest(params=params):
+                Order.objects.all().delete()
+                self.place_order(self.variants[:1])
+                baseline, _ = self.get_orders(params)
+                self.place_order(self.variants[:3])
+                self.place_order(self.variants)
+                count, orders = self.get_orders(params)
+                self.assertEqual(count, baseline)
+                self.assertEqual([len(order['items']) for order in orders], [12, 3, 1])
+                self.assertEqual({item['product_name'] for item in orders[0]['items']}, {'Runner'})
+                self.assertIn('Size 0', [item['variant_name'] for item in orders[0]['items']])
+
+
+class AllOrdersConditionalTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer@example.com', 'secret')
+        cls.other = User.objects.create_user('other@example.com', 'secret')
+        Order.objects.create(user=cls.user, total_price=Decimal('10.00'))
+
+    def get_orders(self, user, etag=None):
+        headers = {**auth_headers(user), **({'If-None-Match': etag} if etag else {})}
+        return self.client.get(reverse('all_orders'), headers=headers)
+
+    def test_revalidates_until_an_order_changes(self):
+        response = self.get_orders(self.user)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        self.assertIn('Authorization', response['Vary'])
+        etag = response['ETag']
+        self.assertEqual(self.get_orders(self.user, etag).status_code, 304)
+        # Every user has their own
+        self.assertEqual(self.get_orders(self.other, etag).status_code, 200)
+
+        order = Order.objects.get(user=self.user)
+        order.status = 'Shipped'
+        order.save()
+        response = self.get_orders(self.user, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        Order.objects.create(user=self.user, total_price=Decimal('5.00'))
+        self.assertEqual(self.get_orders(self.user, response['ETag']).status_code, 200)
+
+
+class AllOrdersCursorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer@example.com', 'secret')
+        orders = Order.objects.bulk_create(Order(user=cls.user, total_price=Decimal('10.00')) for _ in range(23))
+        # Ties on created_at, the first sort key, across page boundaries
+        now = timezone.now()
+        for index, order in enumerate(orders):
+            Order.objects.filter(pk=order.pk).update(created_at=now - timedelta(minutes=index // 4))
+
+    def get_page(self, cursor):
+        return self.client.get(reverse('all_orders'), {'cursor': cursor}, headers=auth_headers(self.user))
+
+    def test_walks_every_order_once(self):
+        seen, cursor, pages = [], '', 0
+        while cursor is not None:
+            response = self.get_page(cursor)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            seen += [order['id'] for order in data['orders']]
+            cursor, pages = data['next_cursor'], pages + 1
+        self.assertEqual(pages, 3)
+        self.assertEqual(seen, list(Order.objects.order_by('-created_at', '-id').values_list('id', flat=True)))
+
+    def test_rejects_tampered_cursors(self):
+        for cursor in ('not a cursor', encode_cursor(['x', {}]), encode_cursor(['2024-01-01T00:00:00', 'x']),
+                       encode_cursor([None, 1]), encode_cursor([1])):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.get_page(cursor).status_code, 400)
+
+
+class CheckoutTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer@example.com', 'secret')
+        cls.variants = make_variants(12, warehouses=(500, 700))
+        cls.address = cls.user.shipping_addresses.create(address='1 Main Road', city='Pune', state='MH',
+                                                         postal_code='411001')
+
+    def fill_cart(self, variants):
+        cart, _ = Cart.objects.get_or_create(user=self.user)
+        for variant in variants:
+            item = CartItem(cart=cart, variant=variant, quantity=2)
+            item.price_line(variant)
+            item.save()
+        Cart.refresh_totals([cart.id])
+
+    def checkout(self):
+        return self.client.post(reverse('checkout'), {'shipping_address_id': self.address.id, 'payment_method': 'card'},
+                                headers=auth_headers(self.user), content_type='application/json')
+
+    def test_query_count_does_not_depend_on_cart_size(self):
+        for size in (1, 12):
+            with self.subTest(size=size):
+                self.fill_cart(self.variants[:size])
+                # 13 queries plus the SAVEPOINT/RELEASE pair transaction.atomic() issues inside a TestCase
+                with self.assertNumQueries(15):
+                    response = self.checkout()
+                self.assertEqual(response.status_code, 201)
+                order = Order.objects.get(id=response.json()['order_id'])
+                self.assertEqual(order.items.count(), size)
+                self.assertEqual(order.total_price, Decimal('20.00') * size)
+                self.assertFalse(CartItem.objects.exists())
+
+
+class ReserveStockTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer@example.com', 'secret')
+        cls.variant, = make_variants(1, stock=10)
+
+    def test_rejects_non_positive_quantities(self):
+        order = Order.objects.create(user=self.user, total_price=Decimal('0.00'))
+        for quantity in (0, -4):
+            with self.subTest(quantity=quantity), self.assertRaises(InvalidQuantity):
+                with transaction.atomic():
+                    reserve_stock(order, [(self.variant.id, quantity)])
+        self.variant.refresh_from_db()
+        self.assertEqual(self.variant.total_stock, 10)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_checkout_rejects_negative_cart_line(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, variant=self.variant, quantity=-4, price=Decimal('10.00'),
+                                cart_total=Decimal('-40.00'))
+        address = self.user.shipping_addresses.create(address='1 Main Road', city='Pune', state='MH', postal_code='411001')
+        response = self.client.post(reverse('checkout'), {'shipping_address_id': address.id},
+                                    headers=auth_headers(self.user), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+        self.variant.refresh_from_db()
+        self.assertEqual(self.variant.total_stock, 10)
+
+
+class StockInvalidationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer@example.com', 'secret')
+        cls.variant, cls.other = make_variants(2, stock=3)
+        cls.generation_keys = [CATALOG_GENERATION_KEY, CATEGORY_GENERATION_KEY.format(cls.variant.product.category_id),
+                               STOCK_GENERATION_KEY]
+
+    def setUp(self):
+        cache.set_many({key: 1 for key in self.generation_keys}, timeout=None)
+        self.addCleanup(cache.delete_many, self.generation_keys)
+        # Ids are reused across tests once their rows are rolled back; retire their fragments
+        bump_fragment_epoch()
+
+    def state(self):
+        redis = get_redis_connection('default')
+        catalog, category, stock = (cache.get(key) for key in self.generation_keys)
+        versions = [redis.get(VERSION_KEY.format(variant.id)) for variant in (self.variant, self.other)]
+        return {'catalog': catalog, 'category': category, 'stock': stock, 'versions': versions}
+
+    def reserve(self, quantity):
+        with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            order = Order.objects.create(user=self.user, total_price=Decimal('10.00') * quantity)
+            return reserve_stock(order, [(self.variant.id, quantity)])
+
+    def test_sale_only_retires_the_variant_fragment(self):
+        before = self.state()
+        with mock.patch('products.facets.rebuild_category_facets') as rebuild:
+            self.reserve(1)
+        after = self.state()
+        self.assertEqual((after['catalog'], after['category']), (1, 1))
+        self.assertEqual(after['stock'], 2)
+        self.assertNotEqual(after['versions'][0], before['versions'][0])
+        self.assertEqual(after['versions'][1], before['versions'][1])
+        rebuild.assert_not_called()
+
+    def test_selling_out_and_restocking_invalidate_the_category(self):
+        with mock.patch('products.facets.rebuild_category_facets') as rebuild:
+            reservations = self.reserve(3)
+            self.assertEqual(self.state()['catalog'], 2)
+            self.assertEqual(self.state()['category'], 2)
+            with self.captureOnCommitCallbacks(execute=True):
+                release_reservations([reservation.id for reservation in reservations])
+            self.assertEqual(self.state()['category'], 3)
+        self.assertEqual(rebuild.call_count, 2)
+
+    def test_detail_shows_the_new_stock(self):
+        url = reverse('product_detail', args=[self.variant.slug])
+        self.assertEqual(self.client.get(url).json()['total_stock'], 3)
+        etag = self.client.get(url)['ETag']
+        self.reserve(1)
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['total_stock'], 2)
+        self.assertEqual(cache.get(CATALOG_GENERATION_KEY), 1)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'needs row locks (SELECT ... FOR UPDATE)')
+class ReserveStockConcurrencyTests(TransactionTestCase):
+    THREADS = 12
+
+    def test_concurrent_checkouts_never_oversell(self):
+        user = User.objects.create_user('customer@example.com', 'secret')
+        # 3 units per variant, 5 in the warehouses for the whole product: stock runs out mid-way
+        variants = make_variants(2, stock=3, warehouses=(3, 2))
+        barrier = threading.Barrier(self.THREADS)
+        outcomes = []
+
+        def checkout(index):
+            # Each order takes both variants, in opposite orders, to provoke lock-order deadlocks
+            lines = [(variant.id, 1) for variant in (variants if index % 2 else variants[::-1])]
+            try:
+                barrier.wait()
+                with transaction.atomic():
+                    order = Order.objects.create(user=user, total_price=Decimal('20.00'))
+                    reserve_stock(order, lines)
+                outcomes.append(True)
+            except InsufficientStock:
+                outcomes.append(False)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout, args=(index,)) for index in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(outcomes), self.THREADS)
+        # The warehouses hold 5 units for two per order: 2 orders fit
+        self.assertEqual(outcomes.count(True), 2)
+        self.assertEqual(sorted(Stock.objects.values_list('quantity', flat=True)), [0, 1])
+        self.assertEqual(list(ProductVariant.objects.order_by('id').values_list('total_stock', flat=True)), [1, 1])
+        self.assertEqual(StockReservation.objects.count(), 4)
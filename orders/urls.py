@@ -7,6 +7,7 @@ urlpatterns = [
     path('payment/', views.process_payment, name='process_payment'),
     path('order-view/<int:order_id>/', views.order_detail, name='order_detail'),
     path('orders/', views.all_orders, name='all_orders'),
+    path('export/', views.export_orders, name='export_orders'),
     
     # Shipping methods
     path('shipping-methods/', views.shipping_methods, name='shipping_methods'),
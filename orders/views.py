@@ -1,13 +1,25 @@
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework import status,generics
+from datetime import date
 from decimal import Decimal
 from django.db import transaction
+from django.http import StreamingHttpResponse
 from . models import *
 from cart.models import *
+from cart import store as cart_store
 from .serializers import OrderSerializer,ShippingAddressSerializer
+from .reservations import reserve_stock, commit_reservations, InsufficientStock, InvalidQuantity
 from django.core.paginator import Paginator
+from core.pagination import keyset_paginate, InvalidCursor
+from core.cache import two_tier
+from core.serializers import apply_query_plan
+from core.http import conditional, streaming_content, PRIVATE_CACHE_CONTROL
+from django.db.models import Count, Max
+from products.cache import catalog_generation
+from .cache import SHIPPING_METHODS_CACHE_KEY
+from .exports import EXPORTS, FORMATS, day_range, export, export_filename
 from accounts.models import ShippingAddress
 from django.conf import settings
 import stripe
@@ -23,12 +35,17 @@ def checkout(request):
     shipping_address_id = request.data.get('shipping_address_id')
     payment_method = request.data.get('payment_method')
 
-    # Check if cart exists for the user
-    try:
-        cart = Cart.objects.get(user=user)
-        if not cart.items.exists():
+    if cart_store.enabled():
+        # Write the live Redis cart behind before reading it from the database
+        cart_version = cart_store.flush_for_checkout(user.id)
+
+    # Load the cart lines with their variant and product in one query
+    cart_items = list(
+        CartItem.objects.filter(cart__user=user, variant__isnull=False).select_related('variant__product')
+    )
+    if not cart_items:
+        if Cart.objects.filter(user=user).exists():
             return Response({'error': 'Cart is empty.'}, status=status.HTTP_400_BAD_REQUEST)
-    except Cart.DoesNotExist:
         return Response({'error': 'Cart not found.'}, status=status.HTTP_404_NOT_FOUND)
     
     # Check if shipping address is provided
@@ -36,39 +53,48 @@ def checkout(request):
         shipping_address = ShippingAddress.objects.get(id=shipping_address_id, user=user)
     except ShippingAddress.DoesNotExist:
         return Response({'error': 'Shipping address not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+    # Compute the order total in memory so the order is written once
+    total_price = sum((item.variant.price * item.quantity for item in cart_items), Decimal(0))
     
     # Create the order and its items
-    with transaction.atomic():
-        total_price = Decimal(0)
-        
-        order = Order.objects.create(
-            user=user,
-            shipping_address=shipping_address,
-            status='Pending',
-            payment_method=payment_method,
-            total_price=0  # We will calculate this below
-        )
-        
-        for cart_item in cart.items.all():
-            variant_price = cart_item.variant.price
-            item_total_price = variant_price * cart_item.quantity
-            total_price += item_total_price
-            
-            # Create OrderItem for each item in the cart
-            OrderItem.objects.create(
-                order=order,
-                product=cart_item.variant.product,
-                variant=cart_item.variant,
-                quantity=cart_item.quantity,
-                price=variant_price
+    try:
+        with transaction.atomic():
+            order = Order.objects.create(
+                user=user,
+                shipping_address=shipping_address,
+                status='Pending',
+                payment_method=payment_method,
+                total_price=total_price
             )
-        
-        # Update the total price for the order
-        order.total_price = total_price
-        order.save()
 
-        # Clear the cart after order creation
-        cart.items.all().delete()
+            # Hold the stock first, an oversold cart rolls the whole order back
+            reserve_stock(order, [(item.variant_id, item.quantity) for item in cart_items])
+
+            OrderItem.objects.bulk_create([
+                OrderItem(
+                    order=order,
+                    product=item.variant.product,
+                    variant=item.variant,
+                    quantity=item.quantity,
+                    price=item.variant.price
+                )
+                for item in cart_items
+            ])
+
+            # Clear the cart after order creation
+            CartItem.objects.filter(pk__in=[item.pk for item in cart_items]).delete()
+            Cart.refresh_totals({item.cart_id for item in cart_items})
+            if cart_store.enabled():
+                # Only the lines ordered: the cart may have changed since the flush
+                ordered = {}
+                for item in cart_items:
+                    ordered[item.variant_id] = ordered.get(item.variant_id, 0) + item.quantity
+                transaction.on_commit(lambda: cart_store.forget(user.id, cart_version, ordered))
+    except InsufficientStock as e:
+        return Response({'error': str(e), 'variant_id': e.variant_id}, status=status.HTTP_409_CONFLICT)
+    except InvalidQuantity as e:
+        return Response({'error': str(e), 'variant_id': e.variant_id}, status=status.HTTP_400_BAD_REQUEST)
 
     return Response({'order_id': order.id, 'message': 'Order created successfully.'}, status=status.HTTP_201_CREATED)
 
@@ -161,19 +187,26 @@ def process_payment(request):
     if amount != order.total_price:
         return Response({'error': 'Amount does not match the order total price.'}, status=status.HTTP_400_BAD_REQUEST)
     
-    # Record the payment
-    Payment.objects.create(
-        order=order,
-        payment_method=payment_method,
-        amount=amount,
-        status='Completed',
-        transaction_id=transaction_id
-    )
+    try:
+        with transaction.atomic():
+            # Turn the held stock into a sale, re-reserving lines whose hold expired
+            commit_reservations(order)
+
+            # Record the payment
+            Payment.objects.create(
+                order=order,
+                payment_method=payment_method,
+                amount=amount,
+                status='Completed',
+                transaction_id=transaction_id
+            )
 
-    # Update the order status
-    order.payment_status = 'Completed'
-    order.status = 'Processing'
-    order.save()
+            # Update the order status
+            order.payment_status = 'Completed'
+            order.status = 'Processing'
+            order.save()
+    except InsufficientStock as e:
+        return Response({'error': str(e), 'variant_id': e.variant_id}, status=status.HTTP_409_CONFLICT)
 
     return Response({'message': 'Payment processed successfully.'}, status=status.HTTP_200_OK)
 
@@ -227,43 +260,74 @@ def order_detail(request, order_id):
 def shipping_methods(request):
     """
     List all available shipping methods.
+    Served from the in-process L1 of core.cache, invalidated by orders.signals.
     """
-    shipping_methods = ShippingMethod.objects.all()
+    def build_methods():
+        shipping_methods = ShippingMethod.objects.all()
 
-    methods = [
-        {
-            'id': method.id,
-            'name': method.name,
-            'price': method.price,
-            'estimated_delivery_days': method.estimated_delivery_days
-        }
-        for method in shipping_methods
-    ]
+        return [
+            {
+                'id': method.id,
+                'name': method.name,
+                'price': method.price,
+                'estimated_delivery_days': method.estimated_delivery_days
+            }
+            for method in shipping_methods
+        ]
+
+    methods = two_tier(SHIPPING_METHODS_CACHE_KEY, build_methods, timeout=60 * 60)
 
     return Response({'shipping_methods': methods}, status=status.HTTP_200_OK)
 
 
 
+def orders_version(request):
+    # Orders are saved (never .update()d) when they change; item names come from the catalog
+    stamp = Order.objects.filter(user=request.user).aggregate(count=Count('id'), updated=Max('updated_at'))
+    return f"{request.user.id}|{stamp['count']}|{stamp['updated']}|{catalog_generation()}"
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@conditional(orders_version, PRIVATE_CACHE_CONTROL)
 def all_orders(request):
     """
     Fetch a list of all orders for the authenticated user. Supports pagination.
     
     Query Parameters:
     - page: (int) Optional. The page number for paginated results. Default is 1.
+    - cursor: (string) Optional. Switches to keyset pagination over (created_at, id); pass it
+      empty for the first page, then the `next_cursor` of the previous response.
     
     Response:
     - Returns a paginated list of orders, including items and payment details.
+    - In cursor mode `page` and `total_pages` are null.
     
     Status Codes:
-    - 200: Success, with paginated order data.
+    - 200: Success, with paginated order data. Carries an ETag, see orders_version.
+    - 304: If-None-Match matched; nothing was serialized.
+    - 400: The cursor is not one this endpoint returned.
     """
     user = request.user
     page = request.query_params.get('page', 1)
+    cursor = request.query_params.get('cursor', None)
 
-    # Fetch all orders for the authenticated user
-    orders = Order.objects.filter(user=user).order_by('-created_at')
+    # Fetch all orders for the authenticated user, with their items and payments prefetched
+    orders = apply_query_plan(Order.objects.filter(user=user), OrderSerializer).order_by('-created_at', '-id')
+
+    if cursor is not None:
+        ordering = ('-created_at', '-id')
+        try:
+            page_orders, next_cursor = keyset_paginate(orders, cursor, ordering, page_size=10)
+        except InvalidCursor:
+            return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+        response_data = {
+            'orders': OrderSerializer(page_orders, many=True).data,
+            'page': None,
+            'total_pages': None,
+            'next_cursor': next_cursor,
+        }
+        return Response(response_data, status=status.HTTP_200_OK)
 
     # Paginate the orders (10 per page)
     paginator = Paginator(orders, 10)
@@ -283,6 +347,47 @@ def all_orders(request):
 
     return Response(response_data, status=status.HTTP_200_OK)
 
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def export_orders(request):
+    """
+    Stream an export of orders, order items or payments for finance, see orders.exports.
+
+    Query Parameters:
+    - kind: (string) Optional. orders (default), items or payments.
+    - since: (date) Optional. First day included, YYYY-MM-DD. Default is yesterday.
+    - until: (date) Optional. First day excluded. Default is the day after since.
+    - file_format: (string) Optional. csv (default) or jsonl. (`format` is DRF's renderer override.)
+    - gzip: (bool) Optional. Gzip the file.
+
+    Status Codes:
+    - 200: The file, streamed as it is read from the database (asynchronously under ASGI, so
+      memory stays at one chunk of rows).
+    - 400: Invalid kind, format or dates.
+    """
+    kind = request.query_params.get('kind', 'orders')
+    file_format = request.query_params.get('file_format', 'csv')
+    compress = request.query_params.get('gzip', '').lower() in ('1', 'true', 'yes')
+    if kind not in EXPORTS or file_format not in FORMATS:
+        return Response({'error': f"kind must be one of {', '.join(EXPORTS)} and file_format one of {', '.join(FORMATS)}"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    try:
+        since = request.query_params.get('since')
+        until = request.query_params.get('until')
+        start, end = day_range(date.fromisoformat(since) if since else None, date.fromisoformat(until) if until else None)
+    except ValueError:
+        return Response({'error': "since and until must be dates, YYYY-MM-DD"}, status=status.HTTP_400_BAD_REQUEST)
+    if end <= start:
+        return Response({'error': "until must be after since"}, status=status.HTTP_400_BAD_REQUEST)
+
+    content_type = 'application/gzip' if compress else ('text/csv' if file_format == 'csv' else 'application/x-ndjson')
+    chunks = export(kind, start, end, file_format, compress)
+    response = StreamingHttpResponse(streaming_content(request, chunks), content_type=content_type)
+    filename = export_filename(kind, start, end, file_format, compress)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['Cache-Control'] = 'no-store'
+    return response
+
 class ShippingAddressListCreate(generics.ListCreateAPIView):
     serializer_class = ShippingAddressSerializer
     permission_classes = [IsAuthenticated]
@@ -0,0 +1,160 @@
+import hashlib
+import time
+from django.core.cache import cache
+from core.cache import aget_many, aset, local_get_many, local_sequence, local_set_many, publish_invalidation
+
+# Every catalog write bumps the global generation, and the generation of each
+# category it touches. Cached catalog responses carry the generation they were
+# built against in their key, so a bump makes every older entry unreachable
+# instead of having to find and delete it. Generations are read on every catalog
+# request, so they are also kept in the in-process L1 of core.cache.
+CATALOG_GENERATION_KEY = 'catalog_generation'
+CATEGORY_GENERATION_KEY = 'catalog_generation_category_{}'
+# Banners are not part of the catalog, they get their own generation
+BANNER_GENERATION_KEY = 'banner_generation'
+# Bumped by every stock movement. Stock counts are rendered from the per-variant fragments
+# (products.fragments), so it keys no cached data; it only goes into the catalog ETags, whose
+# bodies show the counts.
+STOCK_GENERATION_KEY = 'stock_generation'
+
+
+def _seed():
+    # Used when a generation key is missing (first use or evicted). A fresh
+    # timestamp can never collide with a value an older entry was keyed under.
+    return time.time_ns()
+
+
+def get_generations(keys):
+    """
+    Return the current value of each generation key, seeding missing ones.
+    """
+    sequence = local_sequence()
+    values = local_get_many(keys)
+    remote = [key for key in keys if key not in values]
+    if remote:
+        fetched = cache.get_many(remote)
+        missing = [key for key in remote if key not in fetched]
+        if missing:
+            for key in missing:
+                cache.add(key, _seed(), timeout=None)
+            fetched.update(cache.get_many(missing))
+        local_set_many(fetched, sequence=sequence)
+        values.update(fetched)
+    return [values[key] for key in keys]
+
+
+async def aget_generations(keys):
+    """
+    get_generations for async views.
+    """
+    sequence = local_sequence()
+    values = local_get_many(keys)
+    remote = [key for key in keys if key not in values]
+    if remote:
+        fetched = await aget_many(remote)
+        missing = [key for key in remote if key not in fetched]
+        if missing:
+            for key in missing:
+                await aset(key, _seed(), timeout=None, nx=True)
+            fetched.update(await aget_many(missing))
+        local_set_many(fetched, sequence=sequence)
+        values.update(fetched)
+    return [values[key] for key in keys]
+
+
+def _generation_key(category_id):
+    return CATEGORY_GENERATION_KEY.format(category_id) if category_id else CATALOG_GENERATION_KEY
+
+
+def catalog_generation(category_id=None):
+    """
+    Generation for the whole catalog, or for a single category when category_id is given.
+    """
+    return get_generations([_generation_key(category_id)])[0]
+
+
+async def acatalog_generation(category_id=None):
+    return (await aget_generations([_generation_key(category_id)]))[0]
+
+
+def bump_catalog_generation(category_ids=()):
+    """
+    Invalidate the global catalog generation and the generation of every given category.
+    """
+    keys = [CATALOG_GENERATION_KEY]
+    keys += [CATEGORY_GENERATION_KEY.format(category_id) for category_id in set(category_ids) if category_id]
+    _bump_generations(keys)
+
+
+def bump_stock_generation():
+    _bump_generations([STOCK_GENERATION_KEY])
+
+
+def banner_generation():
+    return get_generations([BANNER_GENERATION_KEY])[0]
+
+
+def bump_banner_generation():
+    _bump_generations([BANNER_GENERATION_KEY])
+
+
+def _bump_generations(keys):
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _seed(), timeout=None)
+    publish_invalidation(keys)
+
+
+# Reference data served through core.cache.two_tier, invalidated by products.signals
+CATEGORIES_CACHE_KEY = 'categories_list'
+BANNERS_CACHE_KEY = 'banners_list'
+
+
+def _filters_digest(filters):
+    if not filters:
+        return ''
+    encoded = '&'.join(f'{name}={value}' for name, value in sorted(filters.items()))
+    return '_f' + hashlib.md5(encoded.encode()).hexdigest()
+
+
+# Listing entries hold the page's variant ids only, shared by every serializer profile;
+# the variants themselves come from products.fragments. Each key builder has an async
+# twin for the async views, reading the generation without blocking.
+def _variant_list_key(category_id, page, filters, generation):
+    prefix = f"variants_{category_id}" if category_id else "variants_all"
+    return f"{prefix}_page_{page}{_filters_digest(filters)}_ids_v{generation}"
+
+
+def variant_list_cache_key(category_id, page, filters=None):
+    return _variant_list_key(category_id, page, filters, catalog_generation(category_id))
+
+
+async def avariant_list_cache_key(category_id, page, filters=None):
+    return _variant_list_key(category_id, page, filters, await acatalog_generation(category_id))
+
+
+def variant_detail_cache_key(slug):
+    return f"variant_detail_{slug}_id_v{catalog_generation()}"
+
+
+async def avariant_detail_cache_key(slug):
+    return f"variant_detail_{slug}_id_v{await acatalog_generation()}"
+
+
+def popular_variants_cache_key(page):
+    return f"popular_variants_page_{page}_ids_v{catalog_generation()}"
+
+
+async def apopular_variants_cache_key(page):
+    return f"popular_variants_page_{page}_ids_v{await acatalog_generation()}"
+
+
+def recently_viewed_cache_key(user_id):
+    return f"recently_viewed_variants_{user_id}_ids_v{catalog_generation()}"
+
+
+def search_cache_key(query, page):
+    digest = hashlib.md5(query.strip().lower().encode()).hexdigest()
+    return f"search_{digest}_page_{page}_ids_v{catalog_generation()}"
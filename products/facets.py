@@ -0,0 +1,186 @@
+from decimal import Decimal, InvalidOperation
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from .models import Product, ProductVariant, Varient_values, VariantFacetCount
+
+# Facet dimensions exposed by variant_list, in response order
+FACETS = ('tag', 'subcategory', 'primary', 'secondary', 'in_stock', 'discounted')
+# Ids filtered on are bigint primary keys, larger values cannot match anything
+MAX_ID = 2 ** 63 - 1
+
+
+def _flag(value):
+    return 'true' if value else 'false'
+
+
+def _is_discounted(price, discount_price):
+    return discount_price is not None and price is not None and Decimal(discount_price) < Decimal(price)
+
+
+def _variant_facets(product, primary_id, secondary_id, total_stock, price, discount_price, labels):
+    facets = {('tag', tag.slug, tag.name) for tag in product.tags.all()}
+    if product.subcategory_id:
+        facets.add(('subcategory', str(product.subcategory_id), product.subcategory.name))
+    if primary_id:
+        facets.add(('primary', str(primary_id), labels.get(primary_id, '')))
+    if secondary_id:
+        facets.add(('secondary', str(secondary_id), labels.get(secondary_id, '')))
+    facets.add(('in_stock', _flag((total_stock or 0) > 0), ''))
+    facets.add(('discounted', _flag(_is_discounted(price, discount_price)), ''))
+    return facets
+
+
+def _value_labels(value_ids):
+    values = Varient_values.objects.select_related('varient_type').in_bulk([i for i in value_ids if i])
+    return {value_id: str(value) for value_id, value in values.items()}
+
+
+def _apply_delta(category_id, facets, delta):
+    for facet, value, label in facets:
+        updated = VariantFacetCount.objects.filter(category_id=category_id, facet=facet, value=value) \
+                                           .update(count=F('count') + delta, label=label)
+        if not updated and delta > 0:
+            counter, created = VariantFacetCount.objects.get_or_create(
+                category_id=category_id, facet=facet, value=value,
+                defaults={'label': label, 'count': delta},
+            )
+            if not created:
+                VariantFacetCount.objects.filter(pk=counter.pk).update(count=F('count') + delta)
+
+
+def _facets_changed(variant):
+    # Most saves are stock or price tweaks that keep every facet value, skip those without queries
+    if variant.has_changed('primary_varient') or variant.has_changed('secondary_varient'):
+        return True
+    was_in_stock = (variant.initial_value('total_stock') or 0) > 0
+    was_discounted = _is_discounted(variant.initial_value('price'), variant.initial_value('discount_price'))
+    return (
+        was_in_stock != ((variant.total_stock or 0) > 0)
+        or was_discounted != _is_discounted(variant.price, variant.discount_price)
+    )
+
+
+def variant_saved(variant, created):
+    """
+    Apply the facet count delta of a created or updated variant inside the current transaction.
+    """
+    if not created and not _facets_changed(variant):
+        return
+    product = Product.objects.select_related('subcategory').prefetch_related('tags').get(pk=variant.product_id)
+    old_primary = variant.initial_value('primary_varient')
+    old_secondary = variant.initial_value('secondary_varient')
+    labels = _value_labels({variant.primary_varient_id, variant.secondary_varient_id, old_primary, old_secondary})
+
+    new = _variant_facets(product, variant.primary_varient_id, variant.secondary_varient_id,
+                          variant.total_stock, variant.price, variant.discount_price, labels)
+    old = set()
+    if not created:
+        old = _variant_facets(product, old_primary, old_secondary, variant.initial_value('total_stock'),
+                              variant.initial_value('price'), variant.initial_value('discount_price'), labels)
+    # Labels may differ between snapshots, compare on (facet, value) only
+    old_keys = {(facet, value) for facet, value, _ in old}
+    new_keys = {(facet, value) for facet, value, _ in new}
+    _apply_delta(product.category_id, [f for f in old if (f[0], f[1]) not in new_keys], -1)
+    _apply_delta(product.category_id, [f for f in new if (f[0], f[1]) not in old_keys], 1)
+
+
+def rebuild_category_facets(category_ids):
+    """
+    Recompute the facet counts of whole categories with one GROUP BY per facet.
+    Used for changes that fan out to many variants (product tags, subcategory, deletes).
+    """
+    for category_id in {category_id for category_id in category_ids if category_id}:
+        variants = ProductVariant.objects.filter(product__category_id=category_id).order_by()
+        rows = []
+        for value, label, count in variants.filter(product__tags__isnull=False) \
+                .values_list('product__tags__slug', 'product__tags__name').annotate(count=Count('id')):
+            rows.append(('tag', value, label, count))
+        for value, label, count in variants.filter(product__subcategory__isnull=False) \
+                .values_list('product__subcategory_id', 'product__subcategory__name').annotate(count=Count('id')):
+            rows.append(('subcategory', str(value), label, count))
+        for facet, field in (('primary', 'primary_varient'), ('secondary', 'secondary_varient')):
+            grouped = variants.filter(**{f'{field}__isnull': False}) \
+                              .values_list(f'{field}_id', f'{field}__varient_type__name', f'{field}__value') \
+                              .annotate(count=Count('id'))
+            for value, type_name, value_name, count in grouped:
+                rows.append((facet, str(value), f'{type_name}-{value_name}', count))
+        discounted = Q(discount_price__isnull=False, discount_price__lt=F('price'))
+        flags = variants.aggregate(
+            in_stock=Count('id', filter=Q(total_stock__gt=0)),
+            out_of_stock=Count('id', filter=Q(total_stock__lte=0)),
+            discounted=Count('id', filter=discounted),
+            not_discounted=Count('id', filter=~discounted),
+        )
+        rows += [
+            ('in_stock', 'true', '', flags['in_stock']),
+            ('in_stock', 'false', '', flags['out_of_stock']),
+            ('discounted', 'true', '', flags['discounted']),
+            ('discounted', 'false', '', flags['not_discounted']),
+        ]
+
+        with transaction.atomic():
+            VariantFacetCount.objects.filter(category_id=category_id).delete()
+            VariantFacetCount.objects.bulk_create([
+                VariantFacetCount(category_id=category_id, facet=facet, value=value, label=label or '', count=count)
+                for facet, value, label, count in rows if count
+            ])
+
+
+def _grouped_counts(category_id):
+    counts = VariantFacetCount.objects.filter(count__gt=0)
+    if category_id:
+        counts = counts.filter(category_id=category_id)
+    return counts.values('facet', 'value', 'label').annotate(total=Sum('count')).order_by('facet', '-total', 'value')
+
+
+def _facets(rows):
+    facets = {facet: [] for facet in FACETS}
+    for row in rows:
+        facets.setdefault(row['facet'], []).append({'value': row['value'], 'label': row['label'], 'count': row['total']})
+    return facets
+
+
+def facet_counts(category_id=None):
+    """
+    Facet counts for one category, or summed over every category.
+    """
+    return _facets(_grouped_counts(category_id))
+
+
+async def afacet_counts(category_id=None):
+    return _facets([row async for row in _grouped_counts(category_id)])
+
+
+def filter_variants(variants, params):
+    """
+    Apply the variant_list facet filters found in the query parameters. Values that are not
+    valid (not a finite price, not an id) are ignored.
+    Returns the filtered queryset and the normalized filters that were applied.
+    """
+    applied = {}
+    for name, lookup in (('min_price', 'price__gte'), ('max_price', 'price__lte')):
+        try:
+            price = Decimal(params[name])
+        except (KeyError, InvalidOperation):
+            continue
+        if not price.is_finite():
+            continue
+        variants = variants.filter(**{lookup: price})
+        applied[name] = str(price)
+    if params.get('tag'):
+        variants = variants.filter(product__tags__slug=params['tag'])
+        applied['tag'] = params['tag']
+    for name, lookup in (('subcategory', 'product__subcategory_id__in'),
+                         ('primary', 'primary_varient_id__in'),
+                         ('secondary', 'secondary_varient_id__in')):
+        ids = sorted({int(i) for i in params.get(name, '').split(',') if i.strip().isdecimal() and 0 < int(i) <= MAX_ID})
+        if ids:
+            variants = variants.filter(**{lookup: ids})
+            applied[name] = ','.join(map(str, ids))
+    if params.get('in_stock') in ('true', '1'):
+        variants = variants.filter(total_stock__gt=0)
+        applied['in_stock'] = 'true'
+    if params.get('discounted') in ('true', '1'):
+        variants = variants.filter(discount_price__isnull=False, discount_price__lt=F('price'))
+        applied['discounted'] = 'true'
+    return variants, applied
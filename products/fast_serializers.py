@@ -0,0 +1,151 @@
+from decimal import Decimal, getcontext
+from django.db.models import QuerySet
+from rest_framework.settings import api_settings
+from .models import Product, ProductTag, ProductVariant, ProductVarientImage, Varient_values
+
+# Fast path for the hot variant listings: builds the exact output of ProductVariantSerializer
+# (profile 'full') or ProductVariantSummarySerializer ('summary') from .values() rows, with
+# one query per relation like their query plans, but without instantiating models or running
+# DRF fields per row. Keep the key order and formatting in step with products.serializers;
+# the benchmark_serializers command checks the two paths render the same bytes.
+VARIANT_FIELDS = (
+    'id', 'variant_name', 'price', 'discount_price', 'sku', 'total_stock',
+    'primary_varient_id', 'secondary_varient_id', 'product_id', 'slug',
+)
+PROFILES = ('full', 'summary')
+
+_CENTS = Decimal('0.01')
+
+
+def _decimal(value):
+    # Same as serializers.DecimalField(max_digits=10, decimal_places=2).to_representation
+    if value is None:
+        return None
+    context = getcontext().copy()
+    context.prec = 10
+    value = value.quantize(_CENTS, context=context)
+    return '{:f}'.format(value) if api_settings.COERCE_DECIMAL_TO_STRING else value
+
+
+def _average_rating(rating_sum, review_count):
+    # Same as Product.average_rating
+    if not review_count:
+        return 0
+    return round(rating_sum / review_count, 1)
+
+
+def _variant_rows(variants):
+    if isinstance(variants, QuerySet):
+        return list(variants.prefetch_related(None).values(*VARIANT_FIELDS))
+    variant_ids = list(variants)
+    rows = {row['id']: row for row in ProductVariant.objects.filter(id__in=variant_ids).values(*VARIANT_FIELDS)}
+    return [rows[variant_id] for variant_id in variant_ids if variant_id in rows]
+
+
+def _variant_values(value_ids):
+    if not value_ids:
+        return {}
+    rows = Varient_values.objects.filter(id__in=value_ids).values_list('id', 'varient_type__name', 'value')
+    return {value_id: {'id': value_id, 'varient_type': type_name, 'value': value} for value_id, type_name, value in rows}
+
+
+def _images(variant_ids):
+    storage = ProductVarientImage._meta.get_field('image').storage
+    images = {}
+    # Same query shape (and so the same row order) as the variant_images prefetch
+    rows = ProductVarientImage.objects.filter(varient__in=variant_ids).values_list('varient_id', 'id', 'image', 'alt_text')
+    for variant_id, image_id, image, alt_text in rows:
+        images.setdefault(variant_id, []).append({
+            'id': image_id,
+            'image': storage.url(image) if image else None,
+            'alt_text': alt_text,
+        })
+    return images
+
+
+def _tags(product_ids):
+    tags = {}
+    # Same query shape (and so the same row order) as the product__tags prefetch
+    for product_id, name in ProductTag.objects.filter(products__in=product_ids).values_list('products__id', 'name'):
+        tags.setdefault(product_id, []).append(name)
+    return tags
+
+
+def _products(product_ids, summary):
+    if not product_ids:
+        return {}
+    tags = {} if summary else _tags(product_ids)
+    rows = Product.objects.filter(id__in=product_ids).values_list(
+        'id', 'name', 'description', 'category__name', 'price', 'discount_price', 'rating_sum', 'review_count',
+    )
+    products = {}
+    for product_id, name, description, category, price, discount_price, rating_sum, review_count in rows:
+        if summary:
+            products[product_id] = {
+                'id': product_id,
+                'name': name,
+                'category': category,
+                'price': _decimal(price),
+                'discount_price': _decimal(discount_price),
+                'average_rating': _average_rating(rating_sum, review_count),
+                'review_count': review_count,
+            }
+        else:
+            products[product_id] = {
+                'id': product_id,
+                'name': name,
+                'description': description,
+                'category': category,
+                'tags': tags.get(product_id, []),
+                'price': _decimal(price),
+                'discount_price': _decimal(discount_price),
+                'average_rating': _average_rating(rating_sum, review_count),
+                'review_count': review_count,
+            }
+    return products
+
+
+def serialize_variants(variants, profile='full'):
+    """
+    Serialize variants like VARIANT_PROFILES[profile](variants, many=True).data.
+    variants is a queryset (kept in its own order and slice) or a list of ids (kept in list order).
+    """
+    summary = profile == 'summary'
+    rows = _variant_rows(variants)
+    variant_ids = [row['id'] for row in rows]
+    values = _variant_values({row[field] for row in rows for field in ('primary_varient_id', 'secondary_varient_id')} - {None})
+    images = _images(variant_ids) if rows else {}
+    products = _products({row['product_id'] for row in rows}, summary)
+
+    data = []
+    for row in rows:
+        primary = values.get(row['primary_varient_id'])
+        secondary = values.get(row['secondary_varient_id'])
+        if summary:
+            data.append({
+                'id': row['id'],
+                'variant_name': row['variant_name'],
+                'price': _decimal(row['price']),
+                'discount_price': _decimal(row['discount_price']),
+                'total_stock': row['total_stock'],
+                'primary_varient': dict(primary) if primary else None,
+                'secondary_varient': dict(secondary) if secondary else None,
+                'variant_images': images.get(row['id'], []),
+                'product': products[row['product_id']],
+                'slug': row['slug'],
+            })
+        else:
+            data.append({
+                'id': row['id'],
+                'variant_name': row['variant_name'],
+                'price': _decimal(row['price']),
+                'discount_price': _decimal(row['discount_price']),
+                'sku': row['sku'],
+                'total_stock': row['total_stock'],
+                'primary_varient': dict(primary) if primary else None,
+                'secondary_varient': dict(secondary) if secondary else None,
+                'variant_images': images.get(row['id'], []),
+                'product': products[row['product_id']],
+                'slug': row['slug'],
+            })
+    return data
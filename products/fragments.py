@@ -0,0 +1,144 @@
+import json
+from asgiref.sync import sync_to_async
+from django_redis import get_redis_connection
+from core.cache import async_redis
+from .fast_serializers import serialize_variants
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is an optional speedup
+    orjson = None
+
+# Pre-rendered variant fragments: the JSON of one serialized variant per profile, shared by
+# every listing that shows the variant. Fragment keys carry
+#   - SCHEMA_VERSION, bumped by hand whenever products.fast_serializers changes its output,
+#   - the epoch, bumped when something shared by many variants changes (a category, tag or
+#     variant value name), which retires every fragment at once,
+#   - the variant's own version, bumped by products.signals when the variant, its product or
+#     its images change.
+# Versions are read before the variant is rendered, so a fragment rendered from data that
+# changed meanwhile is stored under a version that is already retired and never served.
+SCHEMA_VERSION = 1
+EPOCH_KEY = 'variant_fragments_epoch'
+VERSION_KEY = 'variant_fragment_version_{}'
+FRAGMENT_PREFIX = 'variant_fragment_{}_{}_'
+FRAGMENT_TTL = 60 * 60 * 24
+
+# KEYS: epoch, then one version key per variant. ARGV: fragment prefix, then the variant ids.
+# Missing counters are seeded with the server time so they never repeat an evicted value.
+# Returns {epoch, versions, fragments}, a fragment being false when it is not cached.
+_GET_FRAGMENTS = """
+local function current(key)
+    local value = redis.call('GET', key)
+    if not value then
+        local now = redis.call('TIME')
+        redis.call('SET', key, now[1] .. string.format('%06d', now[2]), 'NX')
+        value = redis.call('GET', key)
+    end
+    return value
+end
+local epoch = current(KEYS[1])
+local versions, fragments = {}, {}
+for i = 2, #KEYS do
+    local version = current(KEYS[i])
+    versions[i - 1] = version
+    fragments[i - 1] = redis.call('GET', ARGV[1] .. epoch .. '_' .. ARGV[i] .. '_v' .. version)
+end
+return {epoch, versions, fragments}
+"""
+
+
+def _dumps(data):
+    return orjson.dumps(data) if orjson else json.dumps(data, separators=(',', ':')).encode()
+
+
+def _loads(fragment):
+    return orjson.loads(fragment) if orjson else json.loads(fragment)
+
+
+def _fragment_key(prefix, epoch, variant_id, version):
+    return f'{prefix}{epoch}_{variant_id}_v{version}'
+
+
+def _split(variant_ids, fragments):
+    cached, missing = {}, []
+    for variant_id, fragment in zip(variant_ids, fragments):
+        if fragment:
+            cached[variant_id] = _loads(fragment)
+        else:
+            missing.append(variant_id)
+    return cached, missing
+
+
+def _backfill(pipe, prefix, epoch, variant_ids, versions, rendered, cached):
+    version_of = dict(zip(variant_ids, versions))
+    for data in rendered:
+        cached[data['id']] = data
+        key = _fragment_key(prefix, epoch, data['id'], version_of[data['id']].decode())
+        pipe.set(key, _dumps(data), ex=FRAGMENT_TTL)
+
+
+def variant_fragments(variant_ids, profile='full'):
+    """
+    Serialized variants for the given ids, in order, like serialize_variants(variant_ids, profile).
+    Cached fragments come back with one Redis call; misses are rendered together and backfilled.
+    Ids of variants that no longer exist are left out.
+    """
+    variant_ids = list(dict.fromkeys(variant_ids))
+    if not variant_ids:
+        return []
+    redis = get_redis_connection('default')
+    prefix = FRAGMENT_PREFIX.format(SCHEMA_VERSION, profile)
+    keys = [EPOCH_KEY] + [VERSION_KEY.format(variant_id) for variant_id in variant_ids]
+    epoch, versions, fragments = redis.register_script(_GET_FRAGMENTS)(keys=keys, args=[prefix] + variant_ids)
+
+    cached, missing = _split(variant_ids, fragments)
+    if missing:
+        pipe = redis.pipeline(transaction=False)
+        _backfill(pipe, prefix, epoch.decode(), variant_ids, versions, serialize_variants(missing, profile), cached)
+        pipe.execute()
+
+    return [cached[variant_id] for variant_id in variant_ids if variant_id in cached]
+
+
+async def avariant_fragments(variant_ids, profile='full'):
+    """
+    variant_fragments for async views. Misses are rendered in a worker thread, since
+    serialize_variants runs its queries with the sync ORM.
+    """
+    variant_ids = list(dict.fromkeys(variant_ids))
+    if not variant_ids:
+        return []
+    redis = async_redis()
+    prefix = FRAGMENT_PREFIX.format(SCHEMA_VERSION, profile)
+    keys = [EPOCH_KEY] + [VERSION_KEY.format(variant_id) for variant_id in variant_ids]
+    epoch, versions, fragments = await redis.register_script(_GET_FRAGMENTS)(keys=keys, args=[prefix] + variant_ids)
+
+    cached, missing = _split(variant_ids, fragments)
+    if missing:
+        rendered = await sync_to_async(serialize_variants)(missing, profile)
+        pipe = redis.pipeline(transaction=False)
+        _backfill(pipe, prefix, epoch.decode(), variant_ids, versions, rendered, cached)
+        await pipe.execute()
+
+    return [cached[variant_id] for variant_id in variant_ids if variant_id in cached]
+
+
+def bump_variant_versions(variant_ids):
+    """
+    Retire the fragments of the given variants.
+    """
+    variant_ids = set(variant_ids)
+    if not variant_ids:
+        return
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for variant_id in variant_ids:
+        pipe.incr(VERSION_KEY.format(variant_id))
+    pipe.execute()
+
+
+def bump_fragment_epoch():
+    """
+    Retire every fragment, for changes shared by many variants.
+    """
+    get_redis_connection('default').incr(EPOCH_KEY)
@@ -0,0 +1,59 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from core.renderers import FastJSONRenderer
+from core.serializers import apply_query_plan
+from products.fast_serializers import PROFILES, serialize_variants
+from products.models import ProductVariant
+from products.serializers import VARIANT_PROFILES
+
+
+class Command(BaseCommand):
+    help = ("Check that products.fast_serializers renders the same bytes as the DRF variant serializers "
+            "over the catalog, then time both paths")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=10, help="Variants per rendered page")
+        parser.add_argument('--pages', type=int, default=100, help="Pages of the catalog compared, in id order")
+        parser.add_argument('--iterations', type=int, default=20, help="Timed renders of each page per path")
+
+    def drf_render(self, variants, profile):
+        serializer_class = VARIANT_PROFILES[profile]
+        data = serializer_class(apply_query_plan(variants, serializer_class), many=True).data
+        return JSONRenderer().render({'variants': data})
+
+    def fast_render(self, variants, profile):
+        return FastJSONRenderer().render({'variants': serialize_variants(variants, profile)})
+
+    def handle(self, *args, **options):
+        page_size = options['page_size']
+        ids = list(ProductVariant.objects.order_by('id').values_list('id', flat=True)[:page_size * options['pages']])
+        if not ids:
+            raise CommandError("No product variants to compare")
+        pages = [ids[start:start + page_size] for start in range(0, len(ids), page_size)]
+
+        for profile in PROFILES:
+            for page in pages:
+                variants = ProductVariant.objects.filter(id__in=page).order_by('id')
+                expected, actual = self.drf_render(variants, profile), self.fast_render(variants, profile)
+                if expected != actual:
+                    offset = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual)))
+                    raise CommandError(
+                        f"Profile {profile}, variants {page[0]}..{page[-1]} differ at byte {offset}:\n"
+                        f"  drf:  {expected[max(0, offset - 60):offset + 60]!r}\n"
+                        f"  fast: {actual[max(0, offset - 60):offset + 60]!r}"
+                    )
+            self.stdout.write(self.style.SUCCESS(f"{profile}: {len(pages)} pages identical"))
+
+        for profile in PROFILES:
+            timings = {}
+            for name, render in (('drf', self.drf_render), ('fast', self.fast_render)):
+                started = time.perf_counter()
+                for _ in range(options['iterations']):
+                    for page in pages:
+                        render(ProductVariant.objects.filter(id__in=page).order_by('id'), profile)
+                timings[name] = (time.perf_counter() - started) * 1000 / (options['iterations'] * len(pages))
+            self.stdout.write(
+                f"{profile}: drf {timings['drf']:.2f} ms/page, fast {timings['fast']:.2f} ms/page, "
+                f"{timings['drf'] / timings['fast']:.1f}x"
+            )
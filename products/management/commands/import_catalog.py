@@ -0,0 +1,411 @@
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from uuid import uuid4
+from django.core.exceptions import EmptyResultSet
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+from django.db.models import IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils.text import slugify
+from products.cache import bump_catalog_generation
+from products.facets import rebuild_category_facets
+from products.fragments import bump_fragment_epoch
+from products.models import (
+    Category, Product, ProductTag, ProductVariant, ProductVarientImage, Stock, SubCategory,
+    Varient_Type, Varient_values, Warehouse,
+)
+from products.ranking import rebuild_ranking
+from products.search import update_search_vectors
+
+# One row per variant, the product columns repeated on each of its variants:
+#   product_sku*, product_name*, description, category* (slug or name), subcategory, tags,
+#   product_price, product_discount_price, sku*, variant_name, price*, discount_price,
+#   total_stock, primary_type/primary_value, secondary_type/secondary_value, images,
+#   warehouse/warehouse_stock (the product's stock in that warehouse)
+# tags and images are lists ('|' separated in CSV) that replace the existing ones when the
+# column is present. Missing categories, tags, variant values and warehouses are created.
+# Upserted columns; slugs are only generated for new rows and never rewritten
+PRODUCT_UPDATE_FIELDS = ['name', 'description', 'price', 'discount_price', 'category', 'subcategory', 'updated_at']
+VARIANT_UPDATE_FIELDS = ['product', 'primary_varient', 'secondary_varient', 'variant_name', 'price', 'discount_price', 'total_stock']
+MAX_REPORTED_ERRORS = 20
+# Columns checked against the model field they are written to, so a value the database would
+# reject (too long, out of range) skips its row instead of failing the whole batch
+BOUNDED_COLUMNS = {
+    'product_sku': Product._meta.get_field('sku'),
+    'product_name': Product._meta.get_field('name'),
+    'category': Category._meta.get_field('name'),
+    'subcategory': SubCategory._meta.get_field('name'),
+    'tags': ProductTag._meta.get_field('name'),
+    'sku': ProductVariant._meta.get_field('sku'),
+    # Before product_price, which defaults to it
+    'price': ProductVariant._meta.get_field('price'),
+    'product_price': Product._meta.get_field('price'),
+    'product_discount_price': Product._meta.get_field('discount_price'),
+    'discount_price': ProductVariant._meta.get_field('discount_price'),
+    'total_stock': ProductVariant._meta.get_field('total_stock'),
+    'images': ProductVarientImage._meta.get_field('image'),
+    'warehouse': Warehouse._meta.get_field('name'),
+    'warehouse_stock': Stock._meta.get_field('quantity'),
+}
+VARIANT_VALUE_FIELDS = (Varient_Type._meta.get_field('name'), Varient_values._meta.get_field('value'))
+# Room left in a slug for the random suffix, see _slug
+SLUG_SUFFIX_LENGTH = 10
+
+
+class RowError(ValueError):
+    pass
+
+
+def _delete(queryset):
+    # A plain DELETE: QuerySet.delete() would load every row to send the per-row delete signals,
+    # whose invalidations the import does once at the end instead
+    connection = connections[queryset.db]
+    opts = queryset.model._meta
+    table, pk = connection.ops.quote_name(opts.db_table), connection.ops.quote_name(opts.pk.column)
+    try:
+        sql, params = queryset.values('pk').query.sql_with_params()
+    except EmptyResultSet:
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE {pk} IN ({sql})', params)
+        return cursor.rowcount
+
+
+def _slug(model, name):
+    # Like the models' save(): the name plus a random suffix, cut to fit the slug column
+    max_length = model._meta.get_field('slug').max_length
+    return slugify(name[:max_length - SLUG_SUFFIX_LENGTH] + str(uuid4())[:SLUG_SUFFIX_LENGTH])
+
+
+def _check_bounds(name, value, field):
+    if value is None:
+        return
+    if isinstance(value, str):
+        if field.max_length is not None and len(value) > field.max_length:
+            raise RowError(f"{name} is longer than {field.max_length} characters")
+    elif isinstance(value, Decimal):
+        # Already quantized to the field's decimal places; count the digits left of the point
+        if value.adjusted() >= field.max_digits - field.decimal_places:
+            raise RowError(f"{name} is out of range: {value}")
+    else:
+        low, high = connections[DEFAULT_DB_ALIAS].ops.integer_field_range(field.get_internal_type())
+        if not low <= value <= high:
+            raise RowError(f"{name} is out of range: {value}")
+
+
+def _text(row, name, required=False):
+    value = row.get(name)
+    value = value.strip() if isinstance(value, str) else value
+    if value in (None, ''):
+        if required:
+            raise RowError(f"{name} is required")
+        return None
+    return str(value)
+
+
+def _decimal(row, name, required=False):
+    value = _text(row, name, required)
+    if value is None:
+        return None
+    try:
+        return Decimal(value).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise RowError(f"{name} is not a number: {value!r}")
+
+
+def _integer(row, name, default=None):
+    value = _text(row, name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise RowError(f"{name} is not an integer: {value!r}")
+
+
+def _list(row, name):
+    """
+    A list column: a JSON list, or '|' separated in CSV. None when the column is absent,
+    so the existing tags or images are left alone.
+    """
+    if name not in row:
+        return None
+    value = row[name]
+    if isinstance(value, list):
+        return [str(item).strip() for item in value if str(item).strip()]
+    return [item.strip() for item in (value or '').split('|') if item.strip()]
+
+
+def _variant_value(row, prefix):
+    value_type, value = _text(row, f'{prefix}_type'), _text(row, f'{prefix}_value')
+    if bool(value_type) != bool(value):
+        raise RowError(f"{prefix}_type and {prefix}_value go together")
+    return (value_type, value) if value_type else None
+
+
+def parse_row(row):
+    """
+    Normalize one input row (one variant, with its product repeated on every variant row).
+    Raises RowError for a value that is missing, malformed, or does not fit its column.
+    """
+    price = _decimal(row, 'price', required=True)
+    parsed = {
+        'product_sku': _text(row, 'product_sku', required=True),
+        'product_name': _text(row, 'product_name', required=True),
+        'description': _text(row, 'description') or '',
+        'category': _text(row, 'category', required=True),
+        'subcategory': _text(row, 'subcategory'),
+        'tags': _list(row, 'tags'),
+        'product_price': _decimal(row, 'product_price') or price,
+        'product_discount_price': _decimal(row, 'product_discount_price'),
+        'sku': _text(row, 'sku', required=True),
+        'variant_name': (_text(row, 'variant_name') or _text(row, 'product_name'))[:100],
+        'price': price,
+        'discount_price': _decimal(row, 'discount_price'),
+        'total_stock': _integer(row, 'total_stock', default=0),
+        'primary': _variant_value(row, 'primary'),
+        'secondary': _variant_value(row, 'secondary'),
+        'images': _list(row, 'images'),
+        'warehouse': _text(row, 'warehouse'),
+        'warehouse_stock': _integer(row, 'warehouse_stock'),
+    }
+    for name, field in BOUNDED_COLUMNS.items():
+        for value in parsed[name] if isinstance(parsed[name], list) else [parsed[name]]:
+            _check_bounds(name, value, field)
+    for prefix in ('primary', 'secondary'):
+        for value, field in zip(parsed[prefix] or (), VARIANT_VALUE_FIELDS):
+            _check_bounds(f'{prefix}_value', value, field)
+    return parsed
+
+
+class Lookups:
+    """
+    In-memory maps from the names used in the file to ids, loaded once and extended in bulk
+    when a batch brings new names.
+    """
+
+    def __init__(self):
+        self.category_slugs = {}
+        self.categories = {}
+        for category_id, name, slug in Category.objects.values_list('id', 'name', 'slug'):
+            self.categories.setdefault(name.lower(), category_id)
+            if slug:
+                self.category_slugs[slug] = category_id
+        self.subcategories = {
+            (category_id, name.lower()): subcategory_id
+            for subcategory_id, category_id, name in SubCategory.objects.values_list('id', 'category_id', 'name')
+        }
+        self.tags = {slug: tag_id for tag_id, slug in ProductTag.objects.values_list('id', 'slug')}
+        self.types = {name.lower(): type_id for type_id, name in Varient_Type.objects.values_list('id', 'name')}
+        self.values = {
+            (type_id, value.lower()): value_id
+            for value_id, type_id, value in Varient_values.objects.values_list('id', 'varient_type_id', 'value')
+        }
+        self.warehouses = {name.lower(): warehouse_id for warehouse_id, name in Warehouse.objects.values_list('id', 'name')}
+
+    def category(self, name):
+        return self.category_slugs.get(name) or self.categories.get(name.lower())
+
+    def add_missing(self, rows):
+        """
+        Create the categories, subcategories, tags, variant types and values and warehouses the
+        rows name but the database does not have yet, one bulk_create per kind.
+        """
+        names = {row['category'] for row in rows if self.category(row['category']) is None}
+        created = Category.objects.bulk_create([
+            Category(name=name, slug=_slug(Category, name)) for name in {name.lower(): name for name in names}.values()
+        ])
+        self.categories.update({category.name.lower(): category.id for category in created})
+
+        pairs = {(self.category(row['category']), row['subcategory']) for row in rows if row['subcategory']}
+        missing = {(category_id, name.lower()): name for category_id, name in pairs if (category_id, name.lower()) not in self.subcategories}
+        created = SubCategory.objects.bulk_create([SubCategory(category_id=category_id, name=name) for (category_id, _), name in missing.items()])
+        self.subcategories.update({(sub.category_id, sub.name.lower()): sub.id for sub in created})
+
+        tags = {slugify(name): name for row in rows for name in row['tags'] or ()}
+        created = ProductTag.objects.bulk_create([ProductTag(name=name, slug=slug) for slug, name in tags.items() if slug not in self.tags])
+        self.tags.update({tag.slug: tag.id for tag in created})
+
+        pairs = {row[key] for row in rows for key in ('primary', 'secondary') if row[key]}
+        names = {value_type.lower(): value_type for value_type, _ in pairs if value_type.lower() not in self.types}
+        created = Varient_Type.objects.bulk_create([Varient_Type(name=name) for name in names.values()])
+        self.types.update({value_type.name.lower(): value_type.id for value_type in created})
+        missing = {(self.types[value_type.lower()], value.lower()): value for value_type, value in pairs}
+        created = Varient_values.objects.bulk_create([
+            Varient_values(varient_type_id=type_id, value=value)
+            for (type_id, key), value in missing.items() if (type_id, key) not in self.values
+        ])
+        self.values.update({(value.varient_type_id, value.value.lower()): value.id for value in created})
+
+        names = {row['warehouse'].lower(): row['warehouse'] for row in rows if row['warehouse']}
+        created = Warehouse.objects.bulk_create([
+            Warehouse(name=name, location='') for key, name in names.items() if key not in self.warehouses
+        ])
+        self.warehouses.update({warehouse.name.lower(): warehouse.id for warehouse in created})
+
+    def value(self, pair):
+        if pair is None:
+            return None
+        value_type, value = pair
+        return self.values[(self.types[value_type.lower()], value.lower())]
+
+
+class Command(BaseCommand):
+    help = ("Import products and variants from a CSV or JSONL file, one variant per row, upserting "
+            "on product_sku / sku in batches and invalidating the catalog caches once at the end")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV (with a header row) or JSONL file")
+        parser.add_argument('--format', choices=('csv', 'jsonl'), help="Input format (default: from the file extension)")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Rows upserted per transaction")
+
+    def read_rows(self, handle, file_format):
+        if file_format == 'csv':
+            for line, row in enumerate(csv.DictReader(handle), start=2):
+                yield line, row
+            return
+        for line, text in enumerate(handle, start=1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError as e:
+                yield line, e
+                continue
+            yield line, row if isinstance(row, dict) else ValueError("not a JSON object")
+
+    def import_batch(self, lookups, rows):
+        """
+        Upsert one batch. Returns the ids of the categories it touched, before and after.
+        """
+        lookups.add_missing(rows)
+        category_ids = set(Product.objects.filter(sku__in={row['product_sku'] for row in rows}).values_list('category_id', flat=True))
+
+        products = {}
+        for row in rows:
+            category_id = lookups.category(row['category'])
+            products[row['product_sku']] = Product(
+                sku=row['product_sku'],
+                name=row['product_name'],
+                description=row['description'],
+                price=row['product_price'],
+                discount_price=row['product_discount_price'],
+                total_stock=0,
+                category_id=category_id,
+                subcategory_id=lookups.subcategories.get((category_id, row['subcategory'].lower())) if row['subcategory'] else None,
+                slug=_slug(Product, row['product_name']),
+            )
+        Product.objects.bulk_create(
+            products.values(), update_conflicts=True, unique_fields=['sku'], update_fields=PRODUCT_UPDATE_FIELDS,
+        )
+        product_ids = dict(Product.objects.filter(sku__in=list(products)).values_list('sku', 'id'))
+
+        variants = {}
+        for row in rows:
+            variants[row['sku']] = ProductVariant(
+                sku=row['sku'],
+                product_id=product_ids[row['product_sku']],
+                primary_varient_id=lookups.value(row['primary']),
+                secondary_varient_id=lookups.value(row['secondary']),
+                variant_name=row['variant_name'],
+                price=row['price'],
+                discount_price=row['discount_price'],
+                total_stock=row['total_stock'],
+                slug=_slug(ProductVariant, row['product_name']),
+            )
+        ProductVariant.objects.bulk_create(
+            variants.values(), update_conflicts=True, unique_fields=['sku'], update_fields=VARIANT_UPDATE_FIELDS,
+        )
+        variant_ids = dict(ProductVariant.objects.filter(sku__in=list(variants)).values_list('sku', 'id'))
+
+        # Tags and images given in the file replace the existing ones
+        tags = {product_ids[row['product_sku']]: row['tags'] for row in rows if row['tags'] is not None}
+        if tags:
+            through = Product.tags.through
+            _delete(through.objects.filter(product_id__in=list(tags)))
+            through.objects.bulk_create([
+                through(product_id=product_id, producttag_id=lookups.tags[slugify(name)])
+                for product_id, names in tags.items() for name in names
+            ], ignore_conflicts=True)
+
+        images = {variant_ids[row['sku']]: row['images'] for row in rows if row['images'] is not None}
+        if images:
+            _delete(ProductVarientImage.objects.filter(varient_id__in=list(images)))
+            ProductVarientImage.objects.bulk_create([
+                ProductVarientImage(varient_id=variant_id, image=image)
+                for variant_id, paths in images.items() for image in paths
+            ])
+
+        stock = {
+            (product_ids[row['product_sku']], lookups.warehouses[row['warehouse'].lower()]): row['warehouse_stock']
+            for row in rows if row['warehouse'] and row['warehouse_stock'] is not None
+        }
+        if stock:
+            existing = Stock.objects.filter(product_id__in={product_id for product_id, _ in stock}).values_list('id', 'product_id', 'warehouse_id')
+            _delete(Stock.objects.filter(id__in=[stock_id for stock_id, product_id, warehouse_id in existing if (product_id, warehouse_id) in stock]))
+            Stock.objects.bulk_create([
+                Stock(product_id=product_id, warehouse_id=warehouse_id, quantity=quantity)
+                for (product_id, warehouse_id), quantity in stock.items()
+            ])
+
+        touched = list(product_ids.values())
+        variant_stock = ProductVariant.objects.filter(product=OuterRef('pk')).order_by().values('product') \
+                                              .annotate(total=Sum('total_stock')).values('total')
+        Product.objects.filter(id__in=touched).update(
+            total_stock=Coalesce(Subquery(variant_stock, output_field=IntegerField()), Value(0)),
+        )
+        update_search_vectors(touched)
+        return category_ids | {product.category_id for product in products.values()}
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+        batch_size = options['batch_size']
+
+        lookups = Lookups()
+        errors = []
+        imported = 0
+        category_ids = set()
+        try:
+            handle = open(path, newline='', encoding='utf-8')
+        except OSError as e:
+            raise CommandError(f"Cannot open {path}: {e}")
+
+        with handle:
+            rows = self.read_rows(handle, file_format)
+            while batch := list(islice(rows, batch_size)):
+                parsed, lines = [], []
+                for line, row in batch:
+                    try:
+                        if isinstance(row, Exception):
+                            raise RowError(str(row))
+                        parsed.append(parse_row(row))
+                        lines.append(line)
+                    except RowError as e:
+                        errors.append(f"line {line}: {e}")
+                if not parsed:
+                    continue
+                try:
+                    with transaction.atomic():
+                        category_ids |= self.import_batch(lookups, parsed)
+                except DatabaseError as e:
+                    # Rolled back on its own; the rows it added to the lookups are gone too
+                    errors.extend(f"line {line}: batch rejected by the database: {e}" for line in lines)
+                    lookups = Lookups()
+                    continue
+                imported += len(parsed)
+                self.stdout.write(f"{imported} variants imported")
+
+        # Bulk writes skip signals: refresh what they maintain once, for the whole import
+        rebuild_category_facets(category_ids)
+        rebuild_ranking()
+        bump_fragment_epoch()
+        bump_catalog_generation(category_ids)
+
+        for error in errors[:MAX_REPORTED_ERRORS]:
+            self.stderr.write(error)
+        if len(errors) > MAX_REPORTED_ERRORS:
+            self.stderr.write(f"... and {len(errors) - MAX_REPORTED_ERRORS} more")
+        self.stdout.write(self.style.SUCCESS(f"Imported {imported} variants, skipped {len(errors)} rows"))
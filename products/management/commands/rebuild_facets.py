@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from products.cache import bump_catalog_generation
+from products.facets import rebuild_category_facets
+from products.models import Category
+
+
+class Command(BaseCommand):
+    help = "Recompute the precomputed variant_list facet counts for every category, or the given category slugs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('categories', nargs='*', help="Category slugs (default: all)")
+
+    def handle(self, *args, **options):
+        categories = Category.objects.all()
+        if options['categories']:
+            categories = categories.filter(slug__in=options['categories'])
+        category_ids = list(categories.values_list('id', flat=True))
+        rebuild_category_facets(category_ids)
+        bump_catalog_generation(category_ids)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt facet counts for {len(category_ids)} categories"))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from products.cache import bump_catalog_generation
+from products.ranking import rebuild_ranking
+
+
+class Command(BaseCommand):
+    help = "Rebuild the materialized popularity ranking used by popular_variants (run periodically)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help="Rows streamed per database fetch and Redis pipeline")
+
+    def handle(self, *args, **options):
+        total = rebuild_ranking(options['batch_size'])
+        bump_catalog_generation()
+        self.stdout.write(self.style.SUCCESS(f"Ranked {total} products"))
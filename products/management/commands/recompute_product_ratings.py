@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from products.models import Category, Product, Review
+from products.cache import bump_catalog_generation
+from products.ranking import rebuild_ranking
+from products.fragments import bump_fragment_epoch
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized rating_sum and review_count columns on Product from Review"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help="Products updated per UPDATE statement")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        reviews = Review.objects.filter(product=OuterRef('pk')).order_by().values('product')
+        rating_sum = Subquery(reviews.annotate(total=Sum('rating')).values('total'), output_field=IntegerField())
+        review_count = Subquery(reviews.annotate(total=Count('id')).values('total'), output_field=IntegerField())
+
+        last_id = 0
+        updated = 0
+        while True:
+            ids = list(
+                Product.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            # One set-based UPDATE per id range, short transactions keep row locks brief
+            with transaction.atomic():
+                updated += Product.objects.filter(id__gte=ids[0], id__lte=ids[-1]).update(
+                    rating_sum=Coalesce(rating_sum, Value(0)),
+                    review_count=Coalesce(review_count, Value(0)),
+                )
+            last_id = ids[-1]
+
+        # .update() skips signals, so re-rank and invalidate cached catalog pages once at the end
+        rebuild_ranking(batch_size)
+        bump_catalog_generation(Category.objects.values_list('id', flat=True))
+        bump_fragment_epoch()
+        self.stdout.write(self.style.SUCCESS(f"Recomputed ratings for {updated} products"))
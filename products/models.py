@@ -1,10 +1,13 @@
-from django.db import models
+from django.db import models, transaction
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from accounts.models import User
 from .utils import Category_image_renamer
 from uuid import uuid4
 from django.utils.text import slugify 
 from core.utils import Base_content
 from django.core.cache import cache
+from .cache import recently_viewed_cache_key
 from django.utils import timezone
 
 # Create your models here.
@@ -60,15 +63,29 @@ class Product(Base_content):
     updated_at = models.DateTimeField(auto_now=True)
     status = models.CharField(max_length=50,choices=(('Active','Active'),('Inactive','Inactive')),default='Active')
     slug = models.SlugField(unique=True,null=True,blank=True)
+    # Denormalized from Review, kept current by products.signals and the recompute_product_ratings command
+    rating_sum = models.IntegerField(default=0, editable=False)
+    review_count = models.IntegerField(default=0, editable=False)
+    # Maintained by products.search.update_search_vectors
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='product_search_vector_gin'),
+            GinIndex(fields=['name'], name='product_name_trgm', opclasses=['gin_trgm_ops']),
+        ]
 
     def __str__(self):
         return self.name
 
+    @property
+    def average_rating(self):
+        if not self.review_count:
+            return 0
+        return round(self.rating_sum / self.review_count, 1)
+
     def save(self, *args, **kwargs):
-        # Clear the product detail cache when a product is saved
-        cache_key = f"product_detail_{self.slug}"
-        cache.delete(cache_key)
-        
+        # Cached catalog responses are invalidated by the generation bump in products.signals
         if not self.slug:
             self.slug = slugify(self.name+str(uuid4())[:10])
             
@@ -99,19 +116,37 @@ class ProductVariant(Base_content):
     total_stock = models.IntegerField(default=1)
     slug = models.SlugField(unique=True,null=True,blank=True)
 
+    class Meta:
+        indexes = [
+            GinIndex(fields=['variant_name'], name='variant_name_trgm', opclasses=['gin_trgm_ops']),
+        ]
+
     def __str__(self):
         return f"{self.product.name} - {self.variant_name}"
     
     def save(self, *args, **kwargs):
-        # Clear the product detail cache when a product is saved
-        cache_key = f"variant_detail_{self.slug}"
-        cache.delete(cache_key)
-        
+        # Cached catalog responses are invalidated by the generation bump in products.signals
         if not self.slug:
             self.slug = slugify(self.product.name+str(uuid4())[:10])
             
         return super().save(*args,**kwargs)
 
+class VariantFacetCount(models.Model):
+    """
+    Precomputed number of variants per facet value within a category, maintained by products.facets.
+    """
+    category = models.ForeignKey(Category, related_name='facet_counts', on_delete=models.CASCADE)
+    facet = models.CharField(max_length=50)
+    value = models.CharField(max_length=255)
+    label = models.CharField(max_length=500, blank=True)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('category', 'facet', 'value')
+
+    def __str__(self):
+        return f"{self.category} {self.facet}={self.value}: {self.count}"
+
 class ProductVarientImage(Base_content):
     varient = models.ForeignKey(ProductVariant, related_name='variant_images', on_delete=models.CASCADE)
     image = models.ImageField(upload_to='products/')
@@ -119,11 +154,6 @@ class ProductVarientImage(Base_content):
 
     def __str__(self):
         return f"{self.varient.product.name} Image"
-    
-    # def save(self, *args, **kwargs):
-    #     # Clear the product detail cache when a product is saved
-    #     cache_key = f"variant_detail_{self.slug}"
-    #     cache.delete(cache_key)
 
 
 class Warehouse(Base_content):
@@ -154,6 +184,11 @@ class Review(Base_content):
     def __str__(self):
         return f"Review by {self.user.email} on {self.product.name}"
 
+    def save(self, *args, **kwargs):
+        # The product rating counters are updated from post_save, keep both in one transaction
+        with transaction.atomic():
+            return super().save(*args, **kwargs)
+
 
 class RecentlyViewedProduct(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="recently_viewed")
@@ -170,5 +205,5 @@ class RecentlyViewedProduct(models.Model):
     def save(self, *args, **kwargs):
         # Update cache when a product is viewed
         super().save(*args, **kwargs)
-        cache_key = f"recently_viewed_variants_{self.user.id}"
+        cache_key = recently_viewed_cache_key(self.user_id)
         cache.delete(cache_key)
\ No newline at end of file
@@ -0,0 +1,157 @@
+from django.db.models import F, FloatField, OuterRef, Subquery
+from django.db.models.functions import Cast
+from django_redis import get_redis_connection
+from core.cache import async_redis
+from .models import Product, ProductVariant
+
+# Materialized popularity ranking: a sorted set of first-variant ids scored by the
+# product's average rating, plus a hash of product id -> ranked variant id so a
+# product can be re-ranked without scanning the set.
+RANKING_KEY = 'popular_variants_ranking'
+MEMBERS_KEY = 'popular_variants_ranking_members'
+
+# KEYS: ranking, members. ARGV: product id, variant id ('' to drop the product), score.
+# A ranking that is not fully there (never built, flushed, evicted) is left alone, a single
+# product would otherwise make a partial ranking that readers take for a built one; the
+# next read rebuilds it.
+_SET_PRODUCT_RANK = """
+local present = redis.call('EXISTS', KEYS[1], KEYS[2])
+if present < 2 then
+    if present == 1 then
+        redis.call('DEL', KEYS[1], KEYS[2])
+    end
+    return 0
+end
+local old = redis.call('HGET', KEYS[2], ARGV[1])
+if old then
+    redis.call('ZREM', KEYS[1], old)
+end
+if ARGV[2] == '' then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+else
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[2])
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+end
+return 1
+"""
+
+
+def _ranked_products():
+    """
+    Products with at least one review, annotated with their first variant and average rating.
+    """
+    first_variant = ProductVariant.objects.filter(product=OuterRef('pk')).order_by('id').values('id')[:1]
+    return Product.objects.filter(review_count__gt=0).annotate(
+        first_variant_id=Subquery(first_variant),
+        avg_rating=Cast('rating_sum', FloatField()) / F('review_count'),
+    ).filter(first_variant_id__isnull=False)
+
+
+def refresh_product_ranking(product_id):
+    """
+    Re-rank a single product after its reviews or variants changed. Does nothing while the
+    ranking is not built.
+    """
+    row = _ranked_products().filter(pk=product_id).values_list('first_variant_id', 'avg_rating').first()
+    variant_id, score = row if row else ('', 0)
+    redis = get_redis_connection('default')
+    redis.register_script(_SET_PRODUCT_RANK)(keys=[RANKING_KEY, MEMBERS_KEY], args=[product_id, variant_id, score])
+
+
+def rebuild_ranking(batch_size=5000):
+    """
+    Rebuild the whole ranking into temporary keys and swap them in atomically.
+    Returns the number of ranked products.
+    """
+    redis = get_redis_connection('default')
+    tmp_ranking, tmp_members = f'{RANKING_KEY}_rebuild', f'{MEMBERS_KEY}_rebuild'
+    redis.delete(tmp_ranking, tmp_members)
+
+    total = 0
+    rows = _ranked_products().values_list('id', 'first_variant_id', 'avg_rating').iterator(chunk_size=batch_size)
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            total += _write_batch(redis, tmp_ranking, tmp_members, batch)
+            batch = []
+    total += _write_batch(redis, tmp_ranking, tmp_members, batch)
+
+    pipe = redis.pipeline(transaction=True)
+    if total:
+        pipe.rename(tmp_ranking, RANKING_KEY)
+        pipe.rename(tmp_members, MEMBERS_KEY)
+    else:
+        pipe.delete(RANKING_KEY, MEMBERS_KEY)
+    pipe.execute()
+    return total
+
+
+def _write_batch(redis, ranking_key, members_key, rows):
+    if not rows:
+        return 0
+    pipe = redis.pipeline(transaction=False)
+    pipe.zadd(ranking_key, {variant_id: score for _, variant_id, score in rows})
+    pipe.hset(members_key, mapping={product_id: variant_id for product_id, variant_id, _ in rows})
+    pipe.execute()
+    return len(rows)
+
+
+def ranking_exists():
+    return bool(get_redis_connection('default').exists(RANKING_KEY))
+
+
+def ranking_size():
+    return get_redis_connection('default').zcard(RANKING_KEY)
+
+
+def ranking_page(start, count):
+    """
+    Variant ids ranked start..start+count-1, best rated first.
+    """
+    ids = get_redis_connection('default').zrevrange(RANKING_KEY, start, start + count - 1)
+    return [int(variant_id) for variant_id in ids]
+
+
+def ranking_position(variant_id, score):
+    """
+    Position right after variant_id. Falls back to its score when the variant has since left the ranking.
+    """
+    redis = get_redis_connection('default')
+    rank = redis.zrevrank(RANKING_KEY, variant_id)
+    if rank is not None:
+        return rank + 1
+    return redis.zcount(RANKING_KEY, f'({score}', '+inf')
+
+
+def ranking_score(variant_id):
+    """
+    Score (average rating) variant_id is ranked with, None when it is not ranked.
+    """
+    return get_redis_connection('default').zscore(RANKING_KEY, variant_id)
+
+
+# Async twins of the readers above, for the async views
+async def aranking_exists():
+    return bool(await async_redis().exists(RANKING_KEY))
+
+
+async def aranking_size():
+    return await async_redis().zcard(RANKING_KEY)
+
+
+async def aranking_page(start, count):
+    ids = await async_redis().zrevrange(RANKING_KEY, start, start + count - 1)
+    return [int(variant_id) for variant_id in ids]
+
+
+async def aranking_position(variant_id, score):
+    redis = async_redis()
+    rank = await redis.zrevrank(RANKING_KEY, variant_id)
+    if rank is not None:
+        return rank + 1
+    return await redis.zcount(RANKING_KEY, f'({score}', '+inf')
+
+
+async def aranking_score(variant_id):
+    return await async_redis().zscore(RANKING_KEY, variant_id)
@@ -0,0 +1,79 @@
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramWordSimilarity
+from django.db import connection
+from django.db.models import F, OuterRef, Q, Subquery, TextField, Value
+from django.db.models.functions import Coalesce, Greatest
+from .models import Category, Product, ProductTag, ProductVariant
+
+SEARCH_CONFIG = 'english'
+
+
+def is_postgres():
+    return connection.vendor == 'postgresql'
+
+
+def _product_search_vector():
+    """
+    Weighted document for Product.search_vector. Related names are pulled in with
+    correlated subqueries so the whole vector can be written with a single UPDATE.
+    """
+    tag_names = ProductTag.objects.filter(products=OuterRef('pk')).order_by().values('products') \
+                                  .annotate(names=StringAgg('name', ' ')).values('names')
+    variant_names = ProductVariant.objects.filter(product=OuterRef('pk')).order_by().values('product') \
+                                          .annotate(names=StringAgg('variant_name', ' ')).values('names')
+    category_name = Category.objects.filter(pk=OuterRef('category_id')).values('name')
+    return (
+        SearchVector('name', weight='A', config=SEARCH_CONFIG)
+        + SearchVector(Coalesce(Subquery(tag_names), Value(''), output_field=TextField()), weight='B', config=SEARCH_CONFIG)
+        + SearchVector(Coalesce(Subquery(category_name), Value(''), output_field=TextField()), weight='B', config=SEARCH_CONFIG)
+        + SearchVector(Coalesce(Subquery(variant_names), Value(''), output_field=TextField()), weight='B', config=SEARCH_CONFIG)
+        + SearchVector('description', weight='C', config=SEARCH_CONFIG)
+    )
+
+
+def update_search_vectors(product_ids=None):
+    """
+    Recompute the stored search vector for the given products, or for every product.
+    A no-op outside PostgreSQL, where search falls back to icontains.
+    """
+    if not is_postgres():
+        return 0
+    products = Product.objects.all()
+    if product_ids is not None:
+        products = products.filter(pk__in=list(product_ids))
+    return products.update(search_vector=_product_search_vector())
+
+
+def search_variants(variants, query):
+    """
+    Filter and rank a ProductVariant queryset by a free-text query.
+
+    PostgreSQL: full-text match on the GIN-indexed Product.search_vector, ranked by
+    SearchRank. When nothing matches (typos), falls back to the trigram word-similarity
+    operator on the product and variant names, which the trigram GIN indexes serve.
+    Other databases get a plain icontains scan.
+    """
+    if not is_postgres():
+        return variants.filter(
+            Q(product__name__icontains=query)
+            | Q(product__description__icontains=query)
+            | Q(product__tags__name__icontains=query)
+            | Q(product__category__name__icontains=query)
+            | Q(variant_name__icontains=query)
+        ).distinct().order_by('id')
+
+    search_query = SearchQuery(query, search_type='websearch', config=SEARCH_CONFIG)
+    matches = variants.filter(product__search_vector=search_query).annotate(
+        rank=SearchRank(F('product__search_vector'), search_query)
+    ).order_by('-rank', 'id')
+    if matches.exists():
+        return matches
+
+    return variants.filter(
+        Q(product__name__trigram_word_similar=query) | Q(variant_name__trigram_word_similar=query)
+    ).annotate(
+        similarity=Greatest(
+            TrigramWordSimilarity(query, 'product__name'),
+            TrigramWordSimilarity(query, 'variant_name'),
+        )
+    ).order_by('-similarity', 'id')
@@ -1,7 +1,7 @@
 from rest_framework import serializers
+from core.serializers import QueryPlanMixin
 from .models import Product, ProductVarientImage, ProductVariant,Category,ProductTag
 from .models import *
-from django.db.models import Avg
 
 
 class CategorySerializer(serializers.ModelSerializer):
@@ -14,46 +14,82 @@ class BannerSerializer(serializers.ModelSerializer):
         model = Banner
         fields = ['id', 'title', 'image', 'link_url', 'description', 'is_active']
 
-class ProductImageSerializer(serializers.ModelSerializer):
+class ProductImageSerializer(QueryPlanMixin, serializers.ModelSerializer):
     class Meta:
         model = ProductVarientImage
         fields = ['id', 'image', 'alt_text']
 
-class VariantValuesSerializer(serializers.ModelSerializer):
+class VariantValuesSerializer(QueryPlanMixin, serializers.ModelSerializer):
     varient_type = serializers.StringRelatedField()  # Display the name of the variant type
+    plan_select_related = ('varient_type',)
 
     class Meta:
         model = Varient_values
         fields = ['id', 'varient_type', 'value']
 
-class ProductDetailSerializer(serializers.ModelSerializer):
+class ProductDetailSerializer(QueryPlanMixin, serializers.ModelSerializer):
     """Serializer for basic product details to be included in the variant response."""
     category = serializers.StringRelatedField()  # Display the name of the category
     tags = serializers.StringRelatedField(many=True)  # Display the names of tags
     average_rating = serializers.SerializerMethodField()
-    review_count = serializers.SerializerMethodField()
+    review_count = serializers.IntegerField(read_only=True)
+    plan_select_related = ('category',)
+    plan_prefetch_related = ('tags',)
 
     class Meta:
         model = Product
         fields = ['id', 'name', 'description', 'category', 'tags', 'price', 'discount_price','average_rating','review_count']
     
     def get_average_rating(self, obj):
-        """Method to return the average rating for a product."""
-        reviews = obj.reviews.all()
-        if reviews.exists():
-            avg_rating = reviews.aggregate(Avg('rating'))['rating__avg']
-            return round(avg_rating, 1)
-        return 0
-    
-    def get_review_count(self,obj):
-        return obj.reviews.count()
+        """Method to return the average rating for a product, from the stored rating counters."""
+        return obj.average_rating
 
-class ProductVariantSerializer(serializers.ModelSerializer):
+class ProductVariantSerializer(QueryPlanMixin, serializers.ModelSerializer):
     primary_varient = VariantValuesSerializer(read_only=True)
     secondary_varient = VariantValuesSerializer(read_only=True)
     variant_images = ProductImageSerializer(many=True, read_only=True)
     product = ProductDetailSerializer(read_only=True)  # Include selective product details
+    plan_nested = {'product': ProductDetailSerializer, 'primary_varient': VariantValuesSerializer,
+                   'secondary_varient': VariantValuesSerializer}
+    plan_prefetch_related = ('variant_images',)
 
     class Meta:
         model = ProductVariant
         fields = ['id', 'variant_name', 'price', 'discount_price', 'sku', 'total_stock', 'primary_varient', 'secondary_varient', 'variant_images', 'product','slug']
+
+
+class ProductSummarySerializer(QueryPlanMixin, serializers.ModelSerializer):
+    """Product details for listings: no description and no tags."""
+    category = serializers.StringRelatedField()
+    average_rating = serializers.SerializerMethodField()
+    review_count = serializers.IntegerField(read_only=True)
+    plan_select_related = ('category',)
+
+    class Meta:
+        model = Product
+        fields = ['id', 'name', 'category', 'price', 'discount_price', 'average_rating', 'review_count']
+
+    def get_average_rating(self, obj):
+        return obj.average_rating
+
+
+class ProductVariantSummarySerializer(QueryPlanMixin, serializers.ModelSerializer):
+    """Lean variant representation for list endpoints (`?fields=summary`)."""
+    primary_varient = VariantValuesSerializer(read_only=True)
+    secondary_varient = VariantValuesSerializer(read_only=True)
+    variant_images = ProductImageSerializer(many=True, read_only=True)
+    product = ProductSummarySerializer(read_only=True)
+    plan_nested = {'product': ProductSummarySerializer, 'primary_varient': VariantValuesSerializer,
+                   'secondary_varient': VariantValuesSerializer}
+    plan_prefetch_related = ('variant_images',)
+
+    class Meta:
+        model = ProductVariant
+        fields = ['id', 'variant_name', 'price', 'discount_price', 'total_stock', 'primary_varient', 'secondary_varient', 'variant_images', 'product', 'slug']
+
+
+# Serializer profiles of the variant list endpoints, picked with ?fields=
+VARIANT_PROFILES = {
+    'full': ProductVariantSerializer,
+    'summary': ProductVariantSummarySerializer,
+}
@@ -0,0 +1,329 @@
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from .models import (
+    Banner, Category, Product, ProductTag, ProductVariant, ProductVarientImage,
+    Review, Stock, SubCategory, Varient_Type, Varient_values,
+)
+from core.cache import invalidate
+from .cache import (BANNERS_CACHE_KEY, CATEGORIES_CACHE_KEY, bump_banner_generation, bump_catalog_generation,
+                    bump_stock_generation)
+from .ranking import refresh_product_ranking
+from .search import update_search_vectors
+from . import facets
+from .fragments import bump_variant_versions, bump_fragment_epoch
+
+
+def invalidate_catalog(category_ids=()):
+    """
+    Bump the catalog generations once the current transaction commits, so a
+    concurrent reader can never cache pre-commit data under the new generation.
+    """
+    category_ids = list(category_ids)
+    transaction.on_commit(lambda: bump_catalog_generation(category_ids))
+
+
+def invalidate_stock():
+    """
+    Bump the stock generation once the current transaction commits.
+    """
+    transaction.on_commit(bump_stock_generation)
+
+
+def product_category_ids(**filters):
+    return Product.objects.filter(**filters).values_list('category_id', flat=True).distinct()
+
+
+def all_category_ids():
+    return Category.objects.values_list('id', flat=True)
+
+
+@receiver([post_save, post_delete], sender=Category)
+def category_changed(sender, instance, **kwargs):
+    invalidate_catalog([instance.id])
+
+
+def rerank_products(product_ids):
+    """
+    Refresh the popularity ranking of the given products once the current transaction commits.
+    """
+    product_ids = {product_id for product_id in product_ids if product_id}
+    transaction.on_commit(lambda: [refresh_product_ranking(product_id) for product_id in product_ids])
+
+
+@receiver([post_save, post_delete], sender=Product)
+def product_changed(sender, instance, **kwargs):
+    # A product moved to another category invalidates both listings
+    invalidate_catalog([instance.category_id, instance.initial_value('category')])
+    if kwargs.get('signal') is post_delete:
+        rerank_products([instance.id])
+
+
+@receiver([post_save, post_delete], sender=ProductVariant)
+def variant_changed(sender, instance, **kwargs):
+    invalidate_catalog(product_category_ids(id=instance.product_id))
+    # Only creating, deleting or moving a variant can change which one is first for its product
+    if kwargs.get('created', True) or instance.has_changed('product'):
+        rerank_products([instance.product_id, instance.initial_value('product')])
+
+
+@receiver([post_save, post_delete], sender=ProductVarientImage)
+def variant_image_changed(sender, instance, **kwargs):
+    invalidate_catalog(product_category_ids(variants__id=instance.varient_id))
+
+
+@receiver([post_save, post_delete], sender=Stock)
+def product_child_changed(sender, instance, **kwargs):
+    invalidate_catalog(product_category_ids(id=instance.product_id))
+
+
+def adjust_product_rating(product_id, rating_delta, count_delta):
+    Product.objects.filter(pk=product_id).update(
+        rating_sum=F('rating_sum') + rating_delta,
+        review_count=F('review_count') + count_delta,
+    )
+
+
+@receiver(post_save, sender=Review)
+def review_saved(sender, instance, created, **kwargs):
+    if created:
+        adjust_product_rating(instance.product_id, instance.rating, 1)
+        invalidate_catalog(product_category_ids(id=instance.product_id))
+        rerank_products([instance.product_id])
+        return
+
+    # Review.save runs in a transaction, so the old and new product move together
+    old_product_id = instance.initial_value('product')
+    old_rating = instance.initial_value('rating')
+    if old_product_id != instance.product_id:
+        adjust_product_rating(old_product_id, -old_rating, -1)
+        adjust_product_rating(instance.product_id, instance.rating, 1)
+    elif old_rating != instance.rating:
+        adjust_product_rating(instance.product_id, instance.rating - old_rating, 0)
+    invalidate_catalog(product_category_ids(id__in=[old_product_id, instance.product_id]))
+    rerank_products([old_product_id, instance.product_id])
+
+
+@receiver(post_delete, sender=Review)
+def review_deleted(sender, instance, **kwargs):
+    # Runs inside the delete transaction; a no-op when the product itself is being deleted
+    adjust_product_rating(instance.product_id, -instance.rating, -1)
+    invalidate_catalog(product_category_ids(id=instance.product_id))
+    rerank_products([instance.product_id])
+
+
+@receiver(post_save, sender=ProductTag)
+def tag_changed(sender, instance, **kwargs):
+    invalidate_catalog(product_category_ids(tags=instance))
+
+
+@receiver(post_delete, sender=ProductTag)
+@receiver([post_save, post_delete], sender=Varient_values)
+@receiver([post_save, post_delete], sender=Varient_Type)
+def shared_value_changed(sender, instance, **kwargs):
+    # Shared across categories and their links may already be gone, so every category is invalidated
+    invalidate_catalog(all_category_ids())
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def product_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        invalidate_catalog([instance.category_id])
+    elif pk_set:
+        invalidate_catalog(product_category_ids(id__in=pk_set))
+    else:
+        invalidate_catalog(all_category_ids())
+
+
+# Search vectors: Product.search_vector folds in tag, category and variant names,
+# so it is recomputed whenever one of those changes.
+
+@receiver(post_save, sender=Product)
+def product_search_changed(sender, instance, **kwargs):
+    update_search_vectors([instance.id])
+
+
+@receiver(post_save, sender=Category)
+def category_search_changed(sender, instance, created, **kwargs):
+    if not created and instance.has_changed('name'):
+        update_search_vectors(Product.objects.filter(category=instance).values_list('id', flat=True))
+
+
+@receiver([post_save, post_delete], sender=ProductVariant)
+def variant_search_changed(sender, instance, **kwargs):
+    if kwargs.get('created', True) or instance.has_changed('variant_name') or instance.has_changed('product'):
+        update_search_vectors({instance.product_id, instance.initial_value('product')} - {None})
+
+
+@receiver(post_save, sender=ProductTag)
+def tag_search_changed(sender, instance, created, **kwargs):
+    if not created and instance.has_changed('name'):
+        update_search_vectors(Product.objects.filter(tags=instance).values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=ProductTag)
+def tag_search_deleted(sender, instance, **kwargs):
+    # The tag links are gone by post_delete, so collect the products now
+    product_ids = list(Product.objects.filter(tags=instance).values_list('id', flat=True))
+    transaction.on_commit(lambda: update_search_vectors(product_ids))
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def product_tags_search_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        product_ids = [instance.id]
+    elif pk_set:
+        product_ids = list(pk_set)
+    else:
+        product_ids = list(instance.products.values_list('id', flat=True))
+    if action == 'pre_clear':
+        transaction.on_commit(lambda: update_search_vectors(product_ids))
+    else:
+        update_search_vectors(product_ids)
+
+
+# Facet counts: variant saves apply a delta in their own transaction, changes that
+# fan out to many variants rebuild the affected categories after commit.
+
+def refacet_categories(category_ids):
+    category_ids = {category_id for category_id in category_ids if category_id}
+    transaction.on_commit(lambda: facets.rebuild_category_facets(category_ids))
+
+
+@receiver(post_save, sender=ProductVariant)
+def variant_facets_saved(sender, instance, created, **kwargs):
+    if not created and instance.has_changed('product'):
+        refacet_categories(product_category_ids(id__in=[instance.product_id, instance.initial_value('product')]))
+        return
+    facets.variant_saved(instance, created)
+
+
+@receiver(post_delete, sender=ProductVariant)
+def variant_facets_deleted(sender, instance, **kwargs):
+    refacet_categories(product_category_ids(id=instance.product_id))
+
+
+@receiver([post_save, post_delete], sender=Product)
+def product_facets_changed(sender, instance, **kwargs):
+    if kwargs.get('created') or not (instance.has_changed('category') or instance.has_changed('subcategory')
+                                     or kwargs.get('signal') is post_delete):
+        return
+    refacet_categories([instance.category_id, instance.initial_value('category')])
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def product_tags_facets_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        refacet_categories([instance.category_id])
+    elif pk_set:
+        refacet_categories(product_category_ids(id__in=pk_set))
+    else:
+        refacet_categories(product_category_ids(tags=instance))
+
+
+@receiver(post_save, sender=SubCategory)
+def subcategory_facets_changed(sender, instance, created, **kwargs):
+    if not created and instance.has_changed('name'):
+        refacet_categories(product_category_ids(subcategory=instance))
+
+
+@receiver(post_save, sender=ProductTag)
+@receiver(pre_delete, sender=ProductTag)
+def tag_facets_changed(sender, instance, **kwargs):
+    if not kwargs.get('created'):
+        refacet_categories(product_category_ids(tags=instance))
+
+
+@receiver(post_save, sender=Varient_values)
+@receiver(post_save, sender=Varient_Type)
+def variant_value_facets_changed(sender, instance, created, **kwargs):
+    if not created:
+        refacet_categories(all_category_ids())
+
+
+# Variant fragments: per-variant changes retire that variant's cached JSON, changes to
+# names shared by many variants retire every fragment. Both happen after commit.
+
+def invalidate_fragments(variant_ids):
+    variant_ids = list(variant_ids)
+    transaction.on_commit(lambda: bump_variant_versions(variant_ids))
+
+
+def invalidate_all_fragments():
+    transaction.on_commit(bump_fragment_epoch)
+
+
+def product_variant_ids(product_ids):
+    return ProductVariant.objects.filter(product_id__in=[i for i in product_ids if i]).values_list('id', flat=True)
+
+
+@receiver([post_save, post_delete], sender=ProductVariant)
+def variant_fragment_changed(sender, instance, **kwargs):
+    invalidate_fragments([instance.id])
+
+
+@receiver([post_save, post_delete], sender=ProductVarientImage)
+def variant_image_fragment_changed(sender, instance, **kwargs):
+    invalidate_fragments([instance.varient_id])
+
+
+@receiver(post_save, sender=Product)
+def product_fragment_changed(sender, instance, created, **kwargs):
+    if not created:
+        invalidate_fragments(product_variant_ids([instance.id]))
+
+
+@receiver([post_save, post_delete], sender=Review)
+def review_fragment_changed(sender, instance, **kwargs):
+    # The rating counters are part of the product details
+    invalidate_fragments(product_variant_ids([instance.product_id, instance.initial_value('product')]))
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def product_tags_fragment_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        invalidate_fragments(product_variant_ids([instance.id]))
+    elif pk_set:
+        invalidate_fragments(product_variant_ids(pk_set))
+    else:
+        invalidate_all_fragments()
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=ProductTag)
+@receiver(post_save, sender=Varient_values)
+@receiver(post_save, sender=Varient_Type)
+def shared_name_fragment_changed(sender, instance, created, **kwargs):
+    if not created:
+        invalidate_all_fragments()
+
+
+@receiver(post_delete, sender=ProductTag)
+@receiver(post_delete, sender=Varient_values)
+@receiver(post_delete, sender=Varient_Type)
+def shared_name_fragment_deleted(sender, instance, **kwargs):
+    invalidate_all_fragments()
+
+
+# Reference data: served from every process's L1, so drop it everywhere after commit.
+
+@receiver([post_save, post_delete], sender=Category)
+def categories_changed(sender, **kwargs):
+    transaction.on_commit(lambda: invalidate(CATEGORIES_CACHE_KEY))
+
+
+@receiver([post_save, post_delete], sender=Banner)
+def banners_changed(sender, **kwargs):
+    def bump():
+        invalidate(BANNERS_CACHE_KEY)
+        bump_banner_generation()
+    transaction.on_commit(bump)
@@ -1,3 +1,594 @@
+import csv
+import io
+import os
+import tempfile
+from decimal import Decimal
+from unittest import mock, skipIf, skipUnless
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.management import call_command
+from django_redis import get_redis_connection
+from django.db import DataError, connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.renderers import JSONRenderer
+from rest_framework_simplejwt.tokens import AccessToken
+from accounts.models import User
+from core.pagination import encode_cursor
+from core.serializers import apply_query_plan
+from core.tests import LocalCacheMixin
+from .cache import CATALOG_GENERATION_KEY, bump_catalog_generation, get_generations, recently_viewed_cache_key
+from .fragments import avariant_fragments, bump_fragment_epoch, bump_variant_versions, variant_fragments
+from .facets import facet_counts, filter_variants, rebuild_category_facets
+from .fast_serializers import PROFILES, serialize_variants
+from .ranking import MEMBERS_KEY, RANKING_KEY, rebuild_ranking, ranking_exists, ranking_page, ranking_size
+from .search import is_postgres, search_variants, update_search_vectors
+from .signals import invalidate_stock
+from .models import (Banner, Category, Product, ProductTag, ProductVariant, ProductVarientImage,
+                     RecentlyViewedProduct, Review, Stock, Varient_Type, Varient_values)
+from .serializers import VARIANT_PROFILES
 
-# Create your tests here.
+
+def make_catalog():
+    """
+    Two products with tags, reviews and variants covering the optional fields: a secondary
+    value or none, images or none, a discount price or none.
+    """
+    user = User.objects.create_user('reviewer@example.com', 'secret')
+    shoes, hats = Category.objects.create(name='Shoes'), Category.objects.create(name='Hats')
+    color, size = Varient_Type.objects.create(name='Color'), Varient_Type.objects.create(name='Size')
+    red = Varient_values.objects.create(varient_type=color, value='Red')
+    large = Varient_values.objects.create(varient_type=size, value='L')
+    new, sale = ProductTag.objects.create(name='new', slug='new'), ProductTag.objects.create(name='sale', slug='sale')
+
+    runner = Product.objects.create(name='Runner', description='Running shoe', price=Decimal('49.90'),
+                                    discount_price=Decimal('39.50'), sku='RUN', total_stock=20, category=shoes)
+    runner.tags.add(new, sale)
+    cap = Product.objects.create(name='Cap', description='Cotton cap', price=Decimal('12'), sku='CAP',
+                                 total_stock=5, category=hats)
+    for rating in (4, 5, 5):
+        Review.objects.create(user=user, product=runner, rating=rating, title='Good', content='Fits well')
+
+    variants = [
+        ProductVariant.objects.create(product=runner, primary_varient=red, secondary_varient=large,
+                                      variant_name='Red L', price=Decimal('49.90'), discount_price=Decimal('39.5'),
+                                      sku='RUN-RL', total_stock=10),
+        ProductVariant.objects.create(product=runner, primary_varient=red, variant_name='Red',
+                                      price=Decimal('45'), sku='RUN-R', total_stock=10),
+        ProductVariant.objects.create(product=cap, variant_name='Cap', price=Decimal('12.00'),
+                                      discount_price=Decimal('9.99'), sku='CAP-1', total_stock=5),
+    ]
+    ProductVarientImage.objects.create(varient=variants[0], image='products/run-front.jpg', alt_text='Front')
+    ProductVarientImage.objects.create(varient=variants[0], image='products/run-side.jpg')
+    ProductVarientImage.objects.create(varient=variants[2], image='products/cap.jpg', alt_text='Cap')
+    return variants
+
+
+class FastSerializerParityTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.variants = make_catalog()
+
+    def assertSameOutput(self, fast, serializer_class, queryset):
+        slow = serializer_class(apply_query_plan(queryset, serializer_class), many=True).data
+        self.assertEqual(fast, slow)
+        # Byte-for-byte, so key order and number formatting match too
+        self.assertEqual(JSONRenderer().render(fast), JSONRenderer().render(slow))
+
+    def test_queryset_matches_serializer(self):
+        queryset = ProductVariant.objects.order_by('-price', 'id')
+        for profile in PROFILES:
+            with self.subTest(profile=profile):
+                self.assertSameOutput(serialize_variants(queryset, profile), VARIANT_PROFILES[profile], queryset)
+
+    def test_ids_keep_their_order(self):
+        ids = [self.variants[2].id, self.variants[0].id, self.variants[1].id]
+        serializer_class = VARIANT_PROFILES['full']
+        slow = serializer_class(apply_query_plan(ProductVariant.objects.filter(id__in=ids), serializer_class), many=True).data
+        by_id = {data['id']: data for data in slow}
+        self.assertEqual(serialize_variants(ids), [by_id[variant_id] for variant_id in ids])
+
+
+class FragmentTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.variants = make_catalog()
+
+    def setUp(self):
+        # Ids are reused across tests once their rows are rolled back
+        bump_fragment_epoch()
+
+    def rendered(self, variant_ids, profile='summary'):
+        with mock.patch('products.fragments.serialize_variants', wraps=serialize_variants) as render:
+            variant_fragments(variant_ids, profile)
+        return [list(call.args[0]) for call in render.call_args_list]
+
+    def test_renders_misses_once_then_serves_hits(self):
+        runner, _, cap = self.variants
+        ids = [cap.id, runner.id, 10 ** 6, cap.id]
+        self.assertEqual(self.rendered(ids), [[cap.id, runner.id, 10 ** 6]])
+        # Only the missing variant is looked up again, and left out
+        self.assertEqual(self.rendered(ids), [[10 ** 6]])
+        self.assertEqual(variant_fragments(ids, 'summary'), serialize_variants([cap.id, runner.id], 'summary'))
+        with self.assertNumQueries(0):
+            self.assertEqual(len(variant_fragments([runner.id, cap.id], 'summary')), 2)
+        # Profiles are cached apart
+        self.assertEqual(self.rendered(ids, 'full'), [[cap.id, runner.id, 10 ** 6]])
+
+    def test_bumped_variant_is_rendered_again_alone(self):
+        runner, _, cap = self.variants
+        variant_fragments([runner.id, cap.id], 'summary')
+        # .update() skips the signals, the fragment is served until its version is bumped
+        ProductVariant.objects.filter(pk=runner.pk).update(price=Decimal('1.00'))
+        self.assertEqual(variant_fragments([runner.id], 'summary')[0]['price'], '49.90')
+        bump_variant_versions([runner.id])
+        self.assertEqual(self.rendered([runner.id, cap.id]), [[runner.id]])
+        self.assertEqual(variant_fragments([runner.id], 'summary')[0]['price'], '1.00')
+
+    def test_saving_a_variant_retires_its_fragment(self):
+        runner, _, cap = self.variants
+        variant_fragments([runner.id, cap.id], 'summary')
+        runner.price = Decimal('1.00')
+        with self.captureOnCommitCallbacks(execute=True):
+            runner.save()
+        self.assertEqual(self.rendered([runner.id, cap.id]), [[runner.id]])
+
+    async def test_async_reads_the_same_fragments(self):
+        runner, _, cap = self.variants
+        data = await avariant_fragments([cap.id, runner.id], 'summary')
+        self.assertEqual(data, await sync_to_async(variant_fragments)([cap.id, runner.id], 'summary'))
+        self.assertEqual([variant['id'] for variant in data], [cap.id, runner.id])
+
+
+class ProductRatingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.variants = make_catalog()
+        cls.runner, cls.cap = cls.variants[0].product, cls.variants[2].product
+        cls.reviewer = User.objects.get(email='reviewer@example.com')
+
+    def setUp(self):
+        # Ids are reused across tests once their rows are rolled back
+        bump_catalog_generation()
+        bump_fragment_epoch()
+
+    def counters(self, product):
+        return tuple(Product.objects.filter(pk=product.pk).values_list('rating_sum', 'review_count').get())
+
+    def test_counters_follow_review_changes(self):
+        self.assertEqual(self.counters(self.runner), (14, 3))
+        review = Review.objects.create(user=self.reviewer, product=self.runner, rating=1, title='Meh', content='Small')
+        self.assertEqual(self.counters(self.runner), (15, 4))
+        review.rating = 3
+        review.save()
+        self.assertEqual(self.counters(self.runner), (17, 4))
+        review.product = self.cap
+        review.save()
+        self.assertEqual((self.counters(self.runner), self.counters(self.cap)), ((14, 3), (3, 1)))
+        review.delete()
+        self.assertEqual(self.counters(self.cap), (0, 0))
+
+    def test_recompute_repairs_the_counters(self):
+        Product.objects.update(rating_sum=7, review_count=99)
+        call_command('recompute_product_ratings', '--batch-size', '1', stdout=io.StringIO())
+        self.assertEqual((self.counters(self.runner), self.counters(self.cap)), ((14, 3), (0, 0)))
+
+    def test_detail_reads_the_counters_and_follows_new_reviews(self):
+        url = reverse('product_detail', args=[self.variants[0].slug])
+        with CaptureQueriesContext(connection) as queries:
+            product = self.client.get(url).json()['product']
+        self.assertEqual((product['average_rating'], product['review_count']), (4.7, 3))
+        self.assertFalse([query for query in queries if 'products_review' in query['sql']])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Review.objects.create(user=self.reviewer, product=self.runner, rating=1, title='Meh', content='Small')
+        product = self.client.get(url).json()['product']
+        self.assertEqual((product['average_rating'], product['review_count']), (3.8, 4))
+
+
+class FacetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.variants = make_catalog()
+        cls.shoes = Category.objects.get(name='Shoes')
+
+    def setUp(self):
+        # Ids are reused across tests once their rows are rolled back
+        bump_catalog_generation()
+        bump_fragment_epoch()
+
+    def counts(self, category_id):
+        return {facet: {entry['value']: entry['count'] for entry in entries}
+                for facet, entries in facet_counts(category_id).items()}
+
+    def test_counts_follow_variant_saves(self):
+        red, large = self.variants[0].primary_varient_id, self.variants[0].secondary_varient_id
+        expected = {
+            'tag': {'new': 2, 'sale': 2},
+            'subcategory': {},
+            'primary': {str(red): 2},
+            'secondary': {str(large): 1},
+            'in_stock': {'true': 2},
+            'discounted': {'true': 1, 'false': 1},
+        }
+        self.assertEqual(self.counts(self.shoes.id), expected)
+
+        variant = self.variants[1]
+        variant.total_stock = 0
+        variant.save()
+        expected['in_stock'] = {'true': 1, 'false': 1}
+        self.assertEqual(self.counts(self.shoes.id), expected)
+        # The incremental deltas agree with a full recount
+        rebuild_category_facets([self.shoes.id])
+        self.assertEqual(self.counts(self.shoes.id), expected)
+        self.assertEqual(self.counts(None)['in_stock'], {'true': 2, 'false': 1})
+
+    def test_combined_filters(self):
+        red = self.variants[0].primary_varient_id
+        response = self.client.get(reverse('product_list'), {'tag': 'sale', 'primary': red, 'min_price': '46'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([variant['id'] for variant in response.json()['variants']], [self.variants[0].id])
+        variants, applied = filter_variants(ProductVariant.objects.order_by('id'),
+                                            {'discounted': 'true', 'max_price': '20', 'in_stock': '1'})
+        self.assertEqual(list(variants), [self.variants[2]])
+        self.assertEqual(applied, {'max_price': '20', 'in_stock': 'true', 'discounted': 'true'})
+
+    def test_ignores_invalid_values(self):
+        for params in ({'min_price': 'inf'}, {'max_price': 'NaN'}, {'min_price': '-Infinity'}, {'max_price': 'sNaN'},
+                       {'min_price': 'cheap'}, {'primary': '99999999999999999999'}, {'subcategory': '²,0,-1'}):
+            with self.subTest(params=params):
+                response = self.client.get(reverse('product_list'), params)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.json()['variants']), 3)
+                self.assertEqual(filter_variants(ProductVariant.objects.all(), params)[1], {})
+
+
+class CursorPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.variants = make_catalog()
+        product = cls.variants[2].product
+        cls.variants += [
+            ProductVariant.objects.create(product=product, variant_name=f'Cap {index}', price=Decimal('12.00'),
+                                          sku=f'CAP-{index + 2}', total_stock=5)
+            for index in range(20)
+        ]
+
+    def setUp(self):
+        # Ids are reused across tests once their rows are rolled back
+        bump_catalog_generation()
+        bump_fragment_epoch()
+
+    def test_variant_list_walks_every_variant_once(self):
+        seen, cursor = [], ''
+        while cursor is not None:
+            response = self.client.get(reverse('product_list'), {'cursor': cursor, 'fields': 'summary'})
+            self.assertEqual(response.status_code, 200)
+            seen += [variant['id'] for variant in response.json()['variants']]
+            cursor = response.json()['next_cursor']
+        self.assertEqual(seen, sorted(variant.id for variant in self.variants))
+
+    def test_rejects_tampered_cursors(self):
+        for url, cursor in ((reverse('product_list'), encode_cursor(['x'])),
+                            (reverse('product_list'), encode_cursor([{}])),
+                            (reverse('product_list'), encode_cursor([1, 2])),
+                            (reverse('product_list'), '!!'),
+                            (reverse('popular_variants'), encode_cursor(['x', 4.5])),
+                            (reverse('popular_variants'), encode_cursor([1, 'NaN'])),
+                            (reverse('popular_variants'), encode_cursor([1]))):
+            with self.subTest(url=url, cursor=cursor):
+                self.assertEqual(self.client.get(url, {'cursor': cursor}).status_code, 400)
+
+
+class ConditionalRequestTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.variants = make_catalog()
+
+    def setUp(self):
+        # Ids are reused across tests once their rows are rolled back
+        bump_catalog_generation()
+        bump_fragment_epoch()
+
+    def assertRevalidates(self, url, cache_control, change):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], cache_control)
+        etag = response['ETag']
+        # Answered before anything is queried, weak validators included
+        with self.assertNumQueries(0):
+            response = self.client.get(url, headers={'If-None-Match': f'W/{etag}'})
+        self.assertEqual((response.status_code, response['ETag'], response.content), (304, etag, b''))
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_variant_list(self):
+        def change():
+            self.variants[0].price = Decimal('1.00')
+            self.variants[0].save()
+
+        self.assertRevalidates(reverse('product_list'), 'public, max-age=60, stale-while-revalidate=30', change)
+
+    def test_variant_detail_follows_stock(self):
+        url = reverse('product_detail', args=[self.variants[2].slug])
+        self.assertRevalidates(url, 'public, max-age=60, stale-while-revalidate=30', invalidate_stock)
+
+    def test_categories(self):
+        def change():
+            Category.objects.create(name='Socks')
+
+        self.assertRevalidates(reverse('categories_list'), 'public, max-age=300, stale-while-revalidate=60', change)
+
+    def test_banners(self):
+        def change():
+            Banner.objects.create(title='Sale', image='banners/sale.jpg')
+
+        self.assertRevalidates(reverse('banner-list'), 'public, max-age=300, stale-while-revalidate=60', change)
+
+    def test_etag_depends_on_the_query(self):
+        first = self.client.get(reverse('product_list'))['ETag']
+        self.assertNotEqual(self.client.get(reverse('product_list'), {'page': 2})['ETag'], first)
+
+    def test_errors_carry_no_etag(self):
+        response = self.client.get(reverse('product_detail', args=['no-such-variant']))
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response.has_header('ETag'))
+
+
+class QueryCountTests(TestCase):
+    """
+    The listings cost the same number of queries for one variant as for ten, with nothing cached.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer@example.com', 'secret')
+        cls.product = make_catalog()[2].product
+        ProductVariant.objects.all().delete()
+
+    def add_variants(self, count):
+        for index in range(count):
+            variant = ProductVariant.objects.create(product=self.product, variant_name=f'Cap {index}',
+                                                    price=Decimal('12.00'), discount_price=Decimal('10.00'),
+                                                    sku=f'CAP-X{ProductVariant.objects.count()}', total_stock=5)
+            ProductVarientImage.objects.create(varient=variant, image=f'products/cap-{variant.id}.jpg')
+            RecentlyViewedProduct.objects.create(user=self.user, product_variant=variant)
+
+    def count_queries(self, url, params=None, headers=None):
+        # Cold caches: new listing and fragment keys, no cached recently viewed ids
+        bump_catalog_generation()
+        bump_fragment_epoch()
+        cache.delete(recently_viewed_cache_key(self.user.id))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()
+
+    def assertSameQueryCount(self, url, params=None, headers=None, key='data'):
+        self.add_variants(1)
+        one, data = self.count_queries(url, params, headers)
+        self.add_variants(9)
+        ten, more_data = self.count_queries(url, params, headers)
+        self.assertEqual(len(more_data[key]), len(data[key]) + 9)
+        self.assertEqual(ten, one)
+
+    def test_variant_list(self):
+        for params in ({}, {'cursor': ''}, {'fields': 'summary'}):
+            with self.subTest(params=params):
+                ProductVariant.objects.filter(sku__startswith='CAP-X').delete()
+                self.assertSameQueryCount(reverse('product_list'), params, key='variants')
+
+    def test_top_offers(self):
+        self.assertSameQueryCount(reverse('top-offer-product-variants'))
+
+    def test_recently_viewed(self):
+        headers = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+        self.assertSameQueryCount(reverse('recently-viewed-variants'), headers=headers)
+
+
+class RankingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.variants = make_catalog()
+        cls.reviewer = User.objects.get(email='reviewer@example.com')
+
+    def setUp(self):
+        self.addCleanup(get_redis_connection('default').delete, RANKING_KEY, MEMBERS_KEY)
+        # Ids are reused across tests once their rows are rolled back
+        bump_catalog_generation()
+        bump_fragment_epoch()
+
+    def review(self, variant, rating):
+        with self.captureOnCommitCallbacks(execute=True):
+            Review.objects.create(user=self.reviewer, product=variant.product, rating=rating, title='Great',
+                                  content='Fits')
+
+    def test_rebuild_ranks_the_first_variant_of_reviewed_products(self):
+        self.assertEqual(rebuild_ranking(), 1)
+        self.assertEqual(ranking_page(0, 10), [self.variants[0].id])
+
+    def test_review_reranks_its_product(self):
+        rebuild_ranking()
+        self.review(self.variants[2], 5)
+        self.assertEqual(ranking_page(0, 10), [self.variants[2].id, self.variants[0].id])
+        self.review(self.variants[2], 1)
+        self.review(self.variants[2], 1)
+        self.assertEqual(ranking_page(0, 10), [self.variants[0].id, self.variants[2].id])
+        self.assertEqual(ranking_size(), 2)
+
+    def test_review_leaves_an_unbuilt_ranking_alone(self):
+        get_redis_connection('default').delete(RANKING_KEY, MEMBERS_KEY)
+        self.review(self.variants[2], 5)
+        self.assertFalse(ranking_exists())
+        response = self.client.get(reverse('popular_variants'))
+        self.assertEqual([variant['id'] for variant in response.json()['variants']],
+                         [self.variants[2].id, self.variants[0].id])
+
+    def test_review_drops_a_partial_ranking(self):
+        rebuild_ranking()
+        get_redis_connection('default').delete(MEMBERS_KEY)
+        self.review(self.variants[2], 5)
+        self.assertFalse(ranking_exists())
+
+
+class GenerationTests(LocalCacheMixin, TestCase):
+    def test_bump_during_read_is_not_undone(self):
+        cache.set(CATALOG_GENERATION_KEY, 1, timeout=None)
+        self.addCleanup(cache.delete, CATALOG_GENERATION_KEY)
+        get_many = cache.get_many
+
+        def get_many_then_bump(keys):
+            # The generation is bumped between this reader's read and its L1 write
+            values = get_many(keys)
+            bump_catalog_generation()
+            return values
+
+        with mock.patch.object(cache, 'get_many', get_many_then_bump):
+            self.assertEqual(get_generations([CATALOG_GENERATION_KEY]), [1])
+        self.assertEqual(get_generations([CATALOG_GENERATION_KEY]), [2])
+
+
+def has_trigram():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        return cursor.fetchone() is not None
+
+
+class SearchViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.variants = make_catalog()
+        update_search_vectors()
+
+    def test_requires_a_query(self):
+        response = self.client.get(reverse('search'), {'q': '  '})
+        self.assertEqual(response.status_code, 400)
+
+    def test_returns_matching_variants(self):
+        response = self.client.get(reverse('search'), {'q': 'cap', 'fields': 'summary'})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([variant['id'] for variant in data['variants']], [self.variants[2].id])
+        self.assertEqual(data['variants'][0]['product']['name'], 'Cap')
+        self.assertEqual((data['page'], data['pages']), (1, 1))
+
+
+@skipIf(is_postgres(), 'the icontains fallback only runs outside PostgreSQL')
+class FallbackSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.variants = make_catalog()
+
+    def search(self, query):
+        return list(search_variants(ProductVariant.objects.all(), query).values_list('id', flat=True))
+
+    def test_matches_every_searched_field(self):
+        runner, runner_red, cap = [variant.id for variant in self.variants]
+        for query, expected in [
+            ('RUNNER', [runner, runner_red]),  # product name, any case
+            ('cotton', [cap]),  # description
+            ('sale', [runner, runner_red]),  # tag, each variant once despite two tags
+            ('hats', [cap]),  # category
+            ('red l', [runner]),  # variant name
+            ('boots', []),
+        ]:
+            with self.subTest(query=query):
+                self.assertEqual(self.search(query), expected)
+
+
+@skipUnless(is_postgres(), 'full-text search needs PostgreSQL')
+class FullTextSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.variants = make_catalog()
+        trail = Product.objects.create(name='Trail', description='Lighter than a runner', price=Decimal('30'),
+                                       sku='TRL', total_stock=3, category=Category.objects.get(name='Shoes'))
+        cls.trail = ProductVariant.objects.create(product=trail, variant_name='Trail', price=Decimal('30'),
+                                                  sku='TRL-1', total_stock=3)
+        update_search_vectors()
+
+    def search(self, query):
+        return list(search_variants(ProductVariant.objects.all(), query).values_list('id', flat=True))
+
+    def test_ranks_name_matches_above_description_matches(self):
+        runner, runner_red, _ = [variant.id for variant in self.variants]
+        # Stemmed, so "runners" finds "runner"; the name (weight A) outranks the description (C)
+        self.assertEqual(self.search('runners'), [runner, runner_red, self.trail.id])
+
+    def test_matches_tags_categories_and_variant_names(self):
+        runner, runner_red, cap = [variant.id for variant in self.variants]
+        self.assertEqual(self.search('sale'), [runner, runner_red])
+        self.assertEqual(self.search('hats'), [cap])
+        self.assertEqual(self.search('trail'), [self.trail.id])
+
+    def test_websearch_syntax(self):
+        runner, runner_red, _ = [variant.id for variant in self.variants]
+        self.assertEqual(self.search('shoe -lighter'), [runner, runner_red])
+        self.assertEqual(self.search('"cotton cap"'), [self.variants[2].id])
+
+    def test_falls_back_to_trigram_similarity_on_typos(self):
+        if not has_trigram():
+            self.skipTest('pg_trgm is not installed')
+        runner, runner_red, _ = [variant.id for variant in self.variants]
+        self.assertEqual(self.search('runer')[:2], [runner, runner_red])
+
+
+class ImportCatalogTests(TestCase):
+    COLUMNS = ['product_sku', 'product_name', 'category', 'tags', 'sku', 'price', 'total_stock', 'images',
+               'warehouse', 'warehouse_stock']
+
+    def import_rows(self, rows, *args):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False) as handle:
+            writer = csv.DictWriter(handle, self.COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        self.addCleanup(os.remove, handle.name)
+        stderr = io.StringIO()
+        call_command('import_catalog', handle.name, *args, stdout=io.StringIO(), stderr=stderr)
+        return stderr.getvalue().splitlines()
+
+    def row(self, sku, **values):
+        return {'product_sku': 'RUN', 'product_name': 'Runner', 'category': 'Shoes', 'tags': 'new|sale', 'sku': sku,
+                'price': '10.00', 'total_stock': '5', 'images': f'products/{sku}.jpg', 'warehouse': 'Pune',
+                'warehouse_stock': '8', **values}
+
+    def test_skips_values_the_columns_cannot_hold(self):
+        errors = self.import_rows([
+            self.row('RUN-1'),
+            self.row('RUN-2', price='123456789.00'),
+            self.row('RUN-3', product_name='R' * 256),
+            self.row('RUN-4', total_stock=str(2 ** 63)),
+            self.row('RUN-5', tags='new|' + 't' * 51),
+            self.row('RUN-6'),
+        ])
+        self.assertEqual(errors[:4], [
+            'line 3: price is out of range: 123456789.00',
+            'line 4: product_name is longer than 255 characters',
+            f'line 5: total_stock is out of range: {2 ** 63}',
+            'line 6: tags is longer than 50 characters',
+        ])
+        self.assertEqual(sorted(ProductVariant.objects.values_list('sku', flat=True)), ['RUN-1', 'RUN-6'])
+        self.assertEqual(Product.objects.get(sku='RUN').total_stock, 10)
+
+    def test_reimport_replaces_tags_images_and_stock(self):
+        self.import_rows([self.row('RUN-1'), self.row('RUN-2')])
+        self.import_rows([self.row('RUN-1', tags='sale', images='products/a.jpg|products/b.jpg', warehouse_stock='3')])
+        product = Product.objects.get(sku='RUN')
+        self.assertEqual(list(product.tags.values_list('slug', flat=True)), ['sale'])
+        self.assertEqual(sorted(ProductVarientImage.objects.filter(varient__sku='RUN-1').values_list('image', flat=True)),
+                         ['products/a.jpg', 'products/b.jpg'])
+        self.assertEqual(list(ProductVarientImage.objects.filter(varient__sku='RUN-2').values_list('image', flat=True)),
+                         ['products/RUN-2.jpg'])
+        self.assertEqual(list(Stock.objects.values_list('quantity', flat=True)), [3])
+
+    def test_batch_rejected_by_the_database_is_skipped(self):
+        with mock.patch('products.management.commands.import_catalog.update_search_vectors',
+                        side_effect=[DataError('value out of range'), None]):
+            errors = self.import_rows([self.row('RUN-1', category='Boots'), self.row('RUN-2', product_sku='CAP')],
+                                      '--batch-size', '1')
+        self.assertEqual(errors[0], 'line 2: batch rejected by the database: value out of range')
+        self.assertEqual(list(ProductVariant.objects.values_list('sku', flat=True)), ['RUN-2'])
+        self.assertFalse(Category.objects.filter(name='Boots').exists())
@@ -1,38 +1,102 @@
 from django.shortcuts import render,get_object_or_404
 from rest_framework.views import APIView
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, renderer_classes
+from rest_framework.renderers import BrowsableAPIRenderer
 from .serializers import *
 from rest_framework.response import Response
 from . models import *
 from django.core.paginator import Paginator
+from core.pagination import akeyset_paginate, apaginate, encode_cursor, decode_cursor, InvalidCursor
+from core.serializers import apply_query_plan, serializer_profile
+from core.renderers import FastJSONRenderer, FastJSONResponse
+from core.cache import acache_aside, atwo_tier, cache_aside, two_tier
+from core.http import conditional, CATALOG_CACHE_CONTROL, REFERENCE_CACHE_CONTROL
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import require_safe
+from asgiref.sync import sync_to_async
+from .fragments import avariant_fragments, variant_fragments
+from .search import search_variants
+from .facets import filter_variants, afacet_counts
+from .ranking import aranking_exists, rebuild_ranking, aranking_size, aranking_page, aranking_position, aranking_score
+import math
 from rest_framework import status
 from django.core.cache import cache
+from .cache import (
+    CATEGORIES_CACHE_KEY, BANNERS_CACHE_KEY, CATALOG_GENERATION_KEY, STOCK_GENERATION_KEY, acatalog_generation,
+    aget_generations, banner_generation,
+    avariant_list_cache_key, avariant_detail_cache_key,
+    apopular_variants_cache_key, recently_viewed_cache_key, search_cache_key,
+)
 from rest_framework import generics
-from django.db.models import Avg
 from rest_framework.permissions import IsAuthenticated
 from datetime import datetime
 from django.db.models import F, ExpressionWrapper, DecimalField
 # Create your views here.
 
+# variant_list, product_variant_detail, categories_list and popular_variants are the hot
+# read paths, so they are plain async Django views rather than DRF ones (DRF has no async
+# views): under daphne they run on the event loop, with cache hits served through the
+# redis.asyncio helpers of core.cache without taking a thread-pool slot. Queries use the
+# async ORM; building a fragment or a detail on a miss still runs the sync serializers.
 
+
+async def catalog_version(request, *args, **kwargs):
+    # Bumped by every catalog write, categories included, and by every stock movement, which
+    # only reaches the bodies through the fragments; read from the L1
+    return '.'.join(map(str, await aget_generations([CATALOG_GENERATION_KEY, STOCK_GENERATION_KEY])))
+
+
+async def categories_version(request, *args, **kwargs):
+    # Categories show no stock
+    return await acatalog_generation()
+
+
+@method_decorator(conditional(lambda request: banner_generation(), REFERENCE_CACHE_CONTROL), name='get')
 class BannerListView(generics.ListAPIView):
     queryset = Banner.objects.filter(is_active=True).order_by('-created_on')
     serializer_class = BannerSerializer
 
-@api_view(['GET'])
-def categories_list(request):
-    categories = Category.objects.filter(status=True)
-    category_serializer = CategorySerializer(categories,many=True)
+    def list(self, request, *args, **kwargs):
+        # Cached with relative image URLs, made absolute for this request's host
+        banners = two_tier(BANNERS_CACHE_KEY, lambda: BannerSerializer(self.get_queryset(), many=True).data, timeout=60 * 60)
+        return Response([
+            {**banner, 'image': request.build_absolute_uri(banner['image'])} if banner['image'] else banner
+            for banner in banners
+        ])
+
+@require_safe
+@conditional(categories_version, REFERENCE_CACHE_CONTROL)
+async def categories_list(request):
+    async def build_categories():
+        categories = [category async for category in Category.objects.filter(status=True)]
+        return CategorySerializer(categories,many=True).data
+
     response_data = {
         'status':1,
         'message':"",
-        'data':category_serializer.data
+        'data':await atwo_tier(CATEGORIES_CACHE_KEY, build_categories, timeout=60 * 60)
     }
-    return Response(response_data)
+    return FastJSONResponse(response_data)
+
+
+def _with_fragments(page_data, profile):
+    """
+    Response for a cached listing page: its variant_ids swapped for the variants' fragments.
+    """
+    data = dict(page_data)
+    variant_ids = data.pop('variant_ids')
+    return {'variants': variant_fragments(variant_ids, profile), **data}
+
+
+async def _awith_fragments(page_data, profile):
+    data = dict(page_data)
+    variant_ids = data.pop('variant_ids')
+    return {'variants': await avariant_fragments(variant_ids, profile), **data}
     
 
-@api_view(['GET'])
-def variant_list(request):
+@require_safe
+@conditional(catalog_version, CATALOG_CACHE_CONTROL)
+async def variant_list(request):
     """
     Fetch a list of product variants. Supports filtering by category (via category slug),
     pagination, and caching. Each variant includes associated product details, images, 
@@ -40,73 +104,156 @@ def variant_list(request):
 
     Caching Mechanism:
     - Caches variant listings by category and page number for efficient repeated requests.
-    - Cache is invalidated if variants or products are updated.
+      A cached page holds its variant ids only; the variants are assembled from the
+      per-variant fragments of products.fragments, shared with the other listings.
+    - Responses carry an ETag derived from the catalog generation, so a matching
+      If-None-Match gets a 304 before anything is queried, and a public Cache-Control.
+    - Cache keys carry the catalog (or category) generation, which is bumped on every
+      catalog write, so a cached page is never served after the data behind it changed.
 
     Query Parameters:
     - category: (string) Optional. Filter variants by the category of their parent product (category slug).
     - page: (int) Optional. The page number for paginated results. Default is 1.
+    - cursor: (string) Optional. Switches to keyset pagination; pass it empty for the first page,
+      then the `next_cursor` of the previous response. Deep pages cost the same as the first one.
+    - min_price, max_price: (decimal) Optional. Variant price range.
+    - tag: (string) Optional. Product tag slug.
+    - subcategory, primary, secondary: (int list) Optional. Comma separated subcategory or
+      variant value ids.
+    - in_stock, discounted: (bool) Optional. Only variants in stock / priced below their price.
+    - fields: (string) Optional. Serializer profile, `full` (default) or `summary`, which leaves
+      out the product description, tags and sku.
 
     Response:
     - Returns a paginated list of product variants including associated product details, images, and variant values.
+    - Variants are built by products.fast_serializers from .values() rows and rendered with
+      orjson; the output is identical to ProductVariantSerializer / the summary serializer.
+    - Always JSON: as an async view it has no browsable API.
+    - `facets` holds the number of variants per facet value in the category (or the whole
+      catalog), read from the precomputed VariantFacetCount table rather than grouped per request.
+    - In cursor mode `page` and `pages` are null and `next_cursor` is null on the last page.
     
     Status Codes:
     - 200: Success, with paginated variant data.
+    - 400: The cursor is not one this endpoint returned.
     - 404: Category not found if the provided category slug is invalid.
     """
-    category_slug = request.query_params.get('category', None)
-    page = request.query_params.get('page', 1)
-
-    # Cache key for specific category and page
-    cache_key = f"variants_{category_slug or 'all'}_page_{page}"
-    
-    # Check if data is cached
-    cached_data = cache.get(cache_key)
-    # if cached_data:
-    #     return Response(cached_data, status=status.HTTP_200_OK)
+    category_slug = request.GET.get('category', None)
+    page = request.GET.get('page', 1)
+    cursor = request.GET.get('cursor', None)
+    profile, _ = serializer_profile(request, VARIANT_PROFILES)
 
     try:
-        variants = ProductVariant.objects.all().select_related('product', 'primary_varient', 'secondary_varient', 'product__category') \
-                                              .prefetch_related('variant_images', 'product__tags')
-        
-        if category_slug:
-            category = Category.objects.get(slug=category_slug)
-            variants = variants.filter(product__category=category)
+        category = await Category.objects.aget(slug=category_slug) if category_slug else None
     except Category.DoesNotExist:
-        return Response({'error': 'Category not found'}, status=status.HTTP_404_NOT_FOUND)
+        return FastJSONResponse({'error': 'Category not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    variants = ProductVariant.objects.all()
+    variants, filters = filter_variants(variants, request.GET)
+
+    if category:
+        variants = variants.filter(product__category=category)
+
+    async def build_page():
+        facets = await afacet_counts(category.id if category else None)
+
+        if cursor is not None:
+            page_rows, next_cursor = await akeyset_paginate(variants.values('id'), cursor, ('id',), page_size=10)
+            return {
+                'variant_ids': [row['id'] for row in page_rows],
+                'page': None,
+                'pages': None,
+                'next_cursor': next_cursor,
+                'facets': facets,
+                'status': 1,
+            }
+
+        # Paginate variants
+        variant_ids, number, pages = await apaginate(variants.order_by('id').values_list('id', flat=True), page, 10)
+
+        return {
+            'variant_ids': variant_ids,
+            'page': number,
+            'pages': pages,
+            'facets': facets,
+            'status': 1,
+        }
 
-    # Paginate variants
-    paginator = Paginator(variants, 10)
+    # Cache key for specific category, filters and page
+    cache_key = await avariant_list_cache_key(category.id if category else None, page if cursor is None else f"cursor_{cursor}", filters)
     try:
-        paginated_variants = paginator.page(page)
-    except:
-        paginated_variants = paginator.page(1)
-    
-    # Serialize paginated variant data
-    serializer = ProductVariantSerializer(paginated_variants, many=True)
-    
-    # Prepare response data
-    response_data = {
-        'variants': serializer.data,
-        'page': paginated_variants.number,
-        'pages': paginated_variants.paginator.num_pages,
-        'status': 1,
-    }
+        page_data = await acache_aside(cache_key, build_page, timeout=60*15)  # Cache for 15 minutes
+    except InvalidCursor:
+        return FastJSONResponse({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Cache the response data
-    cache.set(cache_key, response_data, timeout=60*15)  # Cache for 15 minutes
-
-    return Response(response_data, status=status.HTTP_200_OK)
+    return FastJSONResponse(await _awith_fragments(page_data, profile), status=status.HTTP_200_OK)
     
 
 @api_view(['GET'])
-def product_variant_detail(request, slug):
+@renderer_classes([FastJSONRenderer, BrowsableAPIRenderer])
+def search(request):
+    """
+    Full-text search over product variants by product name, description, tags, category
+    and variant name.
+
+    On PostgreSQL this matches the GIN-indexed Product.search_vector and ranks results by
+    relevance, falling back to trigram similarity when the query has typos. Other databases
+    get a degraded icontains scan. Results are cached per query and page under the catalog
+    generation, like variant_list.
+
+    Query Parameters:
+    - q: (string) Required. The search text.
+    - page: (int) Optional. The page number for paginated results. Default is 1.
+    - fields: (string) Optional. Serializer profile, `full` (default) or `summary`.
+
+    Response:
+    - Returns a paginated list of product variants, serialized exactly like variant_list.
+
+    Status Codes:
+    - 200: Success, with paginated variant data.
+    - 400: The q parameter is missing or empty.
+    """
+    query = request.query_params.get('q', '').strip()
+    page = request.query_params.get('page', 1)
+    profile, _ = serializer_profile(request, VARIANT_PROFILES)
+
+    if not query:
+        return Response({'error': 'Search query is required', 'status': 0}, status=status.HTTP_400_BAD_REQUEST)
+
+    def build_page():
+        variants = search_variants(ProductVariant.objects.all(), query)
+
+        paginator = Paginator(variants, 10)
+        try:
+            paginated_variants = paginator.page(page)
+        except:
+            paginated_variants = paginator.page(1)
+
+        return {
+            'variant_ids': list(paginated_variants.object_list.values_list('id', flat=True)),
+            'page': paginated_variants.number,
+            'pages': paginated_variants.paginator.num_pages,
+            'status': 1,
+        }
+
+    page_data = cache_aside(search_cache_key(query, page), build_page, timeout=60*15)  # Cache for 15 minutes
+
+    return Response(_with_fragments(page_data, profile), status=status.HTTP_200_OK)
+
+
+@require_safe
+@conditional(catalog_version, CATALOG_CACHE_CONTROL)
+async def product_variant_detail(request, slug):
     """
     Fetch detailed information about a specific product variant by its ID.
     This includes variant details, product information, primary and secondary variant values, and images.
 
     Caching Mechanism:
-    - The variant detail is cached based on the variant ID to avoid repeated DB hits.
-    - Cache is invalidated if variant data is updated.
+    - The variant id is cached based on the variant slug to avoid repeated DB hits, under the
+      catalog generation, and kept in the in-process L1 of core.cache so repeat hits skip Redis.
+    - The detail itself is the variant's fragment from products.fragments, retired whenever
+      the variant changes, its stock included, without invalidating the rest of the catalog.
+    - ETag / If-None-Match and Cache-Control like variant_list.
 
     URL Parameters:
     - variant_id: (int) Required. The ID of the product variant to retrieve details for.
@@ -118,95 +265,125 @@ def product_variant_detail(request, slug):
     - 200: Success, with variant detail data.
     - 404: Variant not found if the provided ID is invalid.
     """
-    # Define cache key based on variant ID
-    cache_key = f"variant_detail_{slug}"
-
-    # Check if data is already cached
-    cached_data = cache.get(cache_key)
-    # if cached_data:
-    #     return Response(cached_data, status=status.HTTP_200_OK)
+    # Define cache key based on variant slug
+    cache_key = await avariant_detail_cache_key(slug)
 
-    # Fetch variant with related data
-    variant = get_object_or_404(ProductVariant.objects.prefetch_related('variant_images', 'primary_varient', 'secondary_varient', 'product'), slug=slug)
+    async def find_variant():
+        return await ProductVariant.objects.values_list('id', flat=True).aget(slug=slug)
 
-    # Serialize variant detail
-    serializer = ProductVariantSerializer(variant)
-
-    # Cache the serialized data for 15 minutes
-    cache.set(cache_key, serializer.data, timeout=60 * 15)
+    # Cached for 15 minutes, and kept in the in-process L1 too
+    try:
+        variant_id = await atwo_tier(cache_key, find_variant, timeout=60 * 15)
+    except ProductVariant.DoesNotExist:
+        variant_id = None
+
+    # Rendered by ProductVariantSerializer's fast path, the same output
+    variants = await avariant_fragments([variant_id], 'full') if variant_id else []
+    if not variants:
+        return FastJSONResponse({'detail': 'No ProductVariant matches the given query.'}, status=status.HTTP_404_NOT_FOUND)
+    return FastJSONResponse(variants[0], status=status.HTTP_200_OK)
+
+def _ranking_cursor(cursor):
+    # (variant id, score) of the last variant of the previous page
+    try:
+        variant_id, score = decode_cursor(cursor)
+        variant_id, score = int(variant_id), float(score)
+    except (TypeError, ValueError):
+        raise InvalidCursor(cursor)
+    if not math.isfinite(score):
+        raise InvalidCursor(cursor)
+    return variant_id, score
 
-    return Response(serializer.data, status=status.HTTP_200_OK)
 
-@api_view(['GET'])
-def popular_variants(request):
+@require_safe
+async def popular_variants(request):
     """
     Fetch a list of the first variant of each product based on the average rating of the product.
     Only the first variant is listed per product, ordered by the product's average rating.
 
+    The ordering is read from the materialized ranking in products.ranking (a Redis sorted set
+    refreshed when reviews or variants change), so a page costs one range read plus one query,
+    however many products have reviews.
+
     Query Parameters:
     - page: (int) Optional. The page number for paginated results. Default is 1.
+    - cursor: (string) Optional. Switches to cursor pagination over the ranking.
+    - fields: (string) Optional. Serializer profile, `full` (default) or `summary`.
 
     Response:
     - Returns a paginated list of the first variant for each product, ordered by the product's average rating.
-    """
-    page = request.query_params.get('page', 1)
-    cache_key = f"popular_variants_page_{page}"
-
-    cached_data = cache.get(cache_key)
-    if cached_data:
-        return Response(cached_data, status=status.HTTP_200_OK)
+    - In cursor mode `page` and `pages` are null and `next_cursor` points at the following page.
 
-    products = Product.objects.annotate(
-        avg_rating=Avg('reviews__rating')
-    ).filter(
-        avg_rating__isnull=False 
-    ).order_by('-avg_rating')
-
-    first_variants = [product.variants.first() for product in products if product.variants.exists()]
+    Status Codes:
+    - 200: Success.
+    - 400: The cursor is not one this endpoint returned.
+    """
+    page = request.GET.get('page', 1)
+    cursor = request.GET.get('cursor', None)
+    profile, _ = serializer_profile(request, VARIANT_PROFILES)
+    cache_key = await apopular_variants_cache_key(page if cursor is None else f"cursor_{cursor}")
+    page_size = 10
+
+    async def build_page():
+        if not await aranking_exists():
+            await sync_to_async(rebuild_ranking)()
+        total = await aranking_size()
+        pages = max(1, math.ceil(total / page_size))
+
+        if cursor is not None:
+            start = await aranking_position(*_ranking_cursor(cursor)) if cursor else 0
+        else:
+            try:
+                page_number = int(page)
+                if not 1 <= page_number <= pages:
+                    raise ValueError(page_number)
+            except (TypeError, ValueError):
+                page_number = 1
+            start = (page_number - 1) * page_size
+
+        variant_ids = await aranking_page(start, page_size)
+
+        if cursor is not None:
+            next_cursor = None
+            if variant_ids and start + page_size < total:
+                last_id = variant_ids[-1]
+                next_cursor = encode_cursor([last_id, await aranking_score(last_id)])
+            return {
+                'variant_ids': variant_ids,
+                'page': None,
+                'pages': None,
+                'next_cursor': next_cursor,
+            }
+        return {
+            'variant_ids': variant_ids,
+            'page': page_number,
+            'pages': pages,
+        }
 
-    paginator = Paginator(first_variants, 10) 
     try:
-        paginated_variants = paginator.page(page)
-    except:
-        paginated_variants = paginator.page(1)
+        page_data = await acache_aside(cache_key, build_page, timeout=60 * 1)  # Cache for 1 minute
+    except InvalidCursor:
+        return FastJSONResponse({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
 
-    serializer = ProductVariantSerializer(paginated_variants, many=True)
-
-    response_data = {
-        'variants': serializer.data,
-        'page': paginated_variants.number,
-        'pages': paginator.num_pages,
-    }
-
-    cache.set(cache_key, response_data, timeout=60 * 1)  # Cache for 15 minutes
-
-    return Response(response_data, status=status.HTTP_200_OK)
+    return FastJSONResponse(await _awith_fragments(page_data, profile), status=status.HTTP_200_OK)
 
 class RecentlyViewedProductVariantView(APIView):
     permission_classes = [IsAuthenticated]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
 
     def get(self, request):
         user = request.user
-        cache_key = f"recently_viewed_variants_{user.id}"
+        profile, _ = serializer_profile(request, VARIANT_PROFILES)
+        cache_key = recently_viewed_cache_key(user.id)
         
-        product_variants_data = cache.get(cache_key)
-
-        if product_variants_data is None:
+        def build_ids():
             recently_viewed_items = RecentlyViewedProduct.objects.filter(user=user).order_by('-viewed_at')[:10]  # Limit to 10 most recent
-            # print(recently_viewed_items,'recent')
-            # product_variants = ProductVariant.objects.filter(id__in=[item.product_variant.id for item in recently_viewed_items])
-            # print(product_variants,'variants')
-            product_variant_ids = [item.product_variant.id for item in recently_viewed_items]
-            product_variants = ProductVariant.objects.filter(id__in=product_variant_ids)
+            return [item.product_variant_id for item in recently_viewed_items]
 
-            product_variants = sorted(product_variants, key=lambda pv: product_variant_ids.index(pv.id))
+        product_variant_ids = cache_aside(cache_key, build_ids, timeout=60 * 1)
 
-            
-            serializer = ProductVariantSerializer(product_variants, many=True)
-            product_variants_data = serializer.data
-
-            cache.set(cache_key, product_variants_data, timeout=60 * 1)
-        print(product_variants_data,'data2')
+        # Kept in product_variant_ids order
+        product_variants_data = variant_fragments(product_variant_ids, profile)
         response_data = {
             'status':1,
             'data':product_variants_data
@@ -231,14 +408,15 @@ class RecentlyViewedProductVariantView(APIView):
             defaults={"viewed_at": datetime.now()}
         )
 
-        cache_key = f"recently_viewed_variants_{user.id}"
-        cache.delete(cache_key)
+        cache.delete(recently_viewed_cache_key(user.id))
 
         return Response({"message": "Product variant marked as recently viewed.",'status':1}, status=status.HTTP_200_OK)
 
 class TopOfferProductVariantsView(APIView):
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
     
     def get(self, request):
+        profile, _ = serializer_profile(request, VARIANT_PROFILES)
         offer_variants = ProductVariant.objects.filter(
             discount_price__isnull=False,
             discount_price__lt=F('price')  # Ensure there's a discount
@@ -248,9 +426,7 @@ class TopOfferProductVariantsView(APIView):
             )
         ).order_by('-discount_amount')[:10]  # Get top 10 by discount amount
 
-        serializer = ProductVariantSerializer(offer_variants, many=True)
-        
         return Response({
             "status": 1,
-            "data": serializer.data
+            "data": variant_fragments(offer_variants.values_list('id', flat=True), profile)
         }, status=status.HTTP_200_OK)
\ No newline at end of file